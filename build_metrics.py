@@ -0,0 +1,186 @@
+"""
+Per-stage timing and resource metrics for the build scripts.
+
+Every named stage records its wall time, the rows it produced, the peak RSS of the build process, how much the
+database grew and, on Postgres, the EXPLAIN plan of its main statement.  Sequential script steps use
+begin()/end() (begin() also prints the usual timestamped progress line and closes the previous stage), stages run
+by stage_runner use the stage() context manager.  add_rows() and explain() apply to the stage running on the
+calling thread.  write() dumps everything to a JSON file and optionally appends it to a build_metrics table so
+builds of different NCIt releases can be compared.
+
+    metrics = BuildMetrics(con, postgres)
+    metrics.begin("inserting loinc parents")
+    cur.execute(sql)
+    metrics.add_rows(cur.rowcount)
+    metrics.write('build_metrics.json', table='build_metrics')
+"""
+import contextlib
+import datetime
+import json
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+METRICS_TABLE = 'build_metrics'
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, None where the resource module is missing."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+
+def database_size(con, postgres):
+    cur = con.cursor()
+    if postgres:
+        cur.execute('select pg_database_size(current_database())')
+        return cur.fetchone()[0]
+    cur.execute('pragma page_count')
+    pages = cur.fetchone()[0]
+    cur.execute('pragma page_size')
+    return pages * cur.fetchone()[0]
+
+
+class StageRecord:
+
+    def __init__(self, name, con, postgres):
+        self.name = name
+        self.con = con
+        self.postgres = postgres
+        self.started = datetime.datetime.now()
+        self.rows = None
+        self.explain = None
+        self.db_size_before = database_size(con, postgres)
+        self._t0 = time.perf_counter()
+        self.result = None
+
+    def add_rows(self, n):
+        if n is not None and n >= 0:
+            self.rows = (self.rows or 0) + n
+
+    def explain_sql(self, sql, params=None):
+        """Keep the EXPLAIN (FORMAT JSON) plan of sql; only Postgres plans are recorded."""
+        if not self.postgres:
+            return
+        cur = self.con.cursor()
+        cur.execute('explain (format json) ' + sql, params)
+        plan = cur.fetchone()[0]
+        self.explain = plan if not isinstance(plan, str) else json.loads(plan)
+
+    def finish(self):
+        self.result = {
+            'stage': self.name,
+            'started': self.started.isoformat(),
+            'wall_seconds': round(time.perf_counter() - self._t0, 3),
+            'rows': self.rows,
+            'peak_rss_mb': peak_rss_mb(),
+            'db_size_delta': database_size(self.con, self.postgres) - self.db_size_before,
+            'explain': self.explain,
+        }
+        return self.result
+
+
+class BuildMetrics:
+
+    def __init__(self, con, postgres, script=None, enabled=True):
+        """With enabled=False begin() only prints the progress line and nothing is measured."""
+        self.con = con
+        self.postgres = postgres
+        self.script = script
+        self.enabled = enabled
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self.reports = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        """The stage being measured on this thread."""
+        return getattr(self._local, 'current', None)
+
+    @current.setter
+    def current(self, record):
+        self._local.current = record
+
+    def begin(self, name, con=None):
+        """End the current stage (if any) and start timing a new one."""
+        self.end()
+        print(datetime.datetime.now(), name)
+        if self.enabled:
+            self.current = StageRecord(name, con or self.con, self.postgres)
+        return self.current
+
+    def end(self, rows=None):
+        if self.current is None:
+            return
+        self.current.add_rows(rows)
+        self._append(self.current.finish())
+        self.current = None
+
+    def add_rows(self, n):
+        if self.current is not None:
+            self.current.add_rows(n)
+
+    def explain(self, sql, params=None):
+        if self.current is not None:
+            self.current.explain_sql(sql, params)
+
+    def report(self, name, data):
+        """Keep a free-form result (e.g. before/after measurements) in the JSON written by write()."""
+        with self._lock:
+            self.reports[name] = data
+
+    @contextlib.contextmanager
+    def stage(self, name, con=None):
+        """Measure a self-contained stage, possibly running on another thread and connection."""
+        if not self.enabled:
+            yield None
+            return
+        outer = self.current
+        record = self.current = StageRecord(name, con or self.con, self.postgres)
+        try:
+            yield record
+        finally:
+            self.current = outer
+        self._append(record.finish())
+
+    def _append(self, result):
+        with self._lock:
+            self.stages.append(result)
+
+    def summary(self):
+        return {'script': self.script,
+                'started': self.started.isoformat(),
+                'wall_seconds': round((datetime.datetime.now() - self.started).total_seconds(), 3),
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': self.stages,
+                'reports': self.reports}
+
+    def write(self, path=None, table=None, run_id=None):
+        """Write the collected stages to a JSON file and/or append them to table."""
+        self.end()
+        data = self.summary()
+        data['run_id'] = run_id or self.started.isoformat()
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2, default=str)
+        if table is not None and self.stages:
+            cur = self.con.cursor()
+            cur.execute('create table if not exists ' + table + ' (run_id text, script text, stage text, '
+                        'started text, wall_seconds float, rows bigint, peak_rss_mb float, db_size_delta bigint, '
+                        'explain text)')
+            p = '%s' if self.postgres else '?'
+            cur.executemany('insert into ' + table + ' values (' + ','.join([p] * 9) + ')',
+                            [(data['run_id'], self.script, s['stage'], s['started'], s['wall_seconds'], s['rows'],
+                              s['peak_rss_mb'], s['db_size_delta'],
+                              None if s['explain'] is None else json.dumps(s['explain']))
+                             for s in self.stages])
+            self.con.commit()
+        return data
@@ -0,0 +1,101 @@
+"""
+Checkpoints for resuming a failed build.
+
+The build records every stage it completes in a build_state table, together with a fingerprint of the inputs the
+stage was built from (NCIt version, input files, options) and the tables it produced.  A run with --resume skips a
+stage when its row is there with the same fingerprint, all of its output tables still exist and it was completed
+after the stages it depends on (so rebuilding a stage invalidates everything built from it).  An EVS failure or a
+lost connection late in the build then does not mean downloading the Thesaurus and recomputing the closures
+again.  A run without --resume starts from an empty build_state.
+
+    state = BuildState(con, postgres, resume=args.resume)
+    fp = fingerprint(current_evs_version, file_fingerprint('local_crosswalk.csv'))
+    if not state.done('crosswalk', fp):
+        rows = load_crosswalk()
+        state.mark_done('crosswalk', fp, outputs=['curated_crosswalk'], rows=rows)
+"""
+import datetime
+import hashlib
+import json
+import os
+
+import bulk_load
+
+STATE_TABLE = 'build_state'
+
+
+def fingerprint(*parts):
+    """A short stable hash of JSON-serialisable parts."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(path):
+    """Name, size and modification time of a file; cheap enough for multi-GB inputs."""
+    st = os.stat(path)
+    return [os.path.basename(path), st.st_size, int(st.st_mtime)]
+
+
+class BuildState:
+
+    def __init__(self, con, postgres, resume=False, table=STATE_TABLE):
+        self.con = con
+        self.postgres = postgres
+        self.resume = resume
+        self.table = table
+        self.p = '%s' if postgres else '?'
+        cur = con.cursor()
+        cur.execute('create table if not exists ' + table + ' (stage varchar(64) primary key, fingerprint varchar(40), '
+                    'outputs text, rows bigint, seq bigint, completed_at text)')
+        if not resume:
+            cur.execute('delete from ' + table)
+        con.commit()
+
+    def _row(self, cur, stage):
+        cur.execute('select fingerprint, outputs, seq from ' + self.table + ' where stage = ' + self.p, (stage,))
+        return cur.fetchone()
+
+    def _valid(self, cur, stage, fp, deps):
+        row = self._row(cur, stage)
+        if row is None or row[0] != fp:
+            return False
+        for dep in deps:
+            dep_row = self._row(cur, dep)
+            if dep_row is None or dep_row[2] >= row[2]:
+                return False
+        return all(bulk_load.table_exists(cur, t, self.postgres)
+                   and not (self.postgres and bulk_load.is_empty_unlogged(cur, t)) for t in json.loads(row[1]))
+
+    def done(self, stage, fp, deps=(), con=None):
+        """
+        True when resuming and stage was completed from the same inputs, after every stage in deps, and its
+        outputs are still there.  Otherwise the stage is about to be rebuilt and its old checkpoint is dropped, so
+        a run that fails half way through it cannot leave it looking complete.
+        """
+        con = con or self.con
+        cur = con.cursor()
+        if self.resume and self._valid(cur, stage, fp, deps):
+            print(datetime.datetime.now(), "skipping", stage, "-- already built from the same inputs")
+            return True
+        cur.execute('delete from ' + self.table + ' where stage = ' + self.p, (stage,))
+        con.commit()
+        return False
+
+    def set_outputs(self, stage, outputs, con=None):
+        """Replace the output tables recorded for a completed stage (when a later stage moved its rows elsewhere)."""
+        con = con or self.con
+        cur = con.cursor()
+        cur.execute('update ' + self.table + ' set outputs = ' + self.p + ' where stage = ' + self.p,
+                    (json.dumps(list(outputs)), stage))
+        con.commit()
+
+    def mark_done(self, stage, fp, outputs=(), rows=None, con=None):
+        con = con or self.con
+        if rows is not None and rows < 0:
+            rows = None
+        cur = con.cursor()
+        cur.execute('delete from ' + self.table + ' where stage = ' + self.p, (stage,))
+        cur.execute('select coalesce(max(seq), 0) + 1 from ' + self.table)
+        seq = cur.fetchone()[0]
+        cur.execute('insert into ' + self.table + ' values (' + ','.join([self.p] * 6) + ')',
+                    (stage, fp, json.dumps(list(outputs)), rows, seq, datetime.datetime.now().isoformat()))
+        con.commit()
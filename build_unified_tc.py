@@ -4,12 +4,12 @@
 
 
 import sqlite3
-import traceback
 
 import pandas as pd
 import zipfile
 import pprint
 import sys
+import os
 import wget
 import datetime
 import argparse
@@ -19,14 +19,22 @@ import requests
 import psycopg2
 import psycopg2.extras
 import sqlalchemy
-import time
-
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
+import functools
+
+import build_metrics
+import build_state
+import bulk_load
+import closure_artifact
+import evs_cache
+import evs_client
+import generation_swap
+import ontology_query
+import path_codec
+import physical_layout
+import reach_index
+import stage_runner
+import tc_engine
+import thesaurus_load
 
 start_time = datetime.datetime.now()
 pp = pprint.PrettyPrinter(indent=4)
@@ -40,15 +48,150 @@ parser.add_argument('--password', action='store', type=str, required=False)
 parser.add_argument('--port', action='store', type=str, required=False)
 parser.add_argument('--schema', action='store', type=str, required=False)
 parser.add_argument('--dbfilename', action='store', type=str, required=False )
+parser.add_argument('--tc_engine', action='store', type=str, required=False, default='sql', choices=['sql', 'python'],
+                    help='compute the closure and path tables with recursive SQL (default) or the in-process engine')
+parser.add_argument('--incremental', action='store_true', required=False,
+                    help='patch the closure tables of the previous build with the parent edges that changed')
+parser.add_argument('--skip_paths', action='store_true', required=False,
+                    help='only build parents and ncit_tc_all, computing the closure pairs directly; paths are '
+                         'enumerated on demand with path_query')
+parser.add_argument('--path_encoding', action='store', type=str, required=False, default='text',
+                    choices=['text', 'compact'],
+                    help='store ncit_tc_with_path_all as pipe-joined text (default) or as varint-encoded concept ids '
+                         'behind a decoding view, dropping the per-ontology path tables (sqlite readers need '
+                         'path_codec.register_if_compact)')
+parser.add_argument('--evs_url', action='store', type=str, required=False, default=evs_client.EVS_API_URL)
+parser.add_argument('--thesaurus_zip', action='store', type=str, required=False,
+                    help='use this Thesaurus FLAT zip instead of downloading the release EVS is serving')
+parser.add_argument('--crosswalk_csv', action='store', type=str, required=False, default='local_crosswalk.csv')
+parser.add_argument('--evs_concurrency', action='store', type=int, required=False, default=8,
+                    help='number of EVS calls in flight at once')
+parser.add_argument('--evs_rate', action='store', type=float, required=False, default=10.0,
+                    help='maximum EVS calls per second')
+parser.add_argument('--evs_cache', action='store', type=str, required=False,
+                    help='sqlite file caching EVS concept summaries per NCIt version')
+parser.add_argument('--evs_cache_versions', action='store', type=int, required=False, default=2,
+                    help='number of NCIt versions kept in the EVS cache')
+parser.add_argument('--thesaurus_chunk_size', action='store', type=int, required=False,
+                    default=thesaurus_load.DEFAULT_CHUNK_SIZE,
+                    help='number of Thesaurus.txt concepts read and written at a time')
+parser.add_argument('--jobs', action='store', type=int, required=False, default=1,
+                    help='number of independent build stages run at once, each on its own connection (Postgres only)')
+parser.add_argument('--blue_green', action='store_true', required=False,
+                    help='build into a staging schema (Postgres) or a copy of the database file (sqlite) and swap it in '
+                         'atomically at the end, keeping the previous generation for --rollback.  On sqlite every build '
+                         'first copies the whole file, UMLS tables included, and the previous file is kept next to it, '
+                         'so plan for about twice the database size on disk')
+parser.add_argument('--rollback', action='store_true', required=False,
+                    help='swap the generation kept by the last --blue_green build back in and exit')
+parser.add_argument('--metrics_file', action='store', type=str, required=False,
+                    help='write per-stage wall time, rows, peak RSS, database growth and Postgres plans to this JSON file')
+parser.add_argument('--metrics_table', action='store_true', required=False,
+                    help='also append the per-stage metrics to the ' + build_metrics.METRICS_TABLE + ' table')
+parser.add_argument('--reach_index', action='store_true', required=False,
+                    help='also build the interval reachability labels (concept_reach_*) used by reach_index.ReachIndex')
+parser.add_argument('--bulk_load', action='store_true', required=False,
+                    help='build with relaxed durability (sqlite pragmas, UNLOGGED tables on Postgres), create the query '
+                         'indexes together at the end (in parallel with --jobs on Postgres) and ANALYZE their tables')
+parser.add_argument('--resume', action='store_true', required=False,
+                    help='skip the stages a previous failed run of the same NCIt version already completed (see the '
+                         + build_state.STATE_TABLE + ' table); rerun without it after reloading the UMLS tables')
+parser.add_argument('--finalize_layout', action='store_true', required=False,
+                    help='rewrite ncit_tc_all and ncit_tc_with_path_all clustered on (parent, descendant) with covering '
+                         'indexes (WITHOUT ROWID on sqlite, CLUSTER and fillfactor 100 on Postgres) and report sizes '
+                         'and probe latencies before and after')
+parser.add_argument('--closure_artifact', action='store', type=str, required=False,
+                    help='also write the parents and closure as a memory-mappable binary file for query workers '
+                         '(see closure_artifact.open_artifact)')
+parser.add_argument('--parquet_dir', action='store', type=str, required=False,
+                    help='also export ncit, parents, ncit_tc_all and ncit_tc_with_path_all to this directory as Parquet '
+                         'files partitioned by ontology prefix, with a manifest of the NCIt version (needs pyarrow); '
+                         'the directory is a symlink flipped to each new versioned export')
 #sys.exit()
 
 args = parser.parse_args()
+if args.incremental and args.path_encoding == 'compact':
+    parser.error('--incremental patches ncit_tc_with_path_all in place and needs --path_encoding text')
+if args.skip_paths and (args.incremental or args.path_encoding == 'compact'):
+    parser.error('--skip_paths builds no path tables to patch or encode')
+is_postgres = args.dbfilename is None
+if args.parquet_dir is not None:
+    # pyarrow is only needed for the export
+    import parquet_export
+    try:
+        parquet_export.check_publishable(os.path.abspath(args.parquet_dir))
+    except ValueError as e:
+        parser.error(str(e))
+if args.blue_green and args.incremental:
+    parser.error('--blue_green builds a fresh generation and cannot patch the live tables with --incremental')
+if (args.blue_green or args.rollback) and is_postgres and args.schema is None:
+    parser.error('--blue_green and --rollback need --schema on Postgres')
+# sqlite serialises writers on the database file, so parallel stages would only wait on each other's locks
+jobs = args.jobs if is_postgres else 1
 
 if args.dbfilename is None:
     connection_string = f'postgresql://{args.user}:{args.password}@{args.host}:{args.port}/{args.dbname}'
 else:
     connection_string = args.dbfilename
 
+live_schema = args.schema
+version_table = 'ncit_version_composite'
+
+
+def activate_version(cur):
+    cur.execute('update ' + version_table + ' set active_version = NULL')
+    if args.schema is None:
+        cur.execute("insert into " + version_table + """(version_id, downloaded_url,composite_ontology_generation_date, active_version )
+               values(?,?,?,?)
+            """, [current_evs_version, 'hardcoded', datetime.datetime.now(), 'Y'])
+    else:
+        cur.execute("insert into " + version_table + """(version_id, downloaded_url,composite_ontology_generation_date, active_version )
+               values(%s,%s,%s,%s)
+            """, [current_evs_version, 'hardcoded', datetime.datetime.now(), 'Y'])
+
+
+def reactivate_previous_version(cur):
+    cur.execute("select version_id from " + version_table + " where coalesce(active_version, 'N') <> 'Y' "
+                "order by composite_ontology_generation_date desc limit 1")
+    row = cur.fetchone()
+    if row is not None:
+        cur.execute('update ' + version_table + ' set active_version = NULL')
+        cur.execute('update ' + version_table + " set active_version = 'Y' where version_id = %s", (row[0],))
+
+
+if args.rollback:
+    if is_postgres:
+        version_table = live_schema + '.ncit_version_composite'
+        rollback_connection = psycopg2.connect(database=args.dbname, user=args.user, host=args.host, port=args.port,
+                                               password=args.password, options="-c search_path={}".format(live_schema))
+        generation_swap.rollback_schema(rollback_connection, live_schema, before_commit=reactivate_previous_version)
+        rollback_connection.close()
+    else:
+        generation_swap.rollback_file(args.dbfilename)
+    sys.exit(0)
+
+if args.blue_green:
+    # Everything below writes into the staging generation; the live tables stay untouched until the swap
+    if is_postgres:
+        version_table = live_schema + '.ncit_version_composite'
+        setup_connection = psycopg2.connect(database=args.dbname, user=args.user, host=args.host, port=args.port,
+                                            password=args.password, options="-c search_path={}".format(live_schema))
+        args.schema = generation_swap.prepare_staging_schema(setup_connection, live_schema, keep=args.resume)
+        setup_connection.close()
+    else:
+        live_connection = sqlite3.connect(args.dbfilename)
+        connection_string = generation_swap.prepare_staging_file(live_connection, args.dbfilename, keep=args.resume)
+        live_connection.close()
+
+
+def discard_staging():
+    if args.blue_green and is_postgres:
+        cur.execute('drop schema if exists ' + generation_swap.staging_schema(live_schema) + ' cascade')
+        con.commit()
+    elif args.blue_green:
+        con.close()
+        os.remove(connection_string)
+
 
 if args.dbfilename is None:
     print('unified ontology build -- using Postgresql')
@@ -68,6 +211,157 @@ else:
 
 
 cur = db_connection.cursor()
+if args.bulk_load:
+    bulk_load.enter_bulk_mode(con, is_postgres)
+create_table = bulk_load.create_table_sql(is_postgres, args.bulk_load)
+# without an output for the metrics, stages only print their progress line (no extra EXPLAIN or size queries)
+metrics = build_metrics.BuildMetrics(con, is_postgres, script='build_unified_tc',
+                                     enabled=args.metrics_file is not None or args.metrics_table)
+state = build_state.BuildState(con, is_postgres, resume=args.resume)
+
+
+def connect():
+    """A new connection to the build database, for stages that run next to each other."""
+    if is_postgres:
+        stage_con = psycopg2.connect(database=args.dbname, user=args.user, host=args.host, port=args.port,
+                                     password=args.password, options="-c search_path={}".format(args.schema))
+    else:
+        stage_con = sqlite3.connect(connection_string)
+    if args.bulk_load:
+        bulk_load.enter_bulk_mode(stage_con, is_postgres)
+    return stage_con
+
+
+# Indexes that only serve queries against the finished tables; --bulk_load builds them all together at the end
+deferred_indexes = []
+
+
+def build_index(con, name, table, columns):
+    cur = con.cursor()
+    cur.execute("drop index if exists " + name)
+    cur.execute("create index " + name + " on " + table + "(" + columns + ")")
+    con.commit()
+
+
+def create_index(name, table, columns):
+    """Create an index now, or with --bulk_load queue it for create_deferred_indexes()."""
+    if args.bulk_load:
+        deferred_indexes.append((name, table, columns))
+    else:
+        build_index(con, name, table, columns)
+
+
+def create_deferred_indexes():
+    """Build the queued indexes, several at once on Postgres with --jobs, then ANALYZE their tables."""
+    if not deferred_indexes:
+        return
+    index_stages = [stage_runner.Stage(name, functools.partial(build_index, name=name, table=table, columns=columns))
+                    for name, table, columns in deferred_indexes]
+    tables = sorted({table for name, table, columns in deferred_indexes})
+    del deferred_indexes[:]
+    metrics.end()
+    stage_runner.run_stages(index_stages, connect, jobs=jobs, shared=con, metrics=metrics)
+    metrics.begin("analyzing " + ", ".join(tables))
+    bulk_load.analyze(con, tables)
+    metrics.end()
+
+
+def build_sql_path_table(con, suffix, prefix):
+    """Compute ncit_tc_with_path_<suffix> with recursive SQL over the parent edges inside one ontology."""
+    print(datetime.datetime.now(), "computing transitive closure for", suffix)
+    cur = con.cursor()
+    cur.execute("drop table if exists ncit_tc_with_path_" + suffix)
+    sql = (
+        """{2} ncit_tc_with_path_{0} as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
+                (select p1.parent, p1.concept as descendant, p1.level, p1.path from parents p1 where p1.parent like  '{1}%' and p1.concept like '{1}%'  union all 
+                select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
+                from ncit_tc_rows n join parents p on n.parent = p.concept  where p.parent like  '{1}%' and p.concept like '{1}%' 
+                ) select * from ncit_tc_rows
+                """.format(suffix, prefix, create_table))
+    metrics.explain(sql)
+    cur.execute(sql)
+    con.commit()
+    state.mark_done('closure_' + suffix, closure_fp, outputs=['ncit_tc_with_path_' + suffix], rows=cur.rowcount,
+                    con=con)
+    return cur.rowcount
+
+
+def build_sql_comp_table(con):
+    print(datetime.datetime.now(), "computing transitive closure for composite ontology")
+    cur = con.cursor()
+    # Create a table to bootstrap the parents - it includes the NCIT-><not NCIT> links,
+    # the first level links into the non ncit ontologies and the first level links 'up' in the NCIT
+
+    cur.execute("drop table if exists comp_parents")
+    cur.execute(create_table + """ comp_parents as 
+    select dp.parent, dp.concept , dp.level, dp.path 
+    from parents dp join parents p1 on p1.concept = dp.parent 
+    where  p1.parent like  'C%' and p1.concept not like 'C%' 
+    union 
+    select dp.parent, dp.concept, dp.level, dp.path 
+    from parents dp join parents p1 on p1.parent = dp.concept 
+    where  p1.parent like  'C%' and p1.concept  not like 'C%' 
+    union 
+    select p1.parent, p1.concept , p1.level, path from parents p1 where p1.parent like  'C%' and p1.concept not like 'C%' 
+    """)
+    con.commit()
+
+    cur.execute("drop table if exists ncit_tc_with_path_comp")
+    sql = create_table + """ ncit_tc_with_path_comp as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
+               ( select parent, concept as descendant, level, path from comp_parents   union all 
+                select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
+                from ncit_tc_rows n join parents p on n.parent = p.concept 
+                ) select * from ncit_tc_rows
+                """
+    metrics.explain(sql)
+    cur.execute(sql)
+    con.commit()
+    state.mark_done('closure_comp', closure_fp, outputs=['ncit_tc_with_path_comp'], rows=cur.rowcount, con=con)
+    return cur.rowcount
+
+
+def build_sql_closure_table(con):
+    """
+    Compute ncit_tc_all directly as distinct (parent, descendant) pairs, without enumerating any paths.  The
+    per-ontology closures and the composite closure are the recursive queries of the path tables with UNION in
+    place of UNION ALL, so every step only extends pairs that were not derived before.  Every parents edge lies
+    inside one ontology or links an NCIt parent into another one, so the reflexive rows come from the codes of
+    the parents table.
+    """
+    print(datetime.datetime.now(), "computing transitive closure pairs")
+    cur = con.cursor()
+    cur.execute('drop table if exists ncit_tc_all')
+    closures = [
+        """tc_pairs_{0}(parent, descendant) as (
+        select parent, concept from parents where parent like '{1}%' and concept like '{1}%'
+        union
+        select p.parent, t.descendant from tc_pairs_{0} t join parents p on p.concept = t.parent
+        where p.parent like '{1}%'
+        )""".format(suffix, prefix) for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES]
+    closures.append("""tc_pairs_comp(parent, descendant) as (
+        select dp.parent, dp.concept from parents dp join parents p1 on p1.concept = dp.parent
+        where p1.parent like 'C%' and p1.concept not like 'C%'
+        union
+        select dp.parent, dp.concept from parents dp join parents p1 on p1.parent = dp.concept
+        where p1.parent like 'C%' and p1.concept not like 'C%'
+        union
+        select p1.parent, p1.concept from parents p1 where p1.parent like 'C%' and p1.concept not like 'C%'
+        union
+        select p.parent, t.descendant from tc_pairs_comp t join parents p on p.concept = t.parent
+        )""")
+    suffixes = [suffix for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES] + ['comp']
+    sql = (create_table + " ncit_tc_all as with recursive " + ",\n    ".join(closures) + "\n    " +
+           "\n    union ".join("select parent, descendant from tc_pairs_" + suffix for suffix in suffixes))
+    metrics.explain(sql)
+    cur.execute(sql)
+    rows = cur.rowcount
+    con.commit()
+    print(datetime.datetime.now(), "adding reflexive rows")
+    cur.execute("""insert into ncit_tc_all (parent, descendant)
+    select c.code, c.code from (select concept as code from parents union select parent from parents) c""")
+    con.commit()
+    return rows
+
 
 new_ehr_subsources = set()
 
@@ -81,75 +375,24 @@ def get_ncit_ehr_syns_for_code(code=None):
     concept_rs = cur.fetchall()
     concept_list = [r[0] for r in concept_rs]
 
-    num_concepts_per_evs_call = 575
-   # concept_list = ncit_df['code'].tolist()
-
-    concept_url_fstring = "https://api-evsrest.nci.nih.gov/api/v1/concept/ncit?list=%s&include=summary"
     new_column_vals = []
 
-    chunk_count = 0
-    record_count = 0
-    retry_limit = 3
-
     print("Calling EVS to get crosswalk terms")
-    for ch in chunks(concept_list, num_concepts_per_evs_call):
-        c_codes = list(ch)
-        record_count += len(c_codes)
-        c_codes_string = ','.join(c_codes)
-        #print(c_codes_string)
-        concept_url_string = concept_url_fstring % (c_codes_string)
-        retry_count = 0
-
-        while retry_count < retry_limit:
-            try:
-                r = requests.get(concept_url_string, timeout=(1.0, 15.0))
-            except requests.exceptions.RequestException as e:
-                print("exception -- ", e)
-                print("sleeping")
-                retry_count += 1
-                if retry_count == retry_limit:
-                    print("retry max limit hit -- bailing out ")
-                    sys.exit()
-                time.sleep(15)
-            else:
-                try:
-                    concept_set = r.json()
-                except Exception:
-                    print("ERROR in ", concept_url_string)
-                    traceback.print_exc()
-                    sys.exit()
-                for newc in concept_set:
-                    #new_column_vals.append((newc['code'], newc['name']))
-                    if 'synonyms' in newc:
-                        for syn in newc['synonyms']:
-                            if 'source' in syn and syn['source'] == 'mCode':
-                              #  print("found mcode :",newc)
-                                if 'subSource' in syn:
-                                    if syn['subSource'] == 'ICD-10 CM':
-                                      #  print('adding ' + newc['code'] + ' => ', 'ICD10CM:'+syn['code'])
-                                        new_column_vals.append(('ICD10CM:'+syn['code'],
-                                                               newc['code'],
-                                                               newc['code']+'|'+'ICD10CM:'+syn['code'],
-                                                               1))
-                                    elif syn['subSource'] == 'LOINC':
-                                      #  print('adding ' + newc['code'] + ' => ', 'LOINC:' + syn['code'])
-                                        new_column_vals.append(('LOINC:' + syn['code'],
-                                                               newc['code'],
-                                                               newc['code'] + '|' + 'LOINC:' + syn['code'],
-                                                               1))
-                                    elif syn['subSource'] == 'SNOMED CT':
-                                      #  print('adding ' + newc['code'] + ' => ', 'SNOMEDCT:' + syn['code'])
-                                        new_column_vals.append(('SNOMEDCT:' + syn['code'],
-                                                               newc['code'],
-                                                               newc['code'] + '|' + 'SNOMEDCT:' + syn['code'],
-                                                               1))
-                                    else:
-                                        new_ehr_subsources.add(syn['subSource'])
-                                        #print(newc)
-                                        #sys.exit()
-                chunk_count = chunk_count + 1
-                print(datetime.datetime.now(), "processing chunk ", chunk_count, " record count = ", record_count)
-                break
+    evs = evs_client.EvsClient(base_url=args.evs_url, concurrency=args.evs_concurrency, rate=args.evs_rate)
+    cache = None
+    try:
+        if args.evs_cache is not None:
+            cache = evs_cache.EvsCache(args.evs_cache, current_evs_version, keep_versions=args.evs_cache_versions)
+            concept_sets = cache.iter_concept_chunks(evs, concept_list)
+        else:
+            concept_sets = evs.iter_concept_chunks(concept_list)
+        for concept_set in concept_sets:
+            new_column_vals.extend(evs_client.mcode_crosswalk_rows(concept_set, unknown_subsources=new_ehr_subsources))
+    finally:
+        evs.close()
+        if cache is not None:
+            print("EVS cache hits:", cache.hits, "misses:", cache.misses)
+            cache.close()
 
     #
     print("returning dataframes")
@@ -159,20 +402,25 @@ def get_ncit_ehr_syns_for_code(code=None):
 
 
 #load the curated crosswalk table into the DB
-crosswalk_df = pd.read_csv('local_crosswalk.csv', delimiter=',', header=0
-                          )
-
-crosswalk_df.to_sql('curated_crosswalk', con=sa_connection, if_exists='replace')
-sa_connection.commit()
-cur.execute('create index cc_code_system_idx on curated_crosswalk(code_system)'
-)
-
-sa_connection.commit()
-con.commit()
+crosswalk_fp = build_state.fingerprint(build_state.file_fingerprint(args.crosswalk_csv))
+if not state.done('crosswalk', crosswalk_fp):
+    metrics.begin("loading curated crosswalk")
+    crosswalk_df = pd.read_csv(args.crosswalk_csv, delimiter=',', header=0
+                              )
+
+    crosswalk_df.to_sql('curated_crosswalk', con=sa_connection, if_exists='replace')
+    sa_connection.commit()
+    cur.execute('create index cc_code_system_idx on curated_crosswalk(code_system)'
+    )
+
+    sa_connection.commit()
+    con.commit()
+    metrics.end(rows=len(crosswalk_df))
+    state.mark_done('crosswalk', crosswalk_fp, outputs=['curated_crosswalk'], rows=len(crosswalk_df))
 
 if args.dbfilename is  None:
     cur.execute("""
-    create table if not exists ncit_version_composite(
+    create table if not exists """ + version_table + """(
       version_id varchar(32),
       downloaded_url text,
       active_version varchar(1),
@@ -180,7 +428,7 @@ if args.dbfilename is  None:
     """)
 else:
     cur.execute("""
-       create table if not exists ncit_version_composite(
+       create table if not exists """ + version_table + """(
          version_id varchar(32),
          downloaded_url text,
          active_version varchar(1),
@@ -189,7 +437,7 @@ else:
 con.commit()
 
 url_fstring = "https://evs.nci.nih.gov/ftp1/NCI_Thesaurus/archive/%s_Release/Thesaurus_%s.FLAT.zip"
-r = requests.get('https://api-evsrest.nci.nih.gov/api/v1/concept/ncit',
+r = requests.get(args.evs_url.rstrip('/') + '/concept/ncit',
                  params={'include': 'minimal', 'list': 'C2991'}, timeout=(.4, 7.0))
 evs_results = r.json()
 print(evs_results)
@@ -205,7 +453,7 @@ print("Current EVS NCIT version :", current_evs_version)
 # want to stay in sync with EVS
 #
 
-check_version_sql = " select version_id from ncit_version_composite where active_version = 'Y'"
+check_version_sql = " select version_id from " + version_table + " where active_version = 'Y'"
 cur = con.cursor()
 cur.execute(check_version_sql)
 rs = cur.fetchone()
@@ -214,6 +462,7 @@ rs = cur.fetchone()
 if rs is not None and rs[0] == current_evs_version:
     print("POC NCIt is same as EVS NCIt, exiting")
     con.commit()
+    discard_staging()
     con.close()
     sys.exit(0)
 elif rs is None:
@@ -225,366 +474,299 @@ print("Preparing to process NCIT version", current_evs_version)
 
 url_string = url_fstring % (current_evs_version, current_evs_version)
 
-tfilename = Path(url_string).name
-tfile = tempfile.NamedTemporaryFile(suffix=tfilename)
-# sys.exit()
-thesaurus_zip = wget.download(url=url_string, out=tfile.name)
-#thesaurus_zip = 'Thesaurus_23.04d.FLAT.zip'
-arch = zipfile.ZipFile(thesaurus_zip, mode='r')
-
-print("Extracting thesaurus file contents")
-thesaurus_file = arch.open('Thesaurus.txt', mode='r')
-
-# Names in the dataframe will become columns in the sqlite database
-
-# In[37]:
-
-
-ncit_df = pd.read_csv(thesaurus_file, delimiter='\t', header=None,
-                          names=('code', 'url', 'parents', 'synonyms',
-                                 'definition', 'display_name', 'concept_status', 'semantic_type', 'pref_name'))
-
-# Add in the preferred name field - the first choice in the list of synonyms.  Note that this column is not in the NCI Thesaurus and can be computed in pandas or in sqlite.
-
-# In[38]:
-
-
-ncit_df['pref_name'] = ncit_df.apply(lambda row: row['synonyms'].split('|')[0], axis=1)
-
-# In[39]:
-
-
-# print(ncit_df)
-
-
-# In[40]:
-
-# Write the dataframe out to the sqlite table
-print("Writing thesaurus file to database")
-ncit_df.to_sql('ncit', con=sa_connection, if_exists='replace')
-sa_connection.commit()
-#con.execute("delete from ncit where concept_status in ('Obsolete_Concept', 'Retired_Concept')")
-
-# In[42]:
-
-print("creating thesaurus file indexes")
-cur.execute("drop index if exists ncit_code_index")
-cur.execute("create index ncit_code_index on ncit(code)")
-cur.execute("drop index if exists lower_pref_name_idx")
-cur.execute("create index lower_pref_name_idx on ncit(lower(pref_name))")
-con.commit()
-
-# In[43]:
-
-
-print("getting all concepts that have parents")
-#cur = con.cursor()
-cur.execute("select code, parents from ncit where (parents is not null and parents <> '')")
-
-
-# Get all of the concepts that have parents into a result set
-
-# In[44]:
-
-
-concept_parents = cur.fetchall()
-
-# In[45]:
-
-
-#print(len(concept_parents))
-
-# In[46]:
-
-
-con.commit()
-
-# Create a table that will hold the concept, the parent, the path from parent to the concept, and the level (need this to properly recurse along the relationship).
+thesaurus_fp = build_state.fingerprint(current_evs_version, args.incremental,
+                                       url_string if args.thesaurus_zip is None
+                                       else build_state.file_fingerprint(args.thesaurus_zip))
+thesaurus_loaded = not state.done('thesaurus', thesaurus_fp)
+if thesaurus_loaded:
+    tfilename = Path(url_string).name
+    tfile = tempfile.NamedTemporaryFile(suffix=tfilename)
+    # sys.exit()
+    if args.thesaurus_zip is not None:
+        thesaurus_zip = args.thesaurus_zip
+    else:
+        thesaurus_zip = wget.download(url=url_string, out=tfile.name)
+    #thesaurus_zip = 'Thesaurus_23.04d.FLAT.zip'
+    arch = zipfile.ZipFile(thesaurus_zip, mode='r')
 
-# In[47]:
+    print("Extracting thesaurus file contents")
+    thesaurus_file = arch.open('Thesaurus.txt', mode='r')
 
+    # Create a table that will hold the concept, the parent, the path from parent to the concept, and the level (need this to properly recurse along the relationship).
 
-cur.execute('drop table if exists parents')
-cur.execute("""
-create table parents (
-concept text,
-parent text,
-path text,
-level int)
-""")
+    # In[47]:
 
-# Put the direct concept &rarr; parent relationships in the table as level 1 items.
 
-# In[48]:
+    if (args.incremental and bulk_load.table_exists(cur, 'parents', is_postgres)
+            and not bulk_load.table_exists(cur, 'parents_prev', is_postgres)):
+        # Keep the edges of the last build around so the closure tables can be patched instead of rebuilt.  A
+        # parents_prev left by a failed incremental run already holds them.
+        cur.execute('alter table parents rename to parents_prev')
+    else:
+        cur.execute('drop table if exists parents')
+    cur.execute(create_table + """ parents (
+    concept text,
+    parent text,
+    path text,
+    level int)
+    """)
+    con.commit()
 
-print("inserting NCIt parents")
-for concept, parents in concept_parents:
-    parentl = parents.split('|')
-    for p in parentl:
-        if args.schema is None:
-            cur.execute("insert into parents(concept, parent, level, path )values(?,?,1,?)",
-                        (concept, p, p + '|' + concept))
-        else:
-            cur.execute("insert into parents(concept, parent, level, path )values(%s,%s,1,%s)",
-                        (concept, p, p + '|' + concept))
-con.commit()
+    # Stream the thesaurus into the ncit table and put the direct concept &rarr; parent relationships in the parents
+    # table as level 1 items in the same pass.  The preferred name is the first choice in the list of synonyms.
 
+    # In[37]:
 
-# Now put in ICD10CM parents.
+    metrics.begin("Writing thesaurus file and NCIt parents to database")
+    metrics.add_rows(sum(thesaurus_load.load_thesaurus(con, is_postgres, thesaurus_file, chunksize=args.thesaurus_chunk_size,
+                                                       create_table=create_table)))
+    #con.execute("delete from ncit where concept_status in ('Obsolete_Concept', 'Retired_Concept')")
 
-print("inserting ICD10-crosswalk parents")
-cur.execute("""
-insert into parents(concept, parent, level, path )
-select  'ICD10CM:' ||  disease_code as concept, evs_nci_code as parent , 1 as level, evs_nci_code || '|' || 'ICD10CM:' || disease_code as path
-from curated_crosswalk where code_system = 'ICD10'
-""")
-con.commit()
+    # In[42]:
 
-print("Inserting ICD10CM parents ")
-cur.execute("""
-insert into parents(concept, parent, level, path )
-select distinct  'ICD10CM:' || d.code as concept,  'ICD10CM:'|| p.code as parent, 1 as level ,  'ICD10CM:'||p.code ||  '|' ||   'ICD10CM:'||d.code as path
-from MRHIER  h 
-join mrconso p on p.aui = h.paui 
-join mrconso d on d.aui = h.aui
-and h.sab = 'ICD10CM'
-""")
-con.commit()
-
-print("inserting loinc parents")
-cur.execute("""
-insert into parents(concept, parent, level, path )
-select  distinct  'LOINC:' || d.code as concept,  'LOINC:'|| p.code as parent, 1 as level ,  'LOINC:'||p.code ||  '|' ||   'LOINC:'||d.code as path
-from MRHIER  h 
-join mrconso p on p.aui = h.paui 
-join mrconso d on d.aui = h.aui
-and h.sab = 'LNC'
-""")
-con.commit()
-print("inserting snomedct parents")
-cur.execute("""
-insert into parents(concept, parent, level, path )
-select  distinct  'SNOMEDCT:' || d.code as concept,  'SNOMEDCT:'|| p.code as parent, 1 as level ,  'SNOMEDCT:'||p.code ||  '|' ||   'SNOMEDCT:'||d.code as path
-from MRHIER  h 
-join mrconso p on p.aui = h.paui 
-join mrconso d on d.aui = h.aui
-and h.sab = 'SNOMEDCT_US'
-""")
-con.commit()
+    metrics.begin("creating thesaurus file indexes")
+    create_index("ncit_code_index", "ncit", "code")
+    create_index("lower_pref_name_idx", "ncit", "lower(pref_name)")
+    metrics.end()
+    state.mark_done('thesaurus', thesaurus_fp, outputs=['ncit', 'parents'])
 
 # In[49]:
 
-# Now get mCode links
-
-xwalk_df = get_ncit_ehr_syns_for_code() # Loop through all of the NCIt to make sure all of the mCode mappings are captured.
-
-# xwalk_df = get_ncit_ehr_syns_for_code('C192880') # mcode diseases
-# #xwalk_df.to_sql(name='parents', con=sa_connection, if_exists='append', index=False)
-# con.commit()
-# new_xwalk_df = get_ncit_ehr_syns_for_code('C192883') #mcode procedures
-# xwalk_df = pd.merge(xwalk_df, new_xwalk_df,  how='left')
-# con.commit()
-# new_xwalk_df = get_ncit_ehr_syns_for_code('C192884') #mcode fish procedure
-# xwalk_df = pd.merge(xwalk_df, new_xwalk_df,  how='left')
-# con.commit()
-
-xwalk_df.to_sql(name='parents', con=sa_connection, if_exists='append', index=False)
-sa_connection.commit()
-con.commit()
-#print(con.execute("select * from parents where parent= 'C3824'").fetchall())
-
-# In[50]:
-
-print(new_ehr_subsources)
-
-cur.execute("drop index if exists par_concept_idx")
-cur.execute("create index par_concept_idx on parents(concept)")
-cur.execute("drop index if exists par_par_idx")
-cur.execute("create index par_par_idx on parents(parent)")
-
-# This is the key part - execute the recursive SQL to generate the set of all paths through the NCIt.  We'll prune this to just concepts and descendants a few steps below.
-
-# In[63]:
-
-print(datetime.datetime.now(), "computing transitive closure for NCIt")
-cur.execute("drop table if exists ncit_tc_with_path_ncit")
-cur.execute(
-    """create table ncit_tc_with_path_ncit as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
-            (select p1.parent, p1.concept as descendant, p1.level, p1.path from parents p1 where p1.parent like  'C%' and p1.concept like 'C%'  union all 
-            select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
-            from ncit_tc_rows n join parents p on n.parent = p.concept  where p.parent like  'C%' and p.concept like 'C%' 
-            ) select * from ncit_tc_rows
-            """)
-con.commit()
-
-print(datetime.datetime.now(),"computing transitive closure for ICD10CM")
-cur.execute("drop table if exists ncit_tc_with_path_icd10cm")
-cur.execute(
-    """create table ncit_tc_with_path_icd10cm as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
-            (select p1.parent, p1.concept as descendant, p1.level, path from parents p1 where p1.parent like  'ICD10CM%' and p1.concept like 'ICD10CM%'  union all 
-            select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
-            from ncit_tc_rows n join parents p on n.parent = p.concept  where p.parent like  'ICD10CM%' and p.concept like 'ICD10CM%'  
-            ) select * from ncit_tc_rows
-            """)
-con.commit()
-
-print(datetime.datetime.now(), "computing transitive closure for SNOMEDCT")
-cur.execute("drop table if exists ncit_tc_with_path_snomedct")
-cur.execute("""
-    create table ncit_tc_with_path_snomedct as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
-            (select p1.parent, p1.concept as descendant, p1.level, path from parents p1 where p1.parent like  'SNOMEDCT%' and p1.concept like 'SNOMEDCT%'  union all 
-            select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
-            from ncit_tc_rows n join parents p on n.parent = p.concept  where p.parent like  'SNOMEDCT%' and p.concept like 'SNOMEDCT%'  
-            ) select * from ncit_tc_rows
-            """)
-con.commit()
-
-print(datetime.datetime.now(), "computing transitive closure for LOINC")
-cur.execute("drop table if exists ncit_tc_with_path_loinc")
-cur.execute("""
-    create table ncit_tc_with_path_loinc as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
-            (select p1.parent, p1.concept as descendant, p1.level, path from parents p1 where p1.parent like  'LOINC%' and p1.concept like 'LOINC%'  union all 
-            select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
-            from ncit_tc_rows n join parents p on n.parent = p.concept  where p.parent like  'LOINC%' and p.concept like 'LOINC%'  
-            ) select * from ncit_tc_rows
-            """)
-
-print(datetime.datetime.now(), "computing transitive closure for composite ontology")
-# Create a table to bootstrap the parents - it includes the NCIT-><not NCIT> links,
-# the first level links into the non ncit ontologies and the first level links 'up' in the NCIT
-
-cur.execute("drop table if exists comp_parents")
-cur.execute("""
-create table comp_parents as 
-select dp.parent, dp.concept , dp.level, dp.path 
-from parents dp join parents p1 on p1.concept = dp.parent 
-where  p1.parent like  'C%' and p1.concept not like 'C%' 
-union 
-select dp.parent, dp.concept, dp.level, dp.path 
-from parents dp join parents p1 on p1.parent = dp.concept 
-where  p1.parent like  'C%' and p1.concept  not like 'C%' 
-union 
-select p1.parent, p1.concept , p1.level, path from parents p1 where p1.parent like  'C%' and p1.concept not like 'C%' 
-""")
-con.commit()
-
+# Now get mCode links.  They are kept in their own table so a resumed build does not have to crawl EVS again.
+
+mcode_fp = build_state.fingerprint(current_evs_version)
+if not state.done('mcode', mcode_fp, deps=['thesaurus']):
+    metrics.begin("fetching mCode crosswalk from EVS")
+    xwalk_df = get_ncit_ehr_syns_for_code() # Loop through all of the NCIt to make sure all of the mCode mappings are captured.
+
+    # xwalk_df = get_ncit_ehr_syns_for_code('C192880') # mcode diseases
+    # #xwalk_df.to_sql(name='parents', con=sa_connection, if_exists='append', index=False)
+    # con.commit()
+    # new_xwalk_df = get_ncit_ehr_syns_for_code('C192883') #mcode procedures
+    # xwalk_df = pd.merge(xwalk_df, new_xwalk_df,  how='left')
+    # con.commit()
+    # new_xwalk_df = get_ncit_ehr_syns_for_code('C192884') #mcode fish procedure
+    # xwalk_df = pd.merge(xwalk_df, new_xwalk_df,  how='left')
+    # con.commit()
+
+    xwalk_df.to_sql(name='mcode_parents', con=sa_connection, if_exists='replace', index=False)
+    sa_connection.commit()
+    con.commit()
+    metrics.end(rows=len(xwalk_df))
+    state.mark_done('mcode', mcode_fp, outputs=['mcode_parents'], rows=len(xwalk_df))
+    #print(con.execute("select * from parents where parent= 'C3824'").fetchall())
 
+    # In[50]:
 
-cur.execute("drop table if exists ncit_tc_with_path_comp")
-cur.execute(
-    """create table ncit_tc_with_path_comp as with recursive ncit_tc_rows(parent, descendant, level, path ) as 
-           ( select parent, concept as descendant, level, path from comp_parents   union all 
-            select p.parent , n.descendant as descendant, n.level+1 as level ,  p.parent || '|' || n.path  as path 
-            from ncit_tc_rows n join parents p on n.parent = p.concept 
-            ) select * from ncit_tc_rows
-            """)
+    print(new_ehr_subsources)
 
-con.commit()
+parents_fp = build_state.fingerprint(current_evs_version, tc_engine.UMLS_HIERARCHIES)
+if not state.done('parents', parents_fp, deps=['crosswalk', 'thesaurus', 'mcode']):
+    if not thesaurus_loaded:
+        # Resuming with the NCIt edges already loaded; take out whatever a failed run appended after them
+        metrics.begin("removing non-NCIt parents of the failed run")
+        cur.execute("drop index if exists par_concept_idx")
+        cur.execute("drop index if exists par_par_idx")
+        cur.execute("delete from parents where concept not like 'C%' or parent not like 'C%'")
+        con.commit()
 
-print(datetime.datetime.now(), "creating union of tables")
-cur.execute("drop table if exists ncit_tc_with_path_all")
-con.commit()
+    # Now put in ICD10CM parents.
 
-print(datetime.datetime.now(), "adding in NCIt paths")
-cur.execute(
-    """create table ncit_tc_with_path_all as 
-          select parent, descendant, level, path from ncit_tc_with_path_ncit
+    metrics.begin("inserting ICD10-crosswalk parents")
+    cur.execute("""
+    insert into parents(concept, parent, level, path )
+    select  'ICD10CM:' ||  disease_code as concept, evs_nci_code as parent , 1 as level, evs_nci_code || '|' || 'ICD10CM:' || disease_code as path
+    from curated_crosswalk where code_system = 'ICD10'
     """)
+    metrics.add_rows(cur.rowcount)
+    con.commit()
 
-con.commit()
-
-print(datetime.datetime.now(), "adding in icd10cm paths")
-cur.execute("""
-insert into ncit_tc_with_path_all(	parent, descendant, level, path) 
-select parent, descendant, level, path from ncit_tc_with_path_icd10cm""")
-con.commit()
-
-print(datetime.datetime.now(), "adding in loinc paths")
-
-cur.execute("""
-insert into ncit_tc_with_path_all(	parent, descendant, level, path) 
-select parent, descendant, level, path from ncit_tc_with_path_loinc
-""")
-con.commit()
-
-print(datetime.datetime.now(), "adding in snomedct paths")
-
-cur.execute("""
-insert into ncit_tc_with_path_all(	parent, descendant, level, path) 
-select parent, descendant, level, path from ncit_tc_with_path_snomedct
-""")
-con.commit()
-
-cur.execute("""
-insert into ncit_tc_with_path_all(	parent, descendant, level, path) 
-select parent, descendant, level, path from ncit_tc_with_path_comp
-""")
-con.commit()
-
-print(datetime.datetime.now(), "creating indexes")
-
-cur.execute('create index ncit_tc_path_parent on ncit_tc_with_path_all(parent)')
-cur.execute('CREATE INDEX ncit_tc_path_descendant on ncit_tc_with_path_all(descendant)')
-con.commit()
-
-# Create the transitive closure table.  This fits the mathematical definition of transitive closure.
-
-# In[52]:
-
-print(datetime.datetime.now(), "creating tc_all tables")
+    # One pass over MRHIER for every configured UMLS hierarchy: the sab -> prefix mapping is joined in, so adding
+    # a source is an entry in tc_engine.UMLS_HIERARCHIES rather than another scan of MRHIER.
+    metrics.begin("inserting UMLS hierarchy parents")
+    hierarchy_values = ','.join(['(%s, %s)' if is_postgres else '(?, ?)'] * len(tc_engine.UMLS_HIERARCHIES))
+    sql = """
+    insert into parents(concept, parent, level, path )
+    with hierarchy_sab(sab, prefix) as (values """ + hierarchy_values + """)
+    select distinct s.prefix || ':' || d.code as concept, s.prefix || ':' || p.code as parent, 1 as level,
+           s.prefix || ':' || p.code || '|' || s.prefix || ':' || d.code as path
+    from MRHIER  h
+    join hierarchy_sab s on s.sab = h.sab
+    join mrconso p on p.aui = h.paui
+    join mrconso d on d.aui = h.aui
+    """
+    hierarchy_params = [v for sab_prefix in tc_engine.UMLS_HIERARCHIES for v in sab_prefix]
+    metrics.explain(sql, hierarchy_params)
+    cur.execute(sql, hierarchy_params)
+    metrics.add_rows(cur.rowcount)
+    con.commit()
 
-cur.execute('drop table if exists ncit_tc_all')
-con.commit()
-cur.execute("create table ncit_tc_all as select distinct parent, descendant from ncit_tc_with_path_all ")
-con.commit()
-cur.execute('create index ncit_tc_parent_all on ncit_tc_all (parent) ')
-con.commit()
-# In[53]:
+    metrics.begin("inserting mCode parents")
+    cur.execute("""
+    insert into parents(concept, parent, level, path )
+    select concept, parent, level, path from mcode_parents
+    """)
+    metrics.add_rows(cur.rowcount)
+    con.commit()
 
-rs = cur.execute('select count(*) from ncit_tc_all')
-total_num_rows_in_tc = cur.fetchone()[0]
-print("There are ", total_num_rows_in_tc, "rows in the transitive closure table")
+    metrics.begin("creating parents indexes")
+    cur.execute("drop index if exists par_concept_idx")
+    cur.execute("create index par_concept_idx on parents(concept)")
+    cur.execute("drop index if exists par_par_idx")
+    cur.execute("create index par_par_idx on parents(parent)")
+    con.commit()
+    if args.bulk_load:
+        # the closure queries are planned against these statistics
+        metrics.begin("analyzing parents")
+        bulk_load.analyze(con, ['parents'])
+    metrics.end()
+    state.mark_done('parents', parents_fp, outputs=['parents'])
 
+# This is the key part - execute the recursive SQL to generate the set of all paths through the NCIt.  We'll prune this to just concepts and descendants a few steps below.
 
-print(datetime.datetime.now(), "adding in reflexive parent rows")
+# In[63]:
 
-cur.execute(
-    '''with codes as 
-    (
-    select distinct parent as code from ncit_tc_all
-    union
-    select distinct descendant as code from ncit_tc_all
-    ) 
-    insert into ncit_tc_all (parent, descendant) 
-    select c.code as parent, c.code as descendant from codes c
-    ''')
+incremental = (args.incremental and bulk_load.table_exists(cur, 'parents_prev', is_postgres)
+               and bulk_load.table_exists(cur, 'ncit_tc_all', is_postgres)
+               and bulk_load.table_exists(cur, 'ncit_tc_with_path_all', is_postgres)
+               and not bulk_load.view_exists(cur, 'ncit_tc_with_path_all', is_postgres))
+# compaction drops the per-ontology path tables, so a text build cannot resume from a compact one's closures
+closure_fp = build_state.fingerprint(args.tc_engine, args.skip_paths, args.incremental, args.path_encoding)
+if incremental and not state.done('closure', closure_fp, deps=['parents']):
+    metrics.begin("updating closure tables incrementally from the previous parents")
+    incremental = tc_engine.update_closure_tables(con, postgres=is_postgres)
+    metrics.end()
+    if incremental:
+        state.mark_done('closure', closure_fp, outputs=['ncit_tc_all', 'ncit_tc_with_path_all'])
+
+if args.skip_paths or args.tc_engine == 'python' or incremental:
+    closure_checkpoints = ['closure']
+else:
+    closure_checkpoints = ['closure_' + suffix for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES] + ['closure_comp']
+
+if incremental:
+    print(datetime.datetime.now(), "closure tables updated in place")
+elif args.skip_paths or args.tc_engine == 'python':
+    if not state.done('closure', closure_fp, deps=['parents']):
+        if args.skip_paths:
+            metrics.begin("computing transitive closure without paths")
+            path_codec.drop_compact_tables(cur, is_postgres)
+            for path_table in tc_engine.PATH_TABLES + ['ncit_tc_with_path_all']:
+                cur.execute('drop table if exists ' + path_table)
+            if args.tc_engine == 'sql':
+                metrics.add_rows(build_sql_closure_table(con))
+            else:
+                tc_engine.build_closure_tables(con, postgres=is_postgres, paths=False, create_table=create_table)
+            closure_outputs = ['ncit_tc_all']
+        else:
+            metrics.begin("computing transitive closure with the closure engine")
+            tc_engine.build_closure_tables(con, postgres=is_postgres, create_table=create_table)
+            closure_outputs = tc_engine.PATH_TABLES + ['ncit_tc_all']
+        metrics.end()
+        state.mark_done('closure', closure_fp, outputs=closure_outputs)
+else:
+    # The per-ontology closures and the composite closure only read the parents table, so they can run side by side
+    closure_stages = [stage_runner.Stage(suffix, functools.partial(build_sql_path_table, suffix=suffix, prefix=prefix))
+                      for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES]
+    closure_stages.append(stage_runner.Stage('comp', build_sql_comp_table))
+    closure_stages = [stage for stage in closure_stages
+                      if not state.done('closure_' + stage.name, closure_fp, deps=['parents'])]
+    stage_runner.run_stages(closure_stages, connect, jobs=jobs, shared=con, metrics=metrics)
+
+# An incremental update has already patched the union, tc_all and reflexive rows in place
+if incremental or state.done('tc_all', closure_fp, deps=closure_checkpoints):
+    pass
+elif args.skip_paths:
+    metrics.begin("creating indexes")
+    create_index("tc_desc_all_index", "ncit_tc_all", "descendant")
+    create_index("tc_parent_all_index", "ncit_tc_all", "parent")
+    create_deferred_indexes()
+    metrics.end()
+    state.mark_done('tc_all', closure_fp, outputs=['ncit_tc_all'])
+else:
+    metrics.begin("creating union of tables")
+    path_codec.drop_compact_tables(cur, is_postgres)
+    cur.execute("drop table if exists ncit_tc_with_path_all")
+    con.commit()
 
-# In[64]:
-con.commit()
+    for i, path_table in enumerate(tc_engine.PATH_TABLES):
+        metrics.begin("adding in " + path_table[len('ncit_tc_with_path_'):] + " paths")
+        if i == 0:
+            cur.execute(create_table + " ncit_tc_with_path_all as select parent, descendant, level, path from "
+                        + path_table)
+        else:
+            cur.execute("insert into ncit_tc_with_path_all(parent, descendant, level, path) "
+                        "select parent, descendant, level, path from " + path_table)
+        metrics.add_rows(cur.rowcount)
+        con.commit()
+
+    metrics.begin("creating indexes")
+
+    create_index('ncit_tc_path_parent', 'ncit_tc_with_path_all', 'parent')
+    create_index('ncit_tc_path_descendant', 'ncit_tc_with_path_all', 'descendant')
+
+    # Create the transitive closure table.  This fits the mathematical definition of transitive closure.
+
+    # In[52]:
+
+    if args.tc_engine == 'sql':
+        metrics.begin("creating tc_all tables")
+
+        cur.execute('drop table if exists ncit_tc_all')
+        con.commit()
+        sql = create_table + " ncit_tc_all as select distinct parent, descendant from ncit_tc_with_path_all "
+        metrics.explain(sql)
+        cur.execute(sql)
+        metrics.add_rows(cur.rowcount)
+        con.commit()
+    # In[53]:
+
+    rs = cur.execute('select count(*) from ncit_tc_all')
+    total_num_rows_in_tc = cur.fetchone()[0]
+    print("There are ", total_num_rows_in_tc, "rows in the transitive closure table")
+
+
+    # The in-process engine has already written the reflexive rows into ncit_tc_all
+    if args.tc_engine == 'sql':
+        metrics.begin("adding in reflexive parent rows")
+
+        cur.execute(
+            '''with codes as 
+            (
+            select distinct parent as code from ncit_tc_all
+            union
+            select distinct descendant as code from ncit_tc_all
+            ) 
+            insert into ncit_tc_all (parent, descendant) 
+            select c.code as parent, c.code as descendant from codes c
+            ''')
+        metrics.add_rows(cur.rowcount)
+
+    # In[64]:
+    con.commit()
 
-print(datetime.datetime.now(), "adding in reflexive paths")
+    metrics.begin("adding in reflexive paths")
 
-cur.execute(
-    '''with codes as 
-    (
-    select distinct parent as code from ncit_tc_all
-    union
-    select distinct descendant as code from ncit_tc_all
-    ) 
-    insert into ncit_tc_with_path_all (parent, descendant, level, path) 
-    select c.code, c.code, 0  , c.code  from codes c
-    ''')
+    # ncit_tc_all now has exactly one reflexive row per code, so there is no need to collect the codes again
+    cur.execute(
+        '''insert into ncit_tc_with_path_all (parent, descendant, level, path) 
+        select parent, descendant, 0, parent from ncit_tc_all where parent = descendant
+        ''')
+    metrics.add_rows(cur.rowcount)
 
-# In[59]:
-con.commit()
-cur.execute("drop index if exists tc_desc_all_index")
-con.commit()
-cur.execute("create index tc_desc_all_index on ncit_tc_all(descendant)")
-con.commit()
-cur.execute("drop index if exists tc_parent_all_index")
-con.commit()
-cur.execute("create index tc_parent_all_index on ncit_tc_all(parent )")
-con.commit()
+    # In[59]:
+    con.commit()
+    metrics.begin("creating tc_all indexes")
+    create_index("tc_desc_all_index", "ncit_tc_all", "descendant")
+    create_index("tc_parent_all_index", "ncit_tc_all", "parent")
+    create_deferred_indexes()
+    metrics.end()
+    # compaction turns ncit_tc_with_path_all into a view
+    state.mark_done('tc_all', closure_fp,
+                    outputs=['ncit_tc_all'] + (['ncit_tc_with_path_all'] if args.path_encoding == 'text' else []))
+
+# anything still queued, e.g. the ncit indexes of an incremental build
+create_deferred_indexes()
 
 rc = cur.execute("select count(*) from ncit_tc_all where parent=descendant")
 reflexive_concepts = cur.fetchone()[0]
@@ -599,9 +781,52 @@ rc = cur.execute('select count(*) from ncit_tc_all')
 total_num_rows_in_tc = cur.fetchone()[0]
 print("There are ", total_num_rows_in_tc, "rows in the transitive closure table")
 
-rc = cur.execute("select count(*) from ncit_tc_with_path_all ")
-num_paths = cur.fetchone()[0]
-print("There are ", num_paths , " distinct paths in the composite ontology.")
+if not args.skip_paths:
+    # a resumed build may find the paths already compacted behind the decoding view
+    rc = cur.execute("select count(*) from " + (path_codec.COMPACT_TABLE
+                                                if bulk_load.view_exists(cur, 'ncit_tc_with_path_all', is_postgres)
+                                                else 'ncit_tc_with_path_all'))
+    num_paths = cur.fetchone()[0]
+    print("There are ", num_paths , " distinct paths in the composite ontology.")
+
+if args.path_encoding == 'compact' and not state.done('compact', closure_fp, deps=['tc_all']):
+    metrics.begin("compacting ncit_tc_with_path_all")
+    path_codec.compact_path_table(con, postgres=is_postgres, create_table=create_table)
+    # every path is now in the compact table; the per-ontology tables would keep all of them again as text
+    metrics.begin("dropping the per-ontology path tables")
+    for path_table in tc_engine.PATH_TABLES:
+        cur.execute('drop table if exists ' + path_table)
+    con.commit()
+    metrics.end()
+    # the closure stages' paths live on in the compact table, so a resumed build does not recompute them
+    for stage in closure_checkpoints:
+        state.set_outputs(stage, ['ncit_tc_all', path_codec.COMPACT_TABLE])
+    state.mark_done('compact', closure_fp, outputs=[path_codec.COMPACT_TABLE, 'concept_id'])
+
+if args.reach_index and not state.done('reach_index', closure_fp, deps=['closure' if incremental else 'tc_all']):
+    metrics.begin("building reachability index")
+    reach_index.build_reach_index(con, postgres=is_postgres, create_table=create_table)
+    metrics.end()
+    state.mark_done('reach_index', closure_fp, outputs=['concept_reach_label', 'concept_reach_interval',
+                                                        'concept_reach_exception'])
+
+if args.finalize_layout and not state.done('layout', closure_fp,
+                                          deps=['closure' if incremental else 'tc_all']
+                                          + (['compact'] if args.path_encoding == 'compact' else [])):
+    metrics.begin("finalizing closure table layout")
+    metrics.report('layout', physical_layout.finalize_layout(con, postgres=is_postgres))
+    metrics.end()
+    state.mark_done('layout', closure_fp, outputs=['ncit_tc_all'])
+
+if args.closure_artifact is not None:
+    # written from the staging generation, so it carries the version about to be activated
+    metrics.begin("writing closure artifact")
+    onto = ontology_query.Ontology.from_db(con, version=current_evs_version)
+    closure_artifact.write_artifact(onto, args.closure_artifact)
+    metrics.add_rows(len(onto.anc_ids))
+    metrics.end()
+    print(datetime.datetime.now(), "closure artifact of", len(onto.codes), "codes written to", args.closure_artifact)
+    del onto
 
 # In[62]:
 
@@ -610,19 +835,40 @@ print("There are ", num_paths , " distinct paths in the composite ontology.")
 
 con.commit()
 
+if args.bulk_load:
+    metrics.begin("making the bulk loaded tables durable")
+    bulk_load.leave_bulk_mode(con, is_postgres)
+    metrics.end()
 
-cur.execute('update ncit_version_composite set active_version = NULL')
-if args.schema is None:
-    cur.execute("""insert into ncit_version_composite(version_id, downloaded_url,composite_ontology_generation_date, active_version )
-           values(?,?,?,?)
-        """, [current_evs_version, 'hardcoded', datetime.datetime.now(), 'Y'])
+if args.blue_green and is_postgres:
+    sa_connection.close()
+    generation_swap.swap_staging_schema(con, live_schema, before_commit=activate_version)
 else:
-    cur.execute("""insert into ncit_version_composite(version_id, downloaded_url,composite_ontology_generation_date, active_version )
-           values(%s,%s,%s,%s)
-        """, [current_evs_version, 'hardcoded', datetime.datetime.now(), 'Y'])
-con.commit()
+    activate_version(cur)
+    con.commit()
+
+if args.parquet_dir is not None:
+    metrics.begin("exporting Parquet files")
+    manifest = parquet_export.export_tables(con, args.parquet_dir, is_postgres, version_table=version_table,
+                                            schema=live_schema if args.blue_green and is_postgres else None)
+    metrics.add_rows(sum(t['rows'] for t in manifest['tables'].values()))
+    metrics.end()
+
+if args.incremental:
+    cur.execute('drop table if exists parents_prev')
+    con.commit()
+
+if args.metrics_file is not None or args.metrics_table:
+    metrics_table = None
+    if args.metrics_table:
+        # Metrics accumulate across generations, so on Postgres they live next to the version table
+        metrics_table = build_metrics.METRICS_TABLE if not (args.blue_green and is_postgres) \
+            else live_schema + '.' + build_metrics.METRICS_TABLE
+    metrics.write(args.metrics_file, table=metrics_table, run_id=current_evs_version + ' ' + start_time.isoformat())
 
 end_time = datetime.datetime.now()
 print("Process complete in ", end_time - start_time)
 
 con.close()
+if args.blue_green and not is_postgres:
+    generation_swap.swap_staging_file(args.dbfilename)
@@ -0,0 +1,138 @@
+"""
+Bulk row writers and small database helpers shared by the build scripts.
+
+On Postgres rows are streamed through COPY ... FROM STDIN in batches, on sqlite they go through
+executemany.  Either way nothing is ever read back out of the database.
+"""
+import io
+import itertools
+
+DEFAULT_BATCH_SIZE = 100000
+
+
+def _copy_escape(value):
+    """Escape a single value for the Postgres COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    s = str(value)
+    if '\\' in s or '\t' in s or '\n' in s or '\r' in s:
+        s = s.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return s
+
+
+def batched(iterable, n):
+    """Yield successive lists of at most n items from any iterable."""
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+def table_exists(cur, table, postgres):
+    if postgres:
+        cur.execute('select to_regclass(%s) is not null', (table,))
+    else:
+        cur.execute("select count(*) from sqlite_master where type = 'table' and name = ?", (table,))
+    return bool(cur.fetchone()[0])
+
+
+def view_exists(cur, view, postgres):
+    if postgres:
+        cur.execute('select count(*) from information_schema.views '
+                    'where table_name = %s and table_schema = any(current_schemas(false))', (view,))
+    else:
+        cur.execute("select count(*) from sqlite_master where type = 'view' and name = ?", (view,))
+    return bool(cur.fetchone()[0])
+
+
+def copy_rows(cur, table, columns, rows, postgres, batch_size=DEFAULT_BATCH_SIZE):
+    """Write an iterable of row tuples into table(columns).  Returns the number of rows written."""
+    total = 0
+    col_list = ','.join(columns)
+    if postgres:
+        copy_sql = 'copy ' + table + '(' + col_list + ') from stdin'
+        for batch in batched(rows, batch_size):
+            buf = io.StringIO()
+            for row in batch:
+                buf.write('\t'.join(_copy_escape(v) for v in row))
+                buf.write('\n')
+            buf.seek(0)
+            cur.copy_expert(copy_sql, buf)
+            total += len(batch)
+    else:
+        insert_sql = 'insert into ' + table + '(' + col_list + ') values (' + ','.join('?' * len(columns)) + ')'
+        for batch in batched(rows, batch_size):
+            cur.executemany(insert_sql, batch)
+            total += len(batch)
+    return total
+
+
+# Session settings for --bulk_load.  The sqlite ones trade durability of the running load for speed (a crash can
+# lose the last transactions but WAL keeps the file consistent, so --resume still works); threads lets sqlite sort
+# for create index on helper threads.
+SQLITE_BULK_PRAGMAS = ['journal_mode = WAL', 'synchronous = OFF', 'cache_size = -1048576', 'mmap_size = 8589934592',
+                       'temp_store = MEMORY', 'threads = 4']
+POSTGRES_BULK_SETTINGS = ["maintenance_work_mem = '1GB'", 'max_parallel_maintenance_workers = 4',
+                          'synchronous_commit = off']
+
+
+def enter_bulk_mode(con, postgres):
+    """Switch a connection to the bulk load settings above."""
+    cur = con.cursor()
+    for setting in POSTGRES_BULK_SETTINGS if postgres else SQLITE_BULK_PRAGMAS:
+        cur.execute(('set ' if postgres else 'pragma ') + setting)
+    con.commit()
+
+
+def create_table_sql(postgres, bulk):
+    """'create table', or 'create unlogged table' for tables loaded in bulk mode on Postgres."""
+    return 'create unlogged table' if postgres and bulk else 'create table'
+
+
+def unlogged_tables(cur, schema=None):
+    """The unlogged tables in schema, or in the schemas on the search path."""
+    if schema is not None:
+        cur.execute("select c.relname from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+                    "where c.relkind = 'r' and c.relpersistence = 'u' and n.nspname = %s", (schema,))
+    else:
+        cur.execute("select c.relname from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+                    "where c.relkind = 'r' and c.relpersistence = 'u' and n.nspname = any(current_schemas(false))")
+    return [r[0] for r in cur.fetchall()]
+
+
+def is_empty_unlogged(cur, table):
+    """True for an unlogged Postgres table without rows, which is what a server crash leaves of one."""
+    cur.execute("select relpersistence = 'u' from pg_class where oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    if row is None or not row[0]:
+        return False
+    cur.execute('select not exists (select 1 from ' + table + ')')
+    return cur.fetchone()[0]
+
+
+def leave_bulk_mode(con, postgres, schema=None):
+    """
+    Make everything loaded in bulk mode durable: SET LOGGED on the unlogged tables on Postgres, back to a rollback
+    journal with synchronous=FULL on sqlite.
+    """
+    cur = con.cursor()
+    if postgres:
+        for table in unlogged_tables(cur, schema):
+            cur.execute('alter table ' + (schema + '.' if schema else '') + table + ' set logged')
+        con.commit()
+    else:
+        con.commit()
+        cur.execute('pragma journal_mode = DELETE')
+        cur.execute('pragma synchronous = FULL')
+
+
+def analyze(con, tables):
+    """Refresh planner statistics for tables."""
+    cur = con.cursor()
+    for table in tables:
+        cur.execute('analyze ' + table)
+    con.commit()
@@ -1,3 +1,4 @@
+import sqlite3
 import wget
 import datetime
 import argparse
@@ -10,6 +11,9 @@ import sqlalchemy
 import time
 import pandas as pd
 
+import bulk_load
+import path_codec
+
 pd.set_option('display.max_colwidth', 1000)
 parser = argparse.ArgumentParser(description='Download the NCIT Thesaurus Zip file and create transitive closure tables in a sqlite or Postgresql database.')
 
@@ -20,6 +24,8 @@ parser.add_argument('--password', action='store', type=str, required=False)
 parser.add_argument('--port', action='store', type=str, required=False)
 parser.add_argument('--schema', action='store', type=str, required=False)
 parser.add_argument('--dbfilename', action='store', type=str, required=False )
+parser.add_argument('--mode', action='store', type=str, required=False, default='batch', choices=['batch', 'row'],
+                    help='check all codes with one set-based query (default) or one pair of queries per row')
 #sys.exit()
 
 args = parser.parse_args()
@@ -47,6 +53,8 @@ else:
 
 
 cur = db_connection.cursor()
+# a --path_encoding compact build reads paths through a view that needs decode_tc_path on sqlite
+path_codec.register_if_compact(con, args.dbfilename is None)
 
 
 def is_code_reachable(concept_code):
@@ -62,6 +70,32 @@ def is_code_reachable(concept_code):
     return (reachable_rs[0], reachable_directly_rs[0])
 
 
+def reachable_counts_batch(concept_codes):
+    """
+    (concept_code, reachable, reachable_directly) for every distinct code, computed with a single join of a
+    temporary code table against ncit_tc_all and ncit_tc_with_path_all.
+    """
+    postgres = args.dbfilename is None
+    tables = 'umls.' if postgres else ''
+    cur.execute('drop table if exists mcode_codes')
+    cur.execute('create temporary table mcode_codes (concept_code text primary key)')
+    bulk_load.copy_rows(cur, 'mcode_codes', ('concept_code',), ((c,) for c in sorted(set(concept_codes))), postgres)
+    cur.execute('''
+    with r as (
+        select t.descendant, count(*) as n from {0}ncit_tc_all t join mcode_codes m on m.concept_code = t.descendant
+        where t.parent like 'C%' group by t.descendant
+    ), d as (
+        select t.descendant, count(*) as n from {0}ncit_tc_with_path_all t join mcode_codes m on m.concept_code = t.descendant
+        where t.parent like 'C%' and t.level = 1 group by t.descendant
+    )
+    select m.concept_code, coalesce(r.n, 0), coalesce(d.n, 0)
+    from mcode_codes m left join r on r.descendant = m.concept_code left join d on d.descendant = m.concept_code
+    '''.format(tables))
+    result = pd.DataFrame(cur.fetchall(), columns=['concept_code', 'reachable', 'reachable_directly'])
+    cur.execute('drop table mcode_codes')
+    return result
+
+
 
 print('mCODE coverage analyser')
 df = pd.read_excel('mCODEDataDictionary-STU3.xlsx', sheet_name='Value set codes')
@@ -74,22 +108,34 @@ code_system_prefixes = {'http://hl7.org/fhir/sid/icd-10-cm': 'ICD10CM',
 
 df['prefix'] = df['Code System'].apply( lambda x: code_system_prefixes[x] if x in code_system_prefixes else None )
 df['concept_code'] = df.apply(lambda x: x['prefix'] + ":" + str(x['Code']) if x['Code'] is not None and not pd.isna(x['Code']) and x['prefix'] is not None and 'is' not in str(x['Code'])  else None, axis =1 )
-reachable_counts = {
-    'ICD10CM': {'total':0 , 'reachable':0, 'reachable_directly': 0},
-    'SNOMEDCT': {'total':0 , 'reachable':0, 'reachable_directly': 0},
-    'LOINC': {'total':0 , 'reachable':0, 'reachable_directly': 0}
-}
-for ind, row in df.iterrows():
-    if row['concept_code'] is not None:
-        (reachable, reachable_directly) = is_code_reachable(row['concept_code'])
-        if reachable == 0 and reachable_directly == 0:
-            print(str(row['concept_code']), 'is not reachable')
-            print(row.to_frame())
-            print("------------------------------------")
-        reachable_counts[row['prefix']]['total'] += 1
-        if reachable > 0:
-            reachable_counts[row['prefix']]['reachable'] += 1
-        if reachable_directly > 0:
-            reachable_counts[row['prefix']]['reachable_directly'] += 1
-
-print(reachable_counts)
+if args.mode == 'batch':
+    coded = df[df['concept_code'].notna()]
+    coded = coded.merge(reachable_counts_batch(coded['concept_code']), on='concept_code', how='left')
+    for ind, row in coded[(coded['reachable'] == 0) & (coded['reachable_directly'] == 0)].iterrows():
+        print(str(row['concept_code']), 'is not reachable')
+        print(row.to_frame())
+        print("------------------------------------")
+    summary = coded.assign(reachable=coded['reachable'] > 0, reachable_directly=coded['reachable_directly'] > 0) \
+        .groupby('prefix').agg(total=('concept_code', 'size'), reachable=('reachable', 'sum'),
+                               reachable_directly=('reachable_directly', 'sum'))
+    print(summary)
+else:
+    reachable_counts = {
+        'ICD10CM': {'total':0 , 'reachable':0, 'reachable_directly': 0},
+        'SNOMEDCT': {'total':0 , 'reachable':0, 'reachable_directly': 0},
+        'LOINC': {'total':0 , 'reachable':0, 'reachable_directly': 0}
+    }
+    for ind, row in df.iterrows():
+        if row['concept_code'] is not None:
+            (reachable, reachable_directly) = is_code_reachable(row['concept_code'])
+            if reachable == 0 and reachable_directly == 0:
+                print(str(row['concept_code']), 'is not reachable')
+                print(row.to_frame())
+                print("------------------------------------")
+            reachable_counts[row['prefix']]['total'] += 1
+            if reachable > 0:
+                reachable_counts[row['prefix']]['reachable'] += 1
+            if reachable_directly > 0:
+                reachable_counts[row['prefix']]['reachable_directly'] += 1
+
+    print(reachable_counts)
@@ -1,20 +1,16 @@
+import sys
 import wget
-import datetime
 import argparse
 import tempfile
 from pathlib import Path
-import requests
 import psycopg2
 import psycopg2.extras
 import sqlalchemy
-import time
 import pandas as pd
+import sqlite3
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
+import evs_cache
+import evs_client
 
 pd.set_option('display.max_colwidth', 1000)
 parser = argparse.ArgumentParser(description='Download the NCIT Thesaurus Zip file and create transitive closure tables in a sqlite or Postgresql database.')
@@ -26,6 +22,15 @@ parser.add_argument('--password', action='store', type=str, required=False)
 parser.add_argument('--port', action='store', type=str, required=False)
 parser.add_argument('--schema', action='store', type=str, required=False)
 parser.add_argument('--dbfilename', action='store', type=str, required=False )
+parser.add_argument('--evs_url', action='store', type=str, required=False, default=evs_client.EVS_API_URL)
+parser.add_argument('--evs_concurrency', action='store', type=int, required=False, default=8,
+                    help='number of EVS calls in flight at once')
+parser.add_argument('--evs_rate', action='store', type=float, required=False, default=10.0,
+                    help='maximum EVS calls per second')
+parser.add_argument('--evs_cache', action='store', type=str, required=False,
+                    help='sqlite file caching EVS concept summaries per NCIt version')
+parser.add_argument('--evs_cache_versions', action='store', type=int, required=False, default=2,
+                    help='number of NCIt versions kept in the EVS cache')
 #sys.exit()
 
 args = parser.parse_args()
@@ -54,6 +59,8 @@ else:
 
 cur = db_connection.cursor()
 new_ehr_subsources = set()
+# EVS has used both spellings of the ICD-10-CM subSource
+subsource_prefixes = dict(evs_client.MCODE_SUBSOURCE_PREFIXES, **{'ICD-10-CM': 'ICD10CM'})
 
 def get_ncit_ehr_syns_for_code(code=None):
 
@@ -65,76 +72,30 @@ def get_ncit_ehr_syns_for_code(code=None):
     concept_rs = cur.fetchall()
     concept_list = [r[0] for r in concept_rs]
 
-    num_concepts_per_evs_call = 575
-   # concept_list = ncit_df['code'].tolist()
-
-    concept_url_fstring = "https://api-evsrest.nci.nih.gov/api/v1/concept/ncit?list=%s&include=summary"
     new_column_vals = []
 
-    chunk_count = 0
-    record_count = 0
-    retry_limit = 3
-
     print("Calling EVS to get crosswalk terms")
-    for ch in chunks(concept_list, num_concepts_per_evs_call):
-        c_codes = list(ch)
-        record_count += len(c_codes)
-        c_codes_string = ','.join(c_codes)
-        #print(c_codes_string)
-        concept_url_string = concept_url_fstring % (c_codes_string)
-        retry_count = 0
-
-        while retry_count < retry_limit:
-            try:
-                r = requests.get(concept_url_string, timeout=(1.0, 15.0))
-            except requests.exceptions.RequestException as e:
-                print("exception -- ", e)
-                print("sleeping")
-                retry_count += 1
-                if retry_count == retry_limit:
-                    print("retry max limit hit -- bailing out ")
-                    sys.exit()
-                time.sleep(15)
-            else:
-                try:
-                    concept_set = r.json()
-                except Exception:
-                    print("ERROR in ", concept_url_string)
-                    traceback.print_exc()
-                    sys.exit()
-                for newc in concept_set:
-                    #new_column_vals.append((newc['code'], newc['name']))
-                    if 'synonyms' in newc:
-                        for syn in newc['synonyms']:
-                            if 'source' in syn and syn['source'] == 'mCode':
-                              #  print("found mcode :",newc)
-                                if 'subSource' in syn:
-                                    if syn['subSource'] in ('ICD-10 CM', 'ICD-10-CM'):
-                                      #  print('adding ' + newc['code'] + ' => ', 'ICD10CM:'+syn['code'])
-                                        new_column_vals.append(('ICD10CM:'+syn['code'],
-                                                               newc['code'],
-                                                               newc['code']+'|'+'ICD10CM:'+syn['code'],
-                                                               1))
-                                    elif syn['subSource'] == 'LOINC':
-                                      #  print('adding ' + newc['code'] + ' => ', 'LOINC:' + syn['code'])
-                                        new_column_vals.append(('LOINC:' + syn['code'],
-                                                               newc['code'],
-                                                               newc['code'] + '|' + 'LOINC:' + syn['code'],
-                                                               1))
-                                    elif syn['subSource'] == 'SNOMED CT':
-                                      #  print('adding ' + newc['code'] + ' => ', 'SNOMEDCT:' + syn['code'])
-                                        new_column_vals.append(('SNOMEDCT:' + syn['code'],
-                                                               newc['code'],
-                                                               newc['code'] + '|' + 'SNOMEDCT:' + syn['code'],
-                                                               1))
-                                    else:
-                                        new_ehr_subsources.add(syn['subSource'])
-                                        print(str(newc))
-                                        #print(newc)
-                                        #sys.exit()
-                chunk_count = chunk_count + 1
-                print(datetime.datetime.now(), "processing chunk ", chunk_count, " record count = ", record_count)
-                break
+    evs = evs_client.EvsClient(base_url=args.evs_url, concurrency=args.evs_concurrency, rate=args.evs_rate)
+    cache = None
+    try:
+        if args.evs_cache is not None:
+            evs_version = evs.get_version()
+            if evs_version is None:
+                print("NO VERSION NUMBER in returned info from EVS, cannot use the EVS cache")
+                sys.exit(1)
+            cache = evs_cache.EvsCache(args.evs_cache, evs_version, keep_versions=args.evs_cache_versions)
+            concept_sets = cache.iter_concept_chunks(evs, concept_list)
+        else:
+            concept_sets = evs.iter_concept_chunks(concept_list)
+        for concept_set in concept_sets:
+            new_column_vals.extend(evs_client.mcode_crosswalk_rows(concept_set, subsource_prefixes=subsource_prefixes,
+                                                                   unknown_subsources=new_ehr_subsources,
+                                                                   on_unknown=lambda newc: print(str(newc))))
+    finally:
+        evs.close()
+        if cache is not None:
+            print("EVS cache hits:", cache.hits, "misses:", cache.misses)
+            cache.close()
 
     #
     print("returning dataframes")
@@ -0,0 +1,165 @@
+"""
+Single-file binary form of the in-memory ontology, for query workers that should not warm up from the database.
+
+The file holds a header with the NCIt version, a string table of the concept codes and the CSR arrays of
+ontology_query.Ontology (direct parents, direct children, ancestors, descendants and depths), each section
+64-byte aligned so it can be used in place:
+
+    b'NCITCLOS' | format version (uint32) | header length (uint32) | JSON header | sections...
+
+Codes are numbered in byte order, so the string table is sorted and code -> id is a binary search over it.
+open_artifact() mmaps the file read-only and wraps the sections as numpy views without copying anything; every
+worker process opening the same file shares one page-cache copy, and opening it is independent of its size.
+
+    closure_artifact.write_artifact(Ontology.from_db(con), 'composite.tc')     # or build_unified_tc.py --closure_artifact
+    onto = closure_artifact.open_artifact('composite.tc')
+    onto.version, onto.is_a('SNOMEDCT:363346000', 'C3262')
+
+write_artifact() renames the finished file over the old one, so workers that still have the previous file mapped
+keep reading it until they reopen.
+"""
+import bisect
+import datetime
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+import ontology_query
+
+MAGIC = b'NCITCLOS'
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct('<8sII')
+ALIGN = 64
+
+# CSR relations of Ontology, each stored as <name>_offsets (int64) and <name>_ids (int32)
+RELATIONS = ('parent', 'child', 'anc', 'desc')
+
+
+class CodeTable:
+    """Read-only code <-> id mapping over the sorted string table; stands in for Ontology.codes and .ids."""
+
+    def __init__(self, buf, base, offsets):
+        self.buf = buf
+        self.base = base
+        self.offsets = offsets
+        self.keys = _Keys(self)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.buf[self.base + int(self.offsets[i]):self.base + int(self.offsets[i + 1])].decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def get(self, code, default=None):
+        key = code.encode('utf-8')
+        i = bisect.bisect_left(self.keys, key)
+        return i if i < len(self) and self._key(i) == key else default
+
+    def _key(self, i):
+        return self.buf[self.base + int(self.offsets[i]):self.base + int(self.offsets[i + 1])]
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+
+class _Keys:
+    """Sequence of the encoded codes, for bisect."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        return self.table._key(i)
+
+
+def _renumbered(onto):
+    """The relations of onto with ids reassigned in byte order of the codes."""
+    n = len(onto.codes)
+    keys = [c.encode('utf-8') for c in onto.codes]
+    order = np.array(sorted(range(n), key=keys.__getitem__), dtype=np.int64)
+    rank = np.empty(n, dtype=np.int32)
+    rank[order] = np.arange(n, dtype=np.int32)
+    arrays = {}
+    for name in RELATIONS:
+        offsets = getattr(onto, name + '_offsets')
+        ids = getattr(onto, name + '_ids')
+        src = np.repeat(np.arange(n, dtype=np.int32), np.diff(offsets))
+        arrays[name + '_offsets'], arrays[name + '_ids'] = ontology_query.csr(rank[src], rank[ids], n)
+    arrays['depths'] = np.asarray(onto.depths, dtype=np.int32)[order]
+    code_bytes = [keys[i] for i in order]
+    code_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(k) for k in code_bytes], out=code_offsets[1:])
+    arrays['code_offsets'] = code_offsets
+    arrays['code_bytes'] = np.frombuffer(b''.join(code_bytes), dtype=np.uint8)
+    return arrays
+
+
+def _aligned(pos):
+    return (pos + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_artifact(onto, path, version=None):
+    """Write onto (an ontology_query.Ontology) to path.  version defaults to onto.version."""
+    arrays = _renumbered(onto)
+    sections = {}
+    pos = 0
+    for name, a in arrays.items():
+        sections[name] = {'offset': pos, 'dtype': a.dtype.str, 'count': len(a)}
+        pos = _aligned(pos + a.nbytes)
+    header = {'ncit_version': version if version is not None else onto.version,
+              'created': datetime.datetime.now().isoformat(), 'codes': len(onto.codes), 'sections': sections}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(PREAMBLE.size + len(header_bytes))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, a in arrays.items():
+            f.seek(data_start + sections[name]['offset'])
+            f.write(a.tobytes())
+        f.truncate(data_start + pos)
+    os.replace(tmp, path)
+    return header
+
+
+def read_header(buf):
+    magic, fmt, header_len = PREAMBLE.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError('not a closure artifact')
+    if fmt != FORMAT_VERSION:
+        raise ValueError('closure artifact format %d, expected %d' % (fmt, FORMAT_VERSION))
+    header = json.loads(bytes(buf[PREAMBLE.size:PREAMBLE.size + header_len]).decode('utf-8'))
+    header['data_start'] = _aligned(PREAMBLE.size + header_len)
+    return header
+
+
+def open_artifact(path, cache_size=ontology_query.DEFAULT_CACHE_SIZE):
+    """An ontology_query.Ontology whose arrays are read-only views of the mmapped file."""
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = read_header(buf)
+    start = header['data_start']
+    arrays = {name: np.frombuffer(buf, dtype=s['dtype'], count=s['count'], offset=start + s['offset'])
+              for name, s in header['sections'].items()}
+    onto = ontology_query.Ontology.__new__(ontology_query.Ontology)
+    onto.artifact = buf
+    onto.codes = onto.ids = CodeTable(buf, start + header['sections']['code_bytes']['offset'],
+                                      arrays['code_offsets'])
+    onto.version = header['ncit_version']
+    for name in RELATIONS:
+        setattr(onto, name + '_offsets', arrays[name + '_offsets'])
+        setattr(onto, name + '_ids', arrays[name + '_ids'])
+    onto.depths = arrays['depths']
+    onto._init_cache(cache_size)
+    return onto
@@ -0,0 +1,112 @@
+"""
+On-disk cache of EVS concept summaries, keyed by NCIt version and concept code.
+
+Summaries are stored as zlib-compressed JSON in a small sqlite file, so reruns, retries after a crash and the
+syn-types census only call EVS for the codes that are not cached yet for the current version.  Versions other
+than the most recently used keep_versions are evicted when the cache is opened.  Codes EVS did not return are
+cached too, with a NULL summary, so they are not asked for again on every run.
+"""
+import datetime
+import json
+import sqlite3
+import zlib
+
+from evs_client import chunks
+
+LOOKUP_BATCH_SIZE = 500
+
+
+class EvsCache:
+
+    def __init__(self, path, version, keep_versions=2):
+        if version is None:
+            raise ValueError('EVS cache needs the NCIt version its summaries belong to')
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("""create table if not exists evs_cache_version(
+                             version_id text primary key,
+                             last_used text)""")
+        self.db.execute("""create table if not exists evs_concept_summary(
+                             version_id text,
+                             code text,
+                             summary blob,
+                             primary key (version_id, code)) without rowid""")
+        self.db.execute("insert or replace into evs_cache_version(version_id, last_used) values(?,?)",
+                        (version, datetime.datetime.now().isoformat()))
+        self.db.commit()
+        self.evict(keep_versions)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def evict(self, keep_versions):
+        """Drop every version except the keep_versions most recently used ones."""
+        old = [r[0] for r in self.db.execute(
+            "select version_id from evs_cache_version order by last_used desc limit -1 offset ?", (keep_versions,))]
+        for version in old:
+            self.db.execute("delete from evs_concept_summary where version_id = ?", (version,))
+            self.db.execute("delete from evs_cache_version where version_id = ?", (version,))
+            print(datetime.datetime.now(), "EVS cache evicted version", version)
+        self.db.commit()
+        if old:
+            self.db.execute("vacuum")
+
+    def cached_codes(self, codes):
+        """The subset of codes that have a summary (or are known to be missing from EVS) for this version."""
+        found = set()
+        for ch in chunks(list(codes), LOOKUP_BATCH_SIZE):
+            sql = ("select code from evs_concept_summary where version_id = ? and code in (" +
+                   ','.join('?' * len(ch)) + ")")
+            found.update(r[0] for r in self.db.execute(sql, [self.version] + ch))
+        return found
+
+    def get_many(self, codes):
+        """code -> concept dict for the cached codes in codes."""
+        result = {}
+        for ch in chunks(list(codes), LOOKUP_BATCH_SIZE):
+            sql = ("select code, summary from evs_concept_summary where version_id = ? and code in (" +
+                   ','.join('?' * len(ch)) + ")")
+            for code, summary in self.db.execute(sql, [self.version] + ch):
+                if summary is not None:
+                    result[code] = json.loads(zlib.decompress(summary))
+        return result
+
+    def put_many(self, concepts, missing_codes=()):
+        """Cache concepts, and missing_codes as not known to EVS."""
+        self.db.executemany(
+            "insert or replace into evs_concept_summary(version_id, code, summary) values(?,?,?)",
+            ((self.version, c['code'], zlib.compress(json.dumps(c).encode('utf-8'))) for c in concepts))
+        self.db.executemany(
+            "insert or replace into evs_concept_summary(version_id, code, summary) values(?,?,null)",
+            ((self.version, code) for code in missing_codes))
+        self.db.commit()
+
+    def iter_concept_chunks(self, client, codes, chunk_size=None):
+        """
+        Like EvsClient.iter_concept_chunks, but only codes that are not cached yet are fetched (and cached as each
+        chunk arrives, along with the codes of the chunk that EVS did not return).  Concepts are then read back from the cache in chunks, in the order of codes.
+        """
+        codes = list(codes)
+        if chunk_size is None:
+            chunk_size = client.chunk_size
+        cached = self.cached_codes(codes)
+        missing = [c for c in codes if c not in cached]
+        self.hits += len(codes) - len(missing)
+        self.misses += len(missing)
+        print(datetime.datetime.now(), "EVS cache for version", self.version, ":", len(codes) - len(missing), "hits,",
+              len(missing), "misses")
+        for ch, concept_set in client.iter_chunk_results(missing):
+            returned = set(c['code'] for c in concept_set)
+            self.put_many(concept_set, [c for c in ch if c not in returned])
+        for ch in chunks(codes, chunk_size):
+            found = self.get_many(ch)
+            yield [found[c] for c in ch if c in found]
@@ -0,0 +1,200 @@
+"""
+Concurrent client for the EVS REST concept endpoint.
+
+Concept codes are split into chunks, each chunk is one `concept/ncit?list=...` call, and the calls run on a
+bounded thread pool sharing a single keep-alive requests.Session, with at most 2 x concurrency chunks submitted
+ahead of the consumer.  Calls are rate limited, failures are retried per chunk with jittered exponential backoff,
+and results come back in the order of the input codes.  Point base_url at a local stand-in server to test without
+touching the real EVS.
+"""
+import collections
+import datetime
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import requests.adapters
+
+EVS_API_URL = 'https://api-evsrest.nci.nih.gov/api/v1'
+NUM_CONCEPTS_PER_EVS_CALL = 575
+
+# mCode synonym subSource -> code prefix used in the parents table
+MCODE_SUBSOURCE_PREFIXES = {'ICD-10 CM': 'ICD10CM',
+                            'LOINC': 'LOINC',
+                            'SNOMED CT': 'SNOMEDCT'}
+
+
+def chunks(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+
+def describe_error(e):
+    """Short description of a request failure, without the (very long) list URL."""
+    response = getattr(e, 'response', None)
+    if response is not None:
+        return '%s HTTP %s' % (type(e).__name__, response.status_code)
+    return '%s %s' % (type(e).__name__, e)
+
+
+class EvsFetchError(Exception):
+    """Raised when a chunk of concepts still cannot be fetched after all retries."""
+
+    def __init__(self, failed_chunks):
+        self.failed_chunks = failed_chunks
+        super().__init__('%d EVS chunk(s) could not be fetched' % len(failed_chunks))
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all threads.  A rate of None disables the limit."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class EvsClient:
+
+    def __init__(self, base_url=EVS_API_URL, concurrency=8, rate=10.0, max_retries=5, backoff_base=1.0,
+                 backoff_max=60.0, timeout=(3.05, 60.0), chunk_size=NUM_CONCEPTS_PER_EVS_CALL):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # chunks submitted ahead of the one being consumed
+        self.window = 2 * concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff delay for the given (1-based) attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def get_concepts(self, codes, include='summary'):
+        """One EVS call for a list of codes.  Raises on HTTP or decoding errors."""
+        self.rate_limiter.wait()
+        r = self.session.get(self.base_url + '/concept/ncit',
+                             params={'list': ','.join(codes), 'include': include}, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def get_version(self, code='C2991'):
+        """The NCIt version EVS is currently serving, or None if it is not reported."""
+        evs_results = self.get_concepts([code], include='minimal')
+        if len(evs_results) != 1 or 'version' not in evs_results[0]:
+            return None
+        return evs_results[0]['version']
+
+    def _fetch_chunk(self, codes, include):
+        attempt = 0
+        while True:
+            try:
+                return self.get_concepts(codes, include)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(datetime.datetime.now(), "EVS call for", len(codes), "codes starting", codes[0], "failed --",
+                      describe_error(e),
+                      "-- retry", attempt, "of", self.max_retries, "in %.1fs" % delay)
+                time.sleep(delay)
+
+    def iter_chunk_results(self, codes, include='summary'):
+        """
+        Yield (chunk of codes, parsed concept list) for each chunk of codes, in input order.  A chunk that exhausts
+        its retries is retried once more on its own; EvsFetchError lists the chunks that still failed after the rest
+        were fetched.
+        """
+        code_chunks = list(chunks(list(codes), self.chunk_size))
+        failed = []
+        record_count = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            # only a window of chunks is in flight, so a slow consumer does not pile up every parsed result
+            window = collections.deque(pool.submit(self._fetch_chunk, ch, include)
+                                       for ch in code_chunks[:self.window])
+            for i, ch in enumerate(code_chunks):
+                future = window.popleft()
+                if i + self.window < len(code_chunks):
+                    window.append(pool.submit(self._fetch_chunk, code_chunks[i + self.window], include))
+                try:
+                    concept_set = future.result()
+                except Exception as e:
+                    print(datetime.datetime.now(), "EVS chunk", i + 1, "failed after retries --", describe_error(e),
+                          "-- retrying it on its own")
+                    try:
+                        concept_set = self._fetch_chunk(ch, include)
+                    except Exception:
+                        failed.append(ch)
+                        continue
+                record_count += len(ch)
+                print(datetime.datetime.now(), "processing chunk ", i + 1, "of", len(code_chunks),
+                      " record count = ", record_count)
+                yield ch, concept_set
+        if failed:
+            raise EvsFetchError(failed)
+
+    def iter_concept_chunks(self, codes, include='summary'):
+        """Yield the parsed concept list of each chunk of codes, in input order (see iter_chunk_results)."""
+        for ch, concept_set in self.iter_chunk_results(codes, include):
+            yield concept_set
+
+    def get_concept_summaries(self, codes):
+        concepts = []
+        for concept_set in self.iter_concept_chunks(codes):
+            concepts.extend(concept_set)
+        return concepts
+
+
+def mcode_crosswalk_rows(concepts, subsource_prefixes=None, unknown_subsources=None, on_unknown=None):
+    """
+    (concept, parent, path, level) rows linking each NCIt concept to the ICD10CM/LOINC/SNOMEDCT codes of its mCode
+    synonyms.  subSources without a prefix are added to unknown_subsources when a set is given, and on_unknown is
+    called with the concept of each such synonym.
+    """
+    if subsource_prefixes is None:
+        subsource_prefixes = MCODE_SUBSOURCE_PREFIXES
+    rows = []
+    for newc in concepts:
+        for syn in newc.get('synonyms', ()):
+            if syn.get('source') != 'mCode' or 'subSource' not in syn:
+                continue
+            prefix = subsource_prefixes.get(syn['subSource'])
+            if prefix is None:
+                if unknown_subsources is not None:
+                    unknown_subsources.add(syn['subSource'])
+                if on_unknown is not None:
+                    on_unknown(newc)
+                continue
+            child = prefix + ':' + syn['code']
+            rows.append((child, newc['code'], newc['code'] + '|' + child, 1))
+    return rows
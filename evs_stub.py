@@ -0,0 +1,117 @@
+"""
+Local stand-in for the EVS REST concept endpoint, for benchmarks and offline runs.
+
+Serves GET <url>/concept/ncit?list=C1,C2,...&include=... from a JSON file written by synthetic_ontology.generate()
+({"version": ..., "concepts": {code: concept}}).  Unknown codes are left out of the answer like EVS does.  An
+optional latency and failure rate make it possible to exercise the client's concurrency and retries.
+
+    python evs_stub.py --concepts bench/evs_concepts.json --port 8765
+    python build_unified_tc.py ... --evs_url http://127.0.0.1:8765
+"""
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+
+class EvsStub:
+
+    def __init__(self, concepts, version, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0, seed=0):
+        self.concepts = concepts
+        self.version = version
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['concepts'], data['version'], **kwargs)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def handle(self, request):
+        parsed = urllib.parse.urlparse(request.path)
+        if parsed.path.rstrip('/') != '/concept/ncit':
+            request.send_error(404)
+            return
+        with self.lock:
+            self.calls += 1
+            fail = self.failure_rate and self.rng.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            request.send_error(503)
+            return
+        query = urllib.parse.parse_qs(parsed.query)
+        codes = query.get('list', [''])[0].split(',')
+        minimal = query.get('include', ['summary'])[0] == 'minimal'
+        result = []
+        for code in codes:
+            concept = self.concepts.get(code)
+            if concept is None:
+                continue
+            if minimal:
+                concept = {k: concept[k] for k in ('code', 'name', 'terminology', 'version') if k in concept}
+            result.append(concept)
+        body = json.dumps(result).encode('utf-8')
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic EVS concept/ncit responses on a local port.')
+    parser.add_argument('--concepts', action='store', type=str, required=True)
+    parser.add_argument('--host', action='store', type=str, required=False, default='127.0.0.1')
+    parser.add_argument('--port', action='store', type=int, required=False, default=8765)
+    parser.add_argument('--latency', action='store', type=float, required=False, default=0.0,
+                        help='seconds added to every call')
+    parser.add_argument('--failure_rate', action='store', type=float, required=False, default=0.0,
+                        help='fraction of calls answered with HTTP 503')
+    args = parser.parse_args()
+    stub = EvsStub.from_file(args.concepts, host=args.host, port=args.port, latency=args.latency,
+                             failure_rate=args.failure_rate)
+    print('EVS stub serving', len(stub.concepts), 'concepts of version', stub.version, 'at', stub.url)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
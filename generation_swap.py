@@ -0,0 +1,173 @@
+"""
+Blue/green generations for the composite ontology tables.
+
+A --blue_green build never touches the tables readers are using.  On Postgres it runs with search_path set to a
+staging schema (the UMLS tables it reads are visible there through pass-through views); when it succeeds every
+table, view and function it created is moved into the live schema in one transaction, together with the
+ncit_version_composite update, and the objects they replace are moved into a _prev schema.  On sqlite the build
+works on a copy of the database file which is renamed over the live file at the end; the old file is kept next
+to it with a .prev suffix.  Either way rollback() puts the previous generation back.
+
+The sqlite copy is of the whole file, including the UMLS mrconso/mrrel/mrdef/mrhier tables the build only reads,
+so each build copies them once more and needs about twice the database size on disk (live or .prev plus staging).
+Sqlite has no schemas to swap and cannot rename indexes, so the previous generation cannot be kept alongside the
+new one in the same file.
+"""
+import datetime
+import os
+import sqlite3
+
+PASSTHROUGH_TABLES = ('mrconso', 'mrhier')
+
+
+def staging_schema(schema):
+    return schema + '_staging'
+
+
+def prev_schema(schema):
+    return schema + '_prev'
+
+
+def staging_file(dbfilename):
+    return dbfilename + '.staging'
+
+
+def prev_file(dbfilename):
+    return dbfilename + '.prev'
+
+
+def prepare_staging_schema(con, schema, passthrough=PASSTHROUGH_TABLES, keep=False):
+    """
+    (Re)create the staging schema with views onto the live tables a build only reads.  With keep=True an existing
+    staging schema is left as it is, so a resumed build continues in it.
+    """
+    staging = staging_schema(schema)
+    cur = con.cursor()
+    if not keep:
+        cur.execute('drop schema if exists ' + staging + ' cascade')
+    cur.execute('create schema if not exists ' + staging)
+    for table in passthrough:
+        cur.execute('create or replace view ' + staging + '.' + table + ' as select * from ' + schema + '.' + table)
+    con.commit()
+    return staging
+
+
+def _schema_objects(cur, schema, skip=()):
+    """(kind, name) of the tables, views and functions directly in schema; kind is the ALTER keyword to use."""
+    cur.execute("""
+    select case c.relkind when 'v' then 'view' when 'm' then 'materialized view' else 'table' end, c.relname
+    from pg_class c join pg_namespace n on n.oid = c.relnamespace
+    where n.nspname = %s and c.relkind in ('r', 'p', 'v', 'm')
+    union all
+    select 'function', p.proname || '(' || pg_get_function_identity_arguments(p.oid) || ')'
+    from pg_proc p join pg_namespace n on n.oid = p.pronamespace
+    where n.nspname = %s
+    """, (schema, schema))
+    return [(kind, name) for kind, name in cur.fetchall() if name not in skip]
+
+
+def _move_objects(cur, objects, from_schema, to_schema, displaced_schema):
+    """Move objects from from_schema to to_schema, first moving same-named objects in to_schema aside."""
+    for kind, name in objects:
+        if kind == 'function':
+            sig = name[name.index('('):]
+            base = name[:name.index('(')]
+            cur.execute('select to_regprocedure(%s) is not null', (to_schema + '.' + base + sig,))
+            if cur.fetchone()[0]:
+                cur.execute('alter function ' + to_schema + '.' + base + sig + ' set schema ' + displaced_schema)
+            cur.execute('alter function ' + from_schema + '.' + base + sig + ' set schema ' + to_schema)
+            continue
+        cur.execute("""
+        select case c.relkind when 'v' then 'view' when 'm' then 'materialized view' else 'table' end
+        from pg_class c join pg_namespace n on n.oid = c.relnamespace
+        where n.nspname = %s and c.relname = %s and c.relkind in ('r', 'p', 'v', 'm')
+        """, (to_schema, name))
+        row = cur.fetchone()
+        if row is not None:
+            cur.execute('alter ' + row[0] + ' ' + to_schema + '.' + name + ' set schema ' + displaced_schema)
+        cur.execute('alter ' + kind + ' ' + from_schema + '.' + name + ' set schema ' + to_schema)
+
+
+def swap_staging_schema(con, schema, before_commit=None, passthrough=PASSTHROUGH_TABLES):
+    """
+    Atomically publish everything the build created in the staging schema.  before_commit(cur) runs inside the
+    same transaction, e.g. to activate the new version row.
+    """
+    staging = staging_schema(schema)
+    prev = prev_schema(schema)
+    cur = con.cursor()
+    print(datetime.datetime.now(), "swapping", staging, "into", schema)
+    cur.execute('drop schema if exists ' + prev + ' cascade')
+    cur.execute('create schema ' + prev)
+    objects = _schema_objects(cur, staging, skip=passthrough)
+    _move_objects(cur, objects, staging, schema, prev)
+    if before_commit is not None:
+        before_commit(cur)
+    con.commit()
+    cur.execute('drop schema ' + staging + ' cascade')
+    con.commit()
+    print(datetime.datetime.now(), len(objects), "objects swapped in, previous generation kept in", prev)
+
+
+def rollback_schema(con, schema, before_commit=None):
+    """Swap the objects kept in the _prev schema back into the live schema (and the current ones into _prev)."""
+    prev = prev_schema(schema)
+    swap = schema + '_rollback'
+    cur = con.cursor()
+    cur.execute('select count(*) from pg_namespace where nspname = %s', (prev,))
+    if not cur.fetchone()[0]:
+        raise ValueError('no previous generation in schema ' + prev)
+    cur.execute('drop schema if exists ' + swap + ' cascade')
+    cur.execute('create schema ' + swap)
+    objects = _schema_objects(cur, prev)
+    _move_objects(cur, objects, prev, schema, swap)
+    cur.execute('drop schema ' + prev)
+    cur.execute('alter schema ' + swap + ' rename to ' + prev)
+    if before_commit is not None:
+        before_commit(cur)
+    con.commit()
+    print(datetime.datetime.now(), len(objects), "objects rolled back into", schema)
+
+
+def prepare_staging_file(con, dbfilename, keep=False):
+    """
+    Copy the live sqlite database (open on con) to the staging file the build will write to.  With keep=True an
+    existing staging file is reused instead.
+    """
+    staging = staging_file(dbfilename)
+    if keep and os.path.exists(staging):
+        print(datetime.datetime.now(), "continuing in", staging)
+        return staging
+    if os.path.exists(staging):
+        os.remove(staging)
+    print(datetime.datetime.now(), "copying", dbfilename,
+          "(%d bytes, UMLS tables included) to" % os.path.getsize(dbfilename), staging)
+    dst = sqlite3.connect(staging)
+    con.backup(dst)
+    dst.close()
+    return staging
+
+
+def swap_staging_file(dbfilename):
+    """Rename the staging file over the live one; the live file stays reachable as .prev."""
+    staging = staging_file(dbfilename)
+    prev = prev_file(dbfilename)
+    if os.path.exists(prev):
+        os.remove(prev)
+    if os.path.exists(dbfilename):
+        os.link(dbfilename, prev)
+    os.replace(staging, dbfilename)
+    print(datetime.datetime.now(), "swapped", staging, "into", dbfilename, "previous generation kept in", prev)
+
+
+def rollback_file(dbfilename):
+    prev = prev_file(dbfilename)
+    if not os.path.exists(prev):
+        raise ValueError('no previous generation in ' + prev)
+    swap = dbfilename + '.rollback'
+    if os.path.exists(swap):
+        os.remove(swap)
+    os.link(dbfilename, swap)
+    os.replace(prev, dbfilename)
+    os.replace(swap, prev)
+    print(datetime.datetime.now(), prev, "rolled back into", dbfilename)
@@ -0,0 +1,132 @@
+"""
+Load test for mapping_service.py.
+
+Sends batched /descendants, /ancestors or /is_a requests from concurrent clients, each on its own keep-alive
+session, and reports throughput, latency percentiles, errors and the service's cache hit rate.  Codes are drawn
+from the same database or artifact the service reads, with a hot set that --hot_fraction of the lookups go to
+(real traffic keeps asking about the same concepts, which is what the result cache is for).  Without --url the
+service is started in-process on a free port.
+
+    python mapping_loadtest.py --artifact composite.tc --concurrency 16 --requests 2000 --batch_size 50
+    python mapping_loadtest.py --dbfilename composite.sqlite --url http://127.0.0.1:8770 --endpoint ancestors
+"""
+import argparse
+import datetime
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import mapping_service
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def sample_codes(onto, n, rng, prefix=None):
+    codes = [c for c in onto.codes if prefix is None or c.startswith(prefix)]
+    return rng.sample(codes, min(n, len(codes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the batched mapping service.')
+    mapping_service.add_source_arguments(parser)
+    parser.add_argument('--url', action='store', type=str, required=False,
+                        help='service to test; by default one is started in-process on the given source')
+    parser.add_argument('--endpoint', action='store', type=str, required=False, default='descendants',
+                        choices=['descendants', 'ancestors', 'is_a'])
+    parser.add_argument('--prefixes', action='store', type=str, required=False,
+                        help='comma-separated ontologies to filter the results to, e.g. SNOMEDCT,ICD10CM')
+    parser.add_argument('--query_prefix', action='store', type=str, required=False, default='C',
+                        help='draw the requested codes from this code prefix')
+    parser.add_argument('--concurrency', action='store', type=int, required=False, default=8)
+    parser.add_argument('--requests', action='store', type=int, required=False, default=1000)
+    parser.add_argument('--batch_size', action='store', type=int, required=False, default=20)
+    parser.add_argument('--hot_codes', action='store', type=int, required=False, default=200)
+    parser.add_argument('--hot_fraction', action='store', type=float, required=False, default=0.8,
+                        help='fraction of the requested codes taken from the hot set')
+    parser.add_argument('--cache_size', action='store', type=int, required=False,
+                        default=mapping_service.DEFAULT_CACHE_SIZE)
+    parser.add_argument('--seed', action='store', type=int, required=False, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    source = mapping_service.source_from_args(args)
+    onto = source.load()
+    hot = sample_codes(onto, args.hot_codes, rng, args.query_prefix)
+    cold = sample_codes(onto, 20 * args.hot_codes, rng, args.query_prefix)
+    ancestors = sample_codes(onto, 50, rng, 'C')
+    prefixes = args.prefixes.split(',') if args.prefixes else None
+    batches = []
+    for i in range(args.requests):
+        codes = [rng.choice(hot) if rng.random() < args.hot_fraction else rng.choice(cold)
+                 for j in range(args.batch_size)]
+        if args.endpoint == 'is_a':
+            batches.append({'codes': codes, 'ancestor': rng.choice(ancestors)})
+        else:
+            batches.append({'codes': codes, 'prefixes': prefixes})
+
+    service = None
+    url = args.url
+    if url is None:
+        mapper = mapping_service.Mapper(source, cache_size=args.cache_size)
+        service = mapping_service.MappingService(mapper).start()
+        url = service.url
+    print(datetime.datetime.now(), 'load testing', url + '/' + args.endpoint, 'with', args.concurrency, 'clients,',
+          args.requests, 'requests of', args.batch_size, 'codes')
+
+    local = threading.local()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def call(body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = session.post(url + '/' + args.endpoint, json=body, timeout=60)
+            response.raise_for_status()
+            response.json()
+        except (requests.RequestException, ValueError) as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = (time.perf_counter() - start) * 1000.0
+        with lock:
+            latencies.append(elapsed)
+
+    stats_before = requests.get(url + '/stats', timeout=60).json()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(call, batches))
+    wall = time.perf_counter() - start
+    stats_after = requests.get(url + '/stats', timeout=60).json()
+    if service is not None:
+        service.stop()
+
+    latencies.sort()
+    print()
+    print('version %s, %d codes' % (stats_after['version'], stats_after['codes']))
+    print('%d requests in %.2fs: %.1f requests/s, %.1f codes/s, %d errors'
+          % (len(latencies), wall, len(latencies) / wall, len(latencies) * args.batch_size / wall, len(errors)))
+    if latencies:
+        print('latency ms: mean %.2f  p50 %.2f  p95 %.2f  p99 %.2f  max %.2f'
+              % (statistics.mean(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95),
+                 percentile(latencies, 0.99), latencies[-1]))
+    hits = stats_after['cache']['hits'] - stats_before['cache']['hits']
+    misses = stats_after['cache']['misses'] - stats_before['cache']['misses']
+    if hits + misses:
+        print('result cache: %d hits, %d misses (%.1f%% hit rate), %d entries'
+              % (hits, misses, 100.0 * hits / (hits + misses), stats_after['cache']['size']))
+    for e in sorted(set(errors))[:5]:
+        print('error:', e)
+
+
+if __name__ == '__main__':
+    main()
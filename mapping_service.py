@@ -0,0 +1,324 @@
+"""
+Local HTTP/JSON service for batched lookups across the composite ontology.
+
+Answers "all SNOMEDCT/ICD10CM/LOINC descendants of these NCIt concepts" and the reverse from an in-memory
+ontology_query.Ontology, loaded from the build database (parents and ncit_tc_all) or opened from a
+--closure_artifact file, so clients send one request per batch instead of one SQL query and connection per code.
+
+    python mapping_service.py --artifact composite.tc --http_port 8770
+    python mapping_service.py --dbfilename composite.sqlite
+    curl -d '{"codes": ["C3262", "C4872"], "prefixes": ["SNOMEDCT", "ICD10CM"]}' http://127.0.0.1:8770/descendants
+
+Endpoints (POST a JSON body, or GET with comma-separated query parameters):
+
+    /descendants, /ancestors  {"codes": [...], "prefixes": [...], "include_self": false}
+                              -> {"version", "results": {code: [codes]}, "unknown": [codes]}
+    /is_a                     {"codes": [...], "ancestor": code} -> {"version", "results": {code: bool}}
+    /version, /stats          active version, cache and request counters
+
+prefixes are code prefixes (C for NCIt) or path table suffixes (ncit, snomedct, ...) and restrict the codes
+returned.  Filtered results are kept in a bounded LRU cache.  The source is checked for a new active version in
+ncit_version_composite (or a replaced artifact file) at most every --version_check seconds; when it changed the
+ontology is reloaded and the cache starts empty.
+"""
+import argparse
+import datetime
+import functools
+import http.server
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import psycopg2
+
+import closure_artifact
+import ontology_query
+import tc_engine
+
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_VERSION_CHECK = 5.0
+MAX_CODES = 10000
+
+
+def prefix_matchers(names):
+    """Code prefixes to match for the requested ontologies; None means no filter."""
+    if not names:
+        return None
+    by_name = {}
+    for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES:
+        match = prefix if prefix == tc_engine.NCIT_PREFIX else prefix + ':'
+        by_name[suffix] = by_name[prefix] = by_name[prefix.lower()] = match
+    try:
+        return tuple(sorted(set(by_name[n] for n in names)))
+    except KeyError as e:
+        raise ValueError('unknown ontology prefix %s' % e)
+
+
+class DbSource:
+    """Ontology loaded from the parents and ncit_tc_all tables; the version is the active one."""
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def version(self):
+        con = self.connect()
+        try:
+            cur = con.cursor()
+            # a rebuild or rollback of the same NCIt version still changes the generation date
+            cur.execute("select version_id, composite_ontology_generation_date from ncit_version_composite "
+                        "where active_version = 'Y'")
+            row = cur.fetchone()
+            return None if row is None else tuple(str(v) for v in row)
+        finally:
+            con.close()
+
+    def load(self):
+        con = self.connect()
+        try:
+            return ontology_query.Ontology.from_db(con)
+        finally:
+            con.close()
+
+
+class ArtifactSource:
+    """Ontology mmapped from a closure artifact; a new file renamed over the old one is a new version."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def version(self):
+        st = os.stat(self.path)
+        return st.st_ino, st.st_mtime_ns
+
+    def load(self):
+        return closure_artifact.open_artifact(self.path)
+
+
+class Generation:
+    """One loaded version of the ontology with its result cache."""
+
+    def __init__(self, onto, token, cache_size):
+        self.onto = onto
+        self.token = token
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, relation, code, matchers, include_self):
+        onto = self.onto
+        if relation == 'descendants':
+            codes = onto.descendants(code)
+        else:
+            codes = onto.ancestors(code)
+        if include_self:
+            codes = (code,) + codes
+        if matchers is not None:
+            codes = tuple(c for c in codes if c.startswith(matchers))
+        return codes
+
+
+class Mapper:
+    """Batched lookups over the current generation, reloading it when the source changes."""
+
+    def __init__(self, source, cache_size=DEFAULT_CACHE_SIZE, version_check=DEFAULT_VERSION_CHECK):
+        self.source = source
+        self.cache_size = cache_size
+        self.version_check = version_check
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reloads = 0
+        self.reloading = False
+        self.checked = time.monotonic()
+        self.generation = self._load(source.version())
+
+    def _load(self, token):
+        print(datetime.datetime.now(), "loading ontology")
+        onto = self.source.load()
+        print(datetime.datetime.now(), "loaded version", onto.version, "with", len(onto.codes), "codes")
+        return Generation(onto, token, self.cache_size)
+
+    def current(self):
+        """
+        The generation to answer from.  Once every version_check seconds the calling thread checks the source and
+        reloads it if it changed; other requests keep using the previous generation meanwhile.
+        """
+        with self.lock:
+            self.requests += 1
+            gen = self.generation
+            if self.reloading or time.monotonic() - self.checked < self.version_check:
+                return gen
+            self.checked = time.monotonic()
+            self.reloading = True
+        try:
+            token = self.source.version()
+            if token != gen.token:
+                gen = self._load(token)
+                with self.lock:
+                    self.generation = gen
+                    self.reloads += 1
+        except Exception as e:
+            print(datetime.datetime.now(), "version check failed, still serving", gen.onto.version, "--", e)
+        finally:
+            self.reloading = False
+        return gen
+
+    def related(self, relation, codes, prefixes=None, include_self=False):
+        matchers = prefix_matchers(prefixes)
+        gen = self.current()
+        results = {}
+        unknown = []
+        for code in codes:
+            if code in gen.onto:
+                results[code] = list(gen.lookup(relation, code, matchers, include_self))
+            else:
+                unknown.append(code)
+        return {'version': gen.onto.version, 'results': results, 'unknown': unknown}
+
+    def is_a(self, codes, ancestor):
+        gen = self.current()
+        return {'version': gen.onto.version, 'results': dict(zip(codes, gen.onto.is_a_batch(codes, ancestor)))}
+
+    def stats(self):
+        gen = self.generation
+        info = gen.lookup.cache_info()
+        return {'version': gen.onto.version, 'codes': len(gen.onto.codes), 'requests': self.requests,
+                'reloads': self.reloads, 'cache': {'hits': info.hits, 'misses': info.misses,
+                                                   'size': info.currsize, 'max_size': info.maxsize}}
+
+
+class MappingService:
+
+    def __init__(self, mapper, host='127.0.0.1', port=0):
+        self.mapper = mapper
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes; with Nagle on, keep-alive clients wait for delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(parsed.query)
+                params = {k: v[0].split(',') if k in ('codes', 'prefixes') else v[0] for k, v in query.items()}
+                if 'include_self' in params:
+                    params['include_self'] = params['include_self'].lower() in ('1', 'true', 'yes')
+                service.handle(self, parsed.path, params)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    params = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    service.reply(self, 400, {'error': 'request body is not JSON'})
+                    return
+                service.handle(self, urllib.parse.urlparse(self.path).path, params)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def reply(self, request, status, body):
+        data = json.dumps(body).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def handle(self, request, path, params):
+        path = path.rstrip('/')
+        try:
+            if path in ('/descendants', '/ancestors'):
+                codes = params.get('codes') or []
+                if len(codes) > MAX_CODES:
+                    raise ValueError('at most %d codes per request' % MAX_CODES)
+                body = self.mapper.related(path[1:], codes, params.get('prefixes'),
+                                           bool(params.get('include_self', False)))
+            elif path == '/is_a':
+                codes = params.get('codes') or []
+                if len(codes) > MAX_CODES:
+                    raise ValueError('at most %d codes per request' % MAX_CODES)
+                if not params.get('ancestor'):
+                    raise ValueError('ancestor is required')
+                body = self.mapper.is_a(codes, params['ancestor'])
+            elif path == '/version':
+                body = {'version': self.mapper.current().onto.version}
+            elif path == '/stats':
+                body = self.mapper.stats()
+            else:
+                self.reply(request, 404, {'error': 'unknown endpoint ' + path})
+                return
+        except (ValueError, TypeError, AttributeError) as e:
+            self.reply(request, 400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.reply(request, 500, {'error': '%s %s' % (type(e).__name__, e)})
+            return
+        self.reply(request, 200, body)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_source_arguments(parser):
+    parser.add_argument('--dbname', action='store', type=str, required=False)
+    parser.add_argument('--host', action='store', type=str, required=False)
+    parser.add_argument('--user', action='store', type=str, required=False)
+    parser.add_argument('--password', action='store', type=str, required=False)
+    parser.add_argument('--port', action='store', type=str, required=False)
+    parser.add_argument('--schema', action='store', type=str, required=False)
+    parser.add_argument('--dbfilename', action='store', type=str, required=False)
+    parser.add_argument('--artifact', action='store', type=str, required=False,
+                        help='serve from a build_unified_tc.py --closure_artifact file instead of the database')
+
+
+def source_from_args(args):
+    if args.artifact is not None:
+        return ArtifactSource(args.artifact)
+    if args.dbfilename is not None:
+        return DbSource(lambda: sqlite3.connect(args.dbfilename))
+    return DbSource(lambda: psycopg2.connect(database=args.dbname, user=args.user, host=args.host, port=args.port,
+                                             password=args.password,
+                                             options="-c search_path={}".format(args.schema)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve batched descendant/ancestor/is_a lookups over the composite '
+                                                 'ontology as HTTP/JSON.')
+    add_source_arguments(parser)
+    parser.add_argument('--bind', action='store', type=str, required=False, default='127.0.0.1')
+    parser.add_argument('--http_port', action='store', type=int, required=False, default=8770)
+    parser.add_argument('--cache_size', action='store', type=int, required=False, default=DEFAULT_CACHE_SIZE,
+                        help='number of filtered lookup results kept')
+    parser.add_argument('--version_check', action='store', type=float, required=False,
+                        default=DEFAULT_VERSION_CHECK, help='seconds between checks for a new active version')
+    args = parser.parse_args()
+    mapper = Mapper(source_from_args(args), cache_size=args.cache_size, version_check=args.version_check)
+    service = MappingService(mapper, host=args.bind, port=args.http_port)
+    print(datetime.datetime.now(), 'mapping service for version', mapper.generation.onto.version, 'at', service.url)
+    try:
+        service.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,219 @@
+"""
+In-memory query library over the composite ontology built by build_unified_tc.py.
+
+The parents and ncit_tc_all tables are loaded once into compact structures: codes are interned to integer ids,
+and the direct parent/child edges and the full ancestor/descendant lists are held as CSR arrays (an offsets
+array plus one sorted id array per relation).  Lookups are array slices and binary searches instead of a
+database round trip, and the decoded results for hot concepts are kept in an LRU cache.
+
+    onto = Ontology.from_db(con)          # or Ontology.load('composite.npz') after onto.save(...)
+                                          # or closure_artifact.open_artifact('composite.tc'), shared via mmap
+    onto.is_a('SNOMEDCT:363346000', 'C3262')
+    onto.is_a_batch(['ICD10CM:C50.911', 'LOINC:1234-5'], 'C3262')
+    onto.ancestors_batch(['C4872', 'C3262'])
+"""
+import functools
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 65536
+
+
+def csr(src, dst, n):
+    """Offsets and sorted, de-duplicated neighbour ids for the edges src[i] -> dst[i] over n nodes."""
+    if len(src):
+        keys = np.unique(src.astype(np.int64) * n + dst)
+        src = (keys // n).astype(np.int32)
+        dst = (keys % n).astype(np.int32)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+    return offsets, dst.astype(np.int32)
+
+
+def bfs_depth(child_offsets, child_ids, n, roots):
+    """Shortest number of edges from any root to each node (-1 where unreachable)."""
+    depth = np.full(n, -1, dtype=np.int32)
+    frontier = np.asarray(roots, dtype=np.int64)
+    depth[frontier] = 0
+    level = 0
+    while len(frontier):
+        level += 1
+        starts = child_offsets[frontier]
+        ends = child_offsets[frontier + 1]
+        nxt = np.unique(np.concatenate([child_ids[s:e] for s, e in zip(starts, ends)]))
+        nxt = nxt[depth[nxt] < 0]
+        depth[nxt] = level
+        frontier = nxt.astype(np.int64)
+    return depth
+
+
+class Ontology:
+
+    def __init__(self, codes, parent_edges, closure_pairs, version=None, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        codes is the list of interned codes; parent_edges and closure_pairs are (child/descendant ids,
+        parent/ancestor ids) array pairs.  Reflexive closure pairs are ignored.
+        """
+        self.codes = list(codes)
+        self.ids = {c: i for i, c in enumerate(self.codes)}
+        self.version = version
+        n = len(self.codes)
+        child, parent = (np.asarray(a, dtype=np.int32) for a in parent_edges)
+        desc, anc = (np.asarray(a, dtype=np.int32) for a in closure_pairs)
+        keep = desc != anc
+        desc, anc = desc[keep], anc[keep]
+        self.parent_offsets, self.parent_ids = csr(child, parent, n)
+        self.child_offsets, self.child_ids = csr(parent, child, n)
+        self.anc_offsets, self.anc_ids = csr(desc, anc, n)
+        self.desc_offsets, self.desc_ids = csr(anc, desc, n)
+        roots = np.flatnonzero(np.diff(self.parent_offsets) == 0)
+        self.depths = bfs_depth(self.child_offsets, self.child_ids, n, roots)
+        self._init_cache(cache_size)
+
+    def _init_cache(self, cache_size):
+        self.cache_size = cache_size
+        self._ancestors = functools.lru_cache(maxsize=cache_size)(self._decode_ancestors)
+        self._descendants = functools.lru_cache(maxsize=cache_size)(self._decode_descendants)
+
+    @classmethod
+    def from_db(cls, con, cache_size=DEFAULT_CACHE_SIZE, version=None):
+        """Load parents and ncit_tc_all; version defaults to the active one in ncit_version_composite."""
+        cur = con.cursor()
+        ids = {}
+        codes = []
+
+        def intern(code):
+            i = ids.get(code)
+            if i is None:
+                i = ids[code] = len(codes)
+                codes.append(code)
+            return i
+
+        def load(sql):
+            cur.execute(sql)
+            a = []
+            b = []
+            for x, y in cur:
+                a.append(intern(x))
+                b.append(intern(y))
+            return np.array(a, dtype=np.int32), np.array(b, dtype=np.int32)
+
+        parent_edges = load('select concept, parent from parents')
+        closure_pairs = load('select descendant, parent from ncit_tc_all where parent <> descendant')
+        if version is None:
+            cur.execute("select version_id from ncit_version_composite where active_version = 'Y'")
+            row = cur.fetchone()
+            version = row[0] if row else None
+        return cls(codes, parent_edges, closure_pairs, version=version, cache_size=cache_size)
+
+    def save(self, path):
+        """Write the structures to an .npz file that load() can read back without touching the database."""
+        np.savez(path,
+                 codes=np.frombuffer('\n'.join(self.codes).encode('utf-8'), dtype=np.uint8),
+                 version=np.array([self.version or '']),
+                 parent_offsets=self.parent_offsets, parent_ids=self.parent_ids,
+                 child_offsets=self.child_offsets, child_ids=self.child_ids,
+                 anc_offsets=self.anc_offsets, anc_ids=self.anc_ids,
+                 desc_offsets=self.desc_offsets, desc_ids=self.desc_ids,
+                 depths=self.depths)
+
+    @classmethod
+    def load(cls, path, cache_size=DEFAULT_CACHE_SIZE):
+        data = np.load(path)
+        onto = cls.__new__(cls)
+        raw = data['codes'].tobytes().decode('utf-8')
+        onto.codes = raw.split('\n') if raw else []
+        onto.ids = {c: i for i, c in enumerate(onto.codes)}
+        onto.version = str(data['version'][0]) or None
+        for name in ('parent_offsets', 'parent_ids', 'child_offsets', 'child_ids', 'anc_offsets', 'anc_ids',
+                     'desc_offsets', 'desc_ids', 'depths'):
+            setattr(onto, name, data[name])
+        onto._init_cache(cache_size)
+        return onto
+
+    def _slice(self, offsets, ids, i):
+        return ids[offsets[i]:offsets[i + 1]]
+
+    def _decode(self, id_array):
+        codes = self.codes
+        return tuple(codes[i] for i in id_array.tolist())
+
+    def _decode_ancestors(self, i):
+        return self._decode(self._slice(self.anc_offsets, self.anc_ids, i))
+
+    def _decode_descendants(self, i):
+        return self._decode(self._slice(self.desc_offsets, self.desc_ids, i))
+
+    def __contains__(self, code):
+        return code in self.ids
+
+    def __len__(self):
+        return len(self.codes)
+
+    def is_a(self, code, ancestor):
+        """True if ancestor subsumes code (or is code), i.e. (ancestor, code) is a row of ncit_tc_all."""
+        i = self.ids.get(code)
+        a = self.ids.get(ancestor)
+        if i is None or a is None:
+            return False
+        if i == a:
+            return True
+        anc = self._slice(self.anc_offsets, self.anc_ids, i)
+        k = np.searchsorted(anc, a)
+        return bool(k < len(anc) and anc[k] == a)
+
+    def ancestors(self, code):
+        """Every code above code in the closure, not including code itself."""
+        i = self.ids.get(code)
+        return () if i is None else self._ancestors(i)
+
+    def descendants(self, code):
+        """Every code below code in the closure, not including code itself."""
+        i = self.ids.get(code)
+        return () if i is None else self._descendants(i)
+
+    def direct_parents(self, code):
+        i = self.ids.get(code)
+        return () if i is None else self._decode(self._slice(self.parent_offsets, self.parent_ids, i))
+
+    def direct_children(self, code):
+        i = self.ids.get(code)
+        return () if i is None else self._decode(self._slice(self.child_offsets, self.child_ids, i))
+
+    def depth(self, code):
+        """Shortest number of parent edges from code up to a root, None for unknown codes."""
+        i = self.ids.get(code)
+        if i is None or self.depths[i] < 0:
+            return None
+        return int(self.depths[i])
+
+    def is_a_batch(self, codes, ancestor):
+        """is_a(code, ancestor) for each of codes, answered with one vectorised lookup."""
+        a = self.ids.get(ancestor)
+        if a is None:
+            return [False] * len(codes)
+        idx = np.array([self.ids.get(c, -1) for c in codes], dtype=np.int64)
+        desc = self._slice(self.desc_offsets, self.desc_ids, a)
+        if len(desc):
+            pos = np.minimum(np.searchsorted(desc, idx), len(desc) - 1)
+            hit = desc[pos] == idx
+        else:
+            hit = np.zeros(len(idx), dtype=bool)
+        hit |= idx == a
+        hit &= idx >= 0
+        return hit.tolist()
+
+    def ancestors_batch(self, codes):
+        return {c: self.ancestors(c) for c in codes}
+
+    def descendants_batch(self, codes):
+        return {c: self.descendants(c) for c in codes}
+
+    def direct_parents_batch(self, codes):
+        return {c: self.direct_parents(c) for c in codes}
+
+    def depth_batch(self, codes):
+        return {c: self.depth(c) for c in codes}
+
+    def cache_info(self):
+        return {'ancestors': self._ancestors.cache_info(), 'descendants': self._descendants.cache_info()}
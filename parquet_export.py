@@ -0,0 +1,241 @@
+"""
+Columnar export of the composite ontology tables.
+
+Writes ncit, parents, ncit_tc_all and ncit_tc_with_path_all as Parquet files partitioned by the ontology of each
+row's code (the descendant for the closure tables, the concept for parents), in hive layout:
+
+    <dir>/manifest.json
+    <dir>/ncit_tc_all/ontology=ncit/part-0.parquet
+    <dir>/ncit_tc_all/ontology=snomedct/part-0.parquet
+    ...
+
+Code columns are stored dictionary encoded and read back as dictionary arrays.  The manifest records the active
+NCIt version from ncit_version_composite and the files and row counts of every table, so analytics jobs can scan
+the closure without going through the database, e.g.
+
+    pyarrow.dataset.dataset('<dir>/ncit_tc_all', partitioning='hive').to_table(filter=ds.field('ontology') == 'loinc')
+    duckdb: select * from read_parquet('<dir>/ncit_tc_all/*/*.parquet', hive_partitioning = true) where ...
+
+Each export is written to <dir>.v<timestamp>.partial next to <dir> and renamed to <dir>.v<timestamp> when complete.
+<dir> itself is a symlink that is then flipped to the new directory in one rename, so readers resolve it to either
+the previous or the new export, never a half-written one.  The previous export is kept for readers still scanning
+it, older ones are removed.  (A plain directory left at <dir> by an older export is moved aside once to make room
+for the link; any other non-empty directory or file there is refused.)  Only directories named exactly like
+<dir>.v<timestamp> are ever rotated out.
+"""
+import datetime
+import json
+import os
+import re
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import bulk_load
+import path_codec
+import tc_engine
+
+MANIFEST = 'manifest.json'
+VERSION_SUFFIX = '.v'
+VERSION_FORMAT = '%Y%m%dT%H%M%S%f'
+# versioned export directories kept, including the live one
+KEEP_VERSIONS = 2
+PARTITION_COLUMN = 'ontology'
+OTHER_PARTITION = 'other'
+BATCH_SIZE = 100000
+ROW_GROUP_SIZE = 1000000
+
+# table -> (column deciding the partition, code columns stored dictionary encoded)
+EXPORT_TABLES = {
+    'ncit': ('code', ['code']),
+    'parents': ('concept', ['concept', 'parent']),
+    'ncit_tc_all': ('descendant', ['parent', 'descendant']),
+    'ncit_tc_with_path_all': ('descendant', ['parent', 'descendant']),
+}
+
+INTEGER_COLUMNS = {'index': pa.int64(), 'level': pa.int32()}
+
+
+def partition_prefixes():
+    """(partition, code prefix) in matching order; the UMLS prefixes go first since NCIt's is just 'C'."""
+    umls = [(suffix, prefix + ':') for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES if prefix != tc_engine.NCIT_PREFIX]
+    return umls + [(suffix, prefix) for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES
+                   if prefix == tc_engine.NCIT_PREFIX]
+
+
+def column_type(name, code_columns):
+    if name in code_columns:
+        return pa.dictionary(pa.int32(), pa.string())
+    return INTEGER_COLUMNS.get(name, pa.string())
+
+
+def split_by_partition(table, column, prefixes):
+    """{partition: rows of table} by the prefix of column."""
+    codes = table.column(column)
+    if pa.types.is_dictionary(codes.type):
+        codes = codes.cast(pa.string())
+    remaining = pa.array([True] * len(table))
+    parts = {}
+    for name, prefix in prefixes:
+        mask = pc.and_(remaining, pc.fill_null(pc.starts_with(codes, prefix), False))
+        remaining = pc.and_(remaining, pc.invert(mask))
+        parts[name] = table.filter(mask)
+    parts[OTHER_PARTITION] = table.filter(remaining)
+    return {name: part for name, part in parts.items() if len(part)}
+
+
+class PartitionedWriter:
+    """One Parquet file per partition, buffered into row groups of ROW_GROUP_SIZE rows."""
+
+    def __init__(self, table_dir, schema, code_columns):
+        self.table_dir = table_dir
+        self.schema = schema
+        self.code_columns = code_columns
+        self.writers = {}
+        self.buffers = {}
+        self.rows = {}
+
+    def write(self, name, table):
+        self.buffers.setdefault(name, []).append(table)
+        self.rows[name] = self.rows.get(name, 0) + len(table)
+        if sum(len(t) for t in self.buffers[name]) >= ROW_GROUP_SIZE:
+            self.flush(name)
+
+    def flush(self, name):
+        if not self.buffers.get(name):
+            return
+        if name not in self.writers:
+            part_dir = os.path.join(self.table_dir, PARTITION_COLUMN + '=' + name)
+            os.makedirs(part_dir, exist_ok=True)
+            self.writers[name] = pq.ParquetWriter(os.path.join(part_dir, 'part-0.parquet'), self.schema,
+                                                  use_dictionary=self.code_columns, compression='zstd')
+        self.writers[name].write_table(pa.concat_tables(self.buffers.pop(name)), row_group_size=ROW_GROUP_SIZE)
+
+    def close(self):
+        for name in list(self.buffers):
+            self.flush(name)
+        for writer in self.writers.values():
+            writer.close()
+
+
+def export_table(con, table, table_dir, postgres, schema=None):
+    """Stream one table into partitioned Parquet files.  Returns its manifest entry."""
+    partition_by, code_columns = EXPORT_TABLES[table]
+    prefixes = partition_prefixes()
+    cur = con.cursor(name='parquet_export') if postgres else con.cursor()
+    cur.execute('select * from ' + (schema + '.' if schema else '') + table)
+    # a server-side cursor only has a description once the first rows are fetched
+    rows = cur.fetchmany(BATCH_SIZE)
+    columns = [d[0] for d in cur.description]
+    arrow_schema = pa.schema([(c, column_type(c, code_columns)) for c in columns])
+    writer = PartitionedWriter(table_dir, arrow_schema, [c for c in columns if c in code_columns])
+    while rows:
+        values = list(zip(*rows))
+        arrays = []
+        for i, field in enumerate(arrow_schema):
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values[i], type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values[i], type=field.type))
+        batch = pa.Table.from_arrays(arrays, schema=arrow_schema)
+        for name, part in split_by_partition(batch, partition_by, prefixes).items():
+            writer.write(name, part)
+        rows = cur.fetchmany(BATCH_SIZE)
+    cur.close()
+    writer.close()
+    partitions = {}
+    for name in sorted(writer.rows):
+        path = os.path.join(PARTITION_COLUMN + '=' + name, 'part-0.parquet')
+        partitions[name] = {'path': path, 'rows': writer.rows[name],
+                            'bytes': os.path.getsize(os.path.join(table_dir, path))}
+    return {'partitioned_by': partition_by, 'dictionary_columns': writer.code_columns, 'columns': columns,
+            'rows': sum(writer.rows.values()), 'partitions': partitions}
+
+
+def active_version(cur, version_table):
+    cur.execute('select version_id from ' + version_table + " where active_version = 'Y'")
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def export_tables(con, out_dir, postgres, version_table='ncit_version_composite', schema=None,
+                  tables=tuple(EXPORT_TABLES)):
+    """
+    Export tables (those that exist) to out_dir with a manifest.  schema qualifies the table names, for a
+    connection whose search_path no longer points at them (after a blue/green swap).  Returns the manifest.
+    """
+    cur = con.cursor()
+    path_codec.register_if_compact(con, postgres)
+    out_dir = os.path.abspath(out_dir)
+    check_publishable(out_dir)
+    for stale in export_versions(out_dir, partial=True):
+        shutil.rmtree(stale, ignore_errors=True)
+    version_dir = out_dir + VERSION_SUFFIX + datetime.datetime.now().strftime(VERSION_FORMAT)
+    partial = version_dir + '.partial'
+    os.makedirs(partial)
+    manifest = {'ncit_version': active_version(cur, version_table),
+                'exported_at': datetime.datetime.now().isoformat(),
+                'format': 'parquet', 'partitioning': 'hive', 'partition_column': PARTITION_COLUMN,
+                'partition_prefixes': dict(partition_prefixes()), 'tables': {}}
+    for table in tables:
+        name = table if schema is None else schema + '.' + table
+        # to_regclass sees views as well; ncit_tc_with_path_all is one after compaction
+        if not (bulk_load.table_exists(cur, name, postgres) or
+                (not postgres and bulk_load.view_exists(cur, table, postgres))):
+            continue
+        print(datetime.datetime.now(), "exporting", table, "to Parquet")
+        entry = export_table(con, table, os.path.join(partial, table), postgres, schema=schema)
+        manifest['tables'][table] = dict(entry, path=table)
+        print(datetime.datetime.now(), entry['rows'], "rows of", table, "written in", len(entry['partitions']),
+              "partitions")
+    with open(os.path.join(partial, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(partial, version_dir)
+    publish(version_dir, out_dir)
+    return manifest
+
+
+def export_versions(out_dir, partial=False):
+    """
+    The versioned export directories of out_dir, oldest first: exactly <out_dir>.v<VERSION_FORMAT>, or the
+    .partial ones with partial=True.  Nothing else next to out_dir is ever rotated or removed.
+    """
+    parent, name = os.path.split(out_dir)
+    pattern = re.compile(re.escape(name + VERSION_SUFFIX) + r'\d{8}T\d{12}' + (r'\.partial' if partial else '') + '$')
+    return sorted(os.path.join(parent, entry) for entry in os.listdir(parent or '.') if pattern.match(entry))
+
+
+def check_publishable(out_dir):
+    """Refuse to replace anything at out_dir but a symlink, an empty directory or an earlier export directory."""
+    if os.path.islink(out_dir) or not os.path.lexists(out_dir):
+        return
+    if os.path.isdir(out_dir) and not os.listdir(out_dir):
+        return
+    if not os.path.isdir(out_dir) or not os.path.isfile(os.path.join(out_dir, MANIFEST)):
+        raise ValueError(out_dir + ' exists and is not a Parquet export (no ' + MANIFEST + '); '
+                         'choose another --parquet_dir or move it away')
+
+
+def publish(version_dir, out_dir):
+    """Point the out_dir symlink at version_dir atomically and remove all but the KEEP_VERSIONS newest exports."""
+    check_publishable(out_dir)
+    if os.path.isdir(out_dir) and not os.path.islink(out_dir) and not os.listdir(out_dir):
+        os.rmdir(out_dir)
+    elif os.path.isdir(out_dir) and not os.path.islink(out_dir):
+        # an export written before exports were versioned becomes the version it was written at
+        stamp = datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(out_dir, MANIFEST)))
+        os.rename(out_dir, out_dir + VERSION_SUFFIX + stamp.strftime(VERSION_FORMAT))
+    link = version_dir + '.link'
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, out_dir)
+    current = os.path.realpath(out_dir)
+    for old in export_versions(out_dir)[:-KEEP_VERSIONS]:
+        if os.path.realpath(old) != current:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, MANIFEST)) as f:
+        return json.load(f)
@@ -0,0 +1,201 @@
+"""
+Compact storage for ncit_tc_with_path_all.
+
+Concept codes are interned into the concept_id table (ids handed out in topological order of the parents graph,
+so codes that sit next to each other on a path get nearby ids) and every path is stored as a varint blob: the
+first id as is, then the zigzag-encoded delta to the next id.  ncit_tc_with_path_all becomes a view over
+ncit_tc_path_compact that decodes the blob back to the usual pipe-joined text through decode_tc_path().
+
+On Postgres decode_tc_path is a SQL function created next to the view.  On sqlite it is a Python function, so every
+connection that reads the view has to register it first; without it each query fails with "no such function:
+decode_tc_path".  Scripts that may open a compacted sqlite database call
+
+    path_codec.register_if_compact(con, postgres)
+
+right after connecting (check_mcode_coverage.py, parquet_export, physical_layout do).
+"""
+import datetime
+
+import bulk_load
+import tc_engine
+
+COMPACT_TABLE = 'ncit_tc_path_compact'
+PATH_VIEW = 'ncit_tc_with_path_all'
+
+PG_FUNCTIONS = """
+create or replace function decode_tc_path_ids(p bytea) returns int[] language plpgsql immutable strict as $$
+declare
+  ids int[] := '{}';
+  i int := 0;
+  n int := length(p);
+  b int;
+  v bigint;
+  shift int;
+  prev bigint := 0;
+begin
+  while i < n loop
+    v := 0;
+    shift := 0;
+    loop
+      b := get_byte(p, i);
+      i := i + 1;
+      v := v | ((b & 127)::bigint << shift);
+      exit when b < 128;
+      shift := shift + 7;
+    end loop;
+    if array_length(ids, 1) is null then
+      prev := v;
+    else
+      prev := prev + ((v >> 1) # (-(v & 1)));
+    end if;
+    ids := ids || prev::int;
+  end loop;
+  return ids;
+end $$;
+
+create or replace function decode_tc_path(p bytea) returns text language sql stable strict as $$
+  select string_agg(c.code, '|' order by u.ord)
+  from unnest(decode_tc_path_ids(p)) with ordinality u(id, ord) join concept_id c on c.id = u.id
+$$;
+"""
+
+VIEW_SQL = """
+create view ncit_tc_with_path_all as
+select p.code as parent, d.code as descendant, t.level, decode_tc_path(t.path) as path
+from ncit_tc_path_compact t
+join concept_id p on p.id = t.parent_id
+join concept_id d on d.id = t.descendant_id
+"""
+
+
+def encode_ids(ids):
+    """Varint-encode the first id, then the zigzag delta to each following id."""
+    out = bytearray()
+    prev = None
+    for i in ids:
+        if prev is None:
+            v = i
+        else:
+            d = i - prev
+            v = (d << 1) if d >= 0 else ((-d << 1) - 1)
+        prev = i
+        while v >= 0x80:
+            out.append((v & 0x7f) | 0x80)
+            v >>= 7
+        out.append(v)
+    return bytes(out)
+
+
+def decode_ids(blob):
+    ids = []
+    v = 0
+    shift = 0
+    for b in blob:
+        v |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        if ids:
+            ids.append(ids[-1] + ((v >> 1) ^ -(v & 1)))
+        else:
+            ids.append(v)
+        v = 0
+        shift = 0
+    return ids
+
+
+class PathCodec:
+    """Maps between concept codes, their ids and encoded paths."""
+
+    def __init__(self, codes):
+        self.codes = list(codes)
+        self.ids = {c: i for i, c in enumerate(self.codes)}
+
+    @classmethod
+    def from_db(cls, cur):
+        cur.execute('select id, code from concept_id order by id')
+        return cls(code for i, code in cur)
+
+    def encode(self, path):
+        return encode_ids([self.ids[c] for c in path.split('|')])
+
+    def decode(self, blob):
+        codes = self.codes
+        return '|'.join(codes[i] for i in decode_ids(bytes(blob)))
+
+
+def register_functions(con, codec=None):
+    """Register decode_tc_path on a sqlite connection so the ncit_tc_with_path_all view can be queried."""
+    if codec is None:
+        codec = PathCodec.from_db(con.cursor())
+    con.create_function('decode_tc_path', 1, lambda blob: None if blob is None else codec.decode(blob),
+                        deterministic=True)
+    return codec
+
+
+def register_if_compact(con, postgres):
+    """register_functions() on a sqlite connection whose ncit_tc_with_path_all is the compact view."""
+    if postgres or not bulk_load.view_exists(con.cursor(), PATH_VIEW, postgres):
+        return None
+    return register_functions(con)
+
+
+def drop_compact_tables(cur, postgres):
+    """Undo a previous compaction so ncit_tc_with_path_all can be rebuilt as a plain table."""
+    if bulk_load.view_exists(cur, PATH_VIEW, postgres):
+        cur.execute('drop view ' + PATH_VIEW)
+    cur.execute('drop table if exists ' + COMPACT_TABLE)
+
+
+def concept_order(cur):
+    """Every code in ncit_tc_all, in topological order of the parents graph where it is part of it."""
+    graph = tc_engine.ParentGraph.from_db(cur)
+    ordered = [graph.codes[v] for v in tc_engine.topo_order(graph.parents, range(len(graph.codes)))]
+    seen = set(ordered)
+    cur.execute('select distinct parent from ncit_tc_all')
+    extra = sorted(r[0] for r in cur if r[0] not in seen)
+    return ordered + extra
+
+
+def compact_path_table(con, postgres, create_table='create table'):
+    """
+    Re-encode the ncit_tc_with_path_all table into ncit_tc_path_compact and replace it with a decoding view.
+    create_table is the statement prefix for the new tables (bulk_load.create_table_sql).
+    """
+    cur = con.cursor()
+    print(datetime.datetime.now(), "building concept ids for compact paths")
+    codec = PathCodec(concept_order(cur))
+    cur.execute('drop table if exists concept_id')
+    cur.execute(create_table + ' concept_id (id int primary key, code text unique)')
+    bulk_load.copy_rows(cur, 'concept_id', ('id', 'code'), enumerate(codec.codes), postgres)
+
+    cur.execute('drop table if exists ' + COMPACT_TABLE)
+    cur.execute(create_table + ' ' + COMPACT_TABLE + ' (parent_id int, descendant_id int, level int, path ' +
+                ('bytea' if postgres else 'blob') + ')')
+    con.commit()
+
+    print(datetime.datetime.now(), "encoding paths into", COMPACT_TABLE)
+    sizes = [0, 0]
+    read_cur = con.cursor(name='path_reader') if postgres else con.cursor()
+    read_cur.execute('select parent, descendant, level, path from ' + PATH_VIEW)
+
+    def rows():
+        ids = codec.ids
+        for parent, descendant, level, path in read_cur:
+            blob = codec.encode(path)
+            sizes[0] += len(path)
+            sizes[1] += len(blob)
+            yield ids[parent], ids[descendant], level, blob
+
+    n = bulk_load.copy_rows(cur, COMPACT_TABLE, ('parent_id', 'descendant_id', 'level', 'path'), rows(), postgres)
+    read_cur.close()
+    print(datetime.datetime.now(), n, "paths encoded,", sizes[0], "bytes of path text stored in", sizes[1], "bytes")
+
+    cur.execute('drop table ' + PATH_VIEW)
+    cur.execute('create index ncit_tc_path_compact_parent on ' + COMPACT_TABLE + '(parent_id)')
+    cur.execute('create index ncit_tc_path_compact_descendant on ' + COMPACT_TABLE + '(descendant_id)')
+    if postgres:
+        cur.execute(PG_FUNCTIONS)
+    cur.execute(VIEW_SQL)
+    con.commit()
+    return codec
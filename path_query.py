@@ -0,0 +1,129 @@
+"""
+On-demand path enumeration for builds made with --skip_paths.
+
+Only parents and ncit_tc_all are kept in the database; the paths between a parent and a descendant are walked
+lazily from the parents graph when somebody asks for them.  The paths produced are the distinct ones that
+ncit_tc_with_path_all would have held for the pair: paths inside one ontology, plus comp paths that end in a
+crosswalk seed edge (see tc_engine) and run upwards through any parent edge above it.
+
+    finder = PathFinder.from_db(con)
+    for path in finder.iter_paths('C3262', 'SNOMEDCT:363346000', max_count=10, max_depth=8):
+        print(path)
+"""
+import tc_engine
+
+
+class PathFinder:
+
+    def __init__(self, graph):
+        self.graph = graph
+        # Duplicate edges only produce duplicate paths, so the walks use de-duplicated adjacency
+        self.parents = [list(dict.fromkeys(ps)) for ps in graph.parents]
+        self.children = [list(dict.fromkeys(cs)) for cs in graph.children()]
+        self._seeds = None
+
+    @classmethod
+    def from_db(cls, con, table='parents'):
+        return cls(tc_engine.ParentGraph.from_db(con.cursor(), table))
+
+    def seed_parents(self, v):
+        """The parents x of v for which x -> v is a comp seed edge."""
+        if self._seeds is None:
+            seeds = {}
+            for x, ys in self.graph.comp_seed_edges().items():
+                for y in ys:
+                    seeds.setdefault(y, []).append(x)
+            self._seeds = seeds
+        return self._seeds.get(v, ())
+
+    def _below(self, top, keep=None):
+        """top and every node under it, optionally only following nodes for which keep is true."""
+        seen = {top}
+        stack = [top]
+        children = self.children
+        while stack:
+            v = stack.pop()
+            for c in children[v]:
+                if c not in seen and (keep is None or keep(c)):
+                    seen.add(c)
+                    stack.append(c)
+        return seen
+
+    def _iter_up(self, start, top, allowed, max_edges, keep=None):
+        """Yield id lists top ... start for every upward walk from start to top through allowed nodes."""
+        if start == top:
+            yield [top]
+            return
+        if max_edges is not None and max_edges < 1:
+            return
+        parents = self.parents
+        trail = [start]
+        stack = [iter(parents[start])]
+        while stack:
+            for p in stack[-1]:
+                if p not in allowed or (keep is not None and not keep(p)):
+                    continue
+                if p == top:
+                    yield [top] + trail[::-1]
+                elif max_edges is None or len(trail) < max_edges:
+                    trail.append(p)
+                    stack.append(iter(parents[p]))
+                    break
+            else:
+                stack.pop()
+                trail.pop()
+
+    def iter_paths(self, parent, descendant, max_count=None, max_depth=None):
+        """
+        Lazily yield the pipe-joined paths from parent down to descendant, at most max_count of them and none
+        longer than max_depth edges.  Unknown codes simply yield nothing.
+        """
+        ids = self.graph.ids
+        codes = self.graph.codes
+        if parent not in ids or descendant not in ids or max_count == 0:
+            return
+        top = ids[parent]
+        bottom = ids[descendant]
+        if top == bottom:
+            yield parent
+            return
+        seen = set()
+
+        def emit(id_path):
+            path = '|'.join(codes[i] for i in id_path)
+            if path in seen:
+                return None
+            seen.add(path)
+            return path
+
+        # Paths inside a single ontology
+        for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES:
+            if parent.startswith(prefix) and descendant.startswith(prefix):
+                in_prefix = lambda v, prefix=prefix: codes[v].startswith(prefix)
+                allowed = self._below(top, in_prefix)
+                if bottom in allowed:
+                    for id_path in self._iter_up(bottom, top, allowed, max_depth, in_prefix):
+                        path = emit(id_path)
+                        if path is not None:
+                            yield path
+                            if max_count is not None and len(seen) >= max_count:
+                                return
+
+        # Composite paths: a seed edge x -> descendant with anything above x
+        seed_parents = self.seed_parents(bottom)
+        if not seed_parents:
+            return
+        allowed = self._below(top)
+        for x in seed_parents:
+            if x not in allowed:
+                continue
+            up_edges = None if max_depth is None else max_depth - 1
+            for id_path in self._iter_up(x, top, allowed, up_edges):
+                path = emit(id_path + [bottom])
+                if path is not None:
+                    yield path
+                    if max_count is not None and len(seen) >= max_count:
+                        return
+
+    def paths(self, parent, descendant, max_count=None, max_depth=None):
+        return list(self.iter_paths(parent, descendant, max_count, max_depth))
@@ -0,0 +1,162 @@
+"""
+Final physical layout of the closure tables for the lookup workload.
+
+The build leaves ncit_tc_all and ncit_tc_with_path_all as heap tables in load order with single-column indexes,
+so every lookup is an index probe followed by scattered table fetches.  finalize_layout() rewrites them:
+
+  sqlite    ncit_tc_all becomes a WITHOUT ROWID table clustered on (parent, descendant) with a (descendant,
+            parent) index, so both directions are answered from one b-tree each.  ncit_tc_with_path_all is
+            reloaded in (parent, descendant) order and indexed on (parent, descendant) and (descendant, parent).
+  Postgres  the same composite indexes (covering for ncit_tc_all), fillfactor 100 on tables and indexes, CLUSTER
+            on the (parent, descendant) index and VACUUM ANALYZE so lookups become index-only scans.
+
+Redundant indexes on the same columns are dropped.  The index names stay the ones the build uses.  Table sizes
+and the latencies of a fixed set of probe queries are measured before and after and returned as a report.
+"""
+import datetime
+import statistics
+import time
+
+import bulk_load
+import path_codec
+
+CLOSURE_TABLE = 'ncit_tc_all'
+PATH_TABLE = 'ncit_tc_with_path_all'
+# older builds indexed ncit_tc_all(parent) twice
+REDUNDANT_INDEXES = ['ncit_tc_parent_all']
+# table -> (index on (parent, descendant), index on (descendant, parent))
+LAYOUT_INDEXES = {
+    CLOSURE_TABLE: ('tc_parent_all_index', 'tc_desc_all_index'),
+    PATH_TABLE: ('ncit_tc_path_parent', 'ncit_tc_path_descendant'),
+}
+DEFAULT_PROBES = 200
+
+
+def relation_bytes(cur, table, postgres):
+    """Bytes used by a table and its indexes, None where sqlite was built without the dbstat table."""
+    if postgres:
+        cur.execute('select pg_total_relation_size(to_regclass(%s))', (table,))
+        return cur.fetchone()[0]
+    try:
+        cur.execute("select sum(pgsize) from dbstat where name = ? or name in "
+                    "(select name from sqlite_master where type = 'index' and tbl_name = ?)", (table, table))
+    except Exception:
+        return None
+    return cur.fetchone()[0]
+
+
+def probe_sample(cur, n):
+    """Codes and (parent, descendant) pairs to probe with, drawn once so before and after see the same ones."""
+    cur.execute('select parent from ' + CLOSURE_TABLE + ' where parent = descendant order by random() limit ' +
+                str(int(n)))
+    codes = [r[0] for r in cur.fetchall()]
+    cur.execute('select parent, descendant from ' + CLOSURE_TABLE + ' where parent <> descendant '
+                'order by random() limit ' + str(int(n)))
+    return codes, cur.fetchall()
+
+
+def probe_queries(has_paths):
+    queries = [
+        ('descendants', 'select descendant from ' + CLOSURE_TABLE + ' where parent = {0}', 'code'),
+        ('ancestors', 'select parent from ' + CLOSURE_TABLE + ' where descendant = {0}', 'code'),
+        ('is_a', 'select 1 from ' + CLOSURE_TABLE + ' where parent = {0} and descendant = {0}', 'pair'),
+    ]
+    if has_paths:
+        queries.append(('paths', 'select level, path from ' + PATH_TABLE + ' where parent = {0} and descendant = {0}',
+                        'pair'))
+    return queries
+
+
+def probe_latencies(cur, postgres, sample, has_paths):
+    """{query: {'median_ms', 'p95_ms'}} over the sample."""
+    p = '%s' if postgres else '?'
+    codes, pairs = sample
+    result = {}
+    for name, sql, kind in probe_queries(has_paths):
+        sql = sql.format(p)
+        args = [(c,) for c in codes] if kind == 'code' else pairs
+        timings = []
+        for a in args:
+            start = time.perf_counter()
+            cur.execute(sql, a)
+            cur.fetchall()
+            timings.append((time.perf_counter() - start) * 1000.0)
+        if timings:
+            timings.sort()
+            result[name] = {'median_ms': round(statistics.median(timings), 4),
+                            'p95_ms': round(timings[int(0.95 * (len(timings) - 1))], 4)}
+    return result
+
+
+def _rebuild_sqlite(cur, table, columns, without_rowid):
+    parent_index, descendant_index = LAYOUT_INDEXES[table]
+    names = ', '.join(c for c, t in columns)
+    ddl = ', '.join(c + ' ' + t for c, t in columns)
+    if without_rowid:
+        ddl += ', primary key (parent, descendant)'
+    cur.execute('drop table if exists ' + table + '_layout')
+    cur.execute('create table ' + table + '_layout (' + ddl + ')' + (' without rowid' if without_rowid else ''))
+    # the rows arrive in key order, so the b-trees are appended to and come out fully packed.  A duplicate
+    # (parent, descendant) pair fails the primary key, as it is an upstream bug and Postgres keeps every row
+    cur.execute('insert into ' + table + '_layout (' + names + ') '
+                'select ' + names + ' from ' + table + ' order by parent, descendant')
+    cur.execute('drop table ' + table)
+    cur.execute('alter table ' + table + '_layout rename to ' + table)
+    if not without_rowid:
+        cur.execute('create index ' + parent_index + ' on ' + table + '(parent, descendant)')
+    cur.execute('create index ' + descendant_index + ' on ' + table + '(descendant, parent)')
+
+
+def _cluster_postgres(cur, table):
+    parent_index, descendant_index = LAYOUT_INDEXES[table]
+    for index in (parent_index, descendant_index):
+        cur.execute('drop index if exists ' + index)
+    cur.execute('alter table ' + table + ' set (fillfactor = 100)')
+    cur.execute('create index ' + parent_index + ' on ' + table + '(parent, descendant) with (fillfactor = 100)')
+    cur.execute('create index ' + descendant_index + ' on ' + table + '(descendant, parent) with (fillfactor = 100)')
+    cur.execute('cluster ' + table + ' using ' + parent_index)
+
+
+def finalize_layout(con, postgres, probes=DEFAULT_PROBES):
+    """Rewrite ncit_tc_all (and ncit_tc_with_path_all when it is a table) for lookups.  Returns the report."""
+    cur = con.cursor()
+    tables = [CLOSURE_TABLE]
+    if bulk_load.table_exists(cur, PATH_TABLE, postgres) and not bulk_load.view_exists(cur, PATH_TABLE, postgres):
+        tables.append(PATH_TABLE)
+    has_paths = bulk_load.table_exists(cur, PATH_TABLE, postgres) or bulk_load.view_exists(cur, PATH_TABLE, postgres)
+    path_codec.register_if_compact(con, postgres)
+    sample = probe_sample(cur, probes)
+    report = {'tables': {t: {'bytes_before': relation_bytes(cur, t, postgres)} for t in tables},
+              'probes_before': probe_latencies(cur, postgres, sample, has_paths)}
+
+    for index in REDUNDANT_INDEXES:
+        cur.execute('drop index if exists ' + index)
+    for table in tables:
+        print(datetime.datetime.now(), "rewriting", table, "in (parent, descendant) order")
+        if postgres:
+            _cluster_postgres(cur, table)
+        elif table == CLOSURE_TABLE:
+            _rebuild_sqlite(cur, table, [('parent', 'text'), ('descendant', 'text')], without_rowid=True)
+        else:
+            _rebuild_sqlite(cur, table, [('parent', 'text'), ('descendant', 'text'), ('level', 'int'),
+                                         ('path', 'text')], without_rowid=False)
+        con.commit()
+    if postgres:
+        # index-only scans need the visibility map that VACUUM sets
+        con.autocommit = True
+        for table in tables:
+            cur.execute('vacuum analyze ' + table)
+        con.autocommit = False
+    else:
+        bulk_load.analyze(con, tables)
+
+    for table in tables:
+        report['tables'][table]['bytes_after'] = relation_bytes(cur, table, postgres)
+    report['probes_after'] = probe_latencies(cur, postgres, sample, has_paths)
+    for table, sizes in report['tables'].items():
+        print(datetime.datetime.now(), table, "bytes before", sizes['bytes_before'], "after", sizes['bytes_after'])
+    for name, before in report['probes_before'].items():
+        after = report['probes_after'][name]
+        print(datetime.datetime.now(), "%s probe median %.3f ms -> %.3f ms, p95 %.3f ms -> %.3f ms"
+              % (name, before['median_ms'], after['median_ms'], before['p95_ms'], after['p95_ms']))
+    return report
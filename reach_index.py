@@ -0,0 +1,195 @@
+"""
+Interval reachability labels for constant-time subsumption checks.
+
+Inside each ontology (the same prefix-restricted subgraphs the path tables are built from) a spanning forest is
+numbered in post order, so every concept owns the interval [lo, post] of its tree subtree.  Descendants that are
+only reachable through a non-tree parent edge are covered by extra merged intervals.  ncit_tc_all is not
+transitive across ontologies (the comp rows stop one level below a crosswalk target), so the cross-ontology
+pairs that the intervals cannot express are kept in a short exception list.  Together they answer exactly the
+same question as a lookup in ncit_tc_all:
+
+  concept_reach_label(code, post, lo)           -- code's post-order number and own tree interval [lo, post]
+  concept_reach_interval(code, lo, hi)          -- extra intervals of code's descendants
+  concept_reach_exception(parent, descendant)   -- closure pairs not covered by any interval
+
+    select 1 from concept_reach_label a, concept_reach_label d
+    where a.code = 'C3262' and d.code = 'SNOMEDCT:363346000' and d.post between a.lo and a.post
+"""
+import datetime
+
+import bulk_load
+import tc_engine
+
+
+def longest_depths(parents, order):
+    depth = {}
+    for v in order:
+        depth[v] = 1 + max((depth[p] for p in parents[v]), default=-1)
+    return depth
+
+
+def compute_labels(graph):
+    """
+    Returns (post, lo, intervals, exceptions): post-order number and tree interval start per id, extra
+    (lo, hi) intervals per id, and the (parent id, descendant id) closure pairs the intervals do not cover.
+    """
+    n = len(graph.codes)
+    tree_children = [[] for _ in range(n)]
+    dag_children = [[] for _ in range(n)]
+    is_root = [True] * n
+    orders = []
+    assigned = set()
+    for suffix, prefix in tc_engine.ONTOLOGY_PREFIXES:
+        parents = graph.subgraph_parents(prefix)
+        nodes = [v for v in graph.prefix_nodes(prefix) if v not in assigned]
+        assigned.update(nodes)
+        order = tc_engine.topo_order(parents, nodes)
+        orders.append(order)
+        depth = longest_depths(parents, order)
+        for v in order:
+            ps = list(dict.fromkeys(parents[v]))
+            for p in ps:
+                dag_children[p].append(v)
+            if ps:
+                # The deepest parent tends to be the most specific one and leaves fewer non-tree edges
+                tree_children[max(ps, key=lambda p: depth[p])].append(v)
+                is_root[v] = False
+
+    post = [0] * n
+    lo = [0] * n
+    counter = 0
+    for root in range(n):
+        if not is_root[root]:
+            continue
+        stack = [(root, iter(tree_children[root]), counter)]
+        while stack:
+            v, it, start = stack[-1]
+            for c in it:
+                stack.append((c, iter(tree_children[c]), counter))
+                break
+            else:
+                stack.pop()
+                post[v] = counter
+                lo[v] = start
+                counter += 1
+
+    intervals = {}
+    for order in orders:
+        for v in reversed(order):
+            merged = [(lo[v], post[v])]
+            for c in dag_children[v]:
+                merged.append((lo[c], post[c]))
+                merged.extend(intervals.get(c, ()))
+            merged.sort()
+            out = []
+            for a, b in merged:
+                if out and a <= out[-1][1] + 1:
+                    if b > out[-1][1]:
+                        out[-1] = (out[-1][0], b)
+                else:
+                    out.append((a, b))
+            extra = [iv for iv in out if not (lo[v] <= iv[0] and iv[1] <= post[v])]
+            if extra:
+                intervals[v] = extra
+
+    def covered(a, d):
+        p = post[d]
+        if lo[a] <= p <= post[a]:
+            return True
+        return any(x <= p <= y for x, y in intervals.get(a, ()))
+
+    exceptions = []
+    for d, ancs in tc_engine.comp_ancestor_sets(graph).items():
+        for a in ancs:
+            if not covered(a, d):
+                exceptions.append((a, d))
+    return post, lo, intervals, exceptions
+
+
+def table_size(cur, table, postgres):
+    """(rows, bytes or None) for a table; bytes are only available on Postgres."""
+    cur.execute('select count(*) from ' + table)
+    rows = cur.fetchone()[0]
+    if not postgres:
+        return rows, None
+    cur.execute('select pg_total_relation_size(to_regclass(%s))', (table,))
+    return rows, cur.fetchone()[0]
+
+
+def build_reach_index(con, postgres, graph=None, create_table='create table'):
+    """
+    Compute the labels from the parents table and (re)write the concept_reach_* tables, created with the
+    create_table prefix (bulk_load.create_table_sql).
+    """
+    cur = con.cursor()
+    if graph is None:
+        graph = tc_engine.ParentGraph.from_db(cur)
+    print(datetime.datetime.now(), "computing reachability labels")
+    post, lo, intervals, exceptions = compute_labels(graph)
+    codes = graph.codes
+
+    for table, ddl in (('concept_reach_label', '(code text, post int, lo int)'),
+                       ('concept_reach_interval', '(code text, lo int, hi int)'),
+                       ('concept_reach_exception', '(parent text, descendant text)')):
+        cur.execute('drop table if exists ' + table)
+        cur.execute(create_table + ' ' + table + ' ' + ddl)
+    bulk_load.copy_rows(cur, 'concept_reach_label', ('code', 'post', 'lo'),
+                        ((codes[v], post[v], lo[v]) for v in range(len(codes))), postgres)
+    bulk_load.copy_rows(cur, 'concept_reach_interval', ('code', 'lo', 'hi'),
+                        ((codes[v], a, b) for v, ivs in intervals.items() for a, b in ivs), postgres)
+    bulk_load.copy_rows(cur, 'concept_reach_exception', ('parent', 'descendant'),
+                        ((codes[a], codes[d]) for a, d in exceptions), postgres)
+    cur.execute('create unique index concept_reach_label_code on concept_reach_label(code)')
+    cur.execute('create index concept_reach_interval_code on concept_reach_interval(code)')
+    cur.execute('create index concept_reach_exception_pd on concept_reach_exception(parent, descendant)')
+    con.commit()
+
+    index_rows = 0
+    index_bytes = 0
+    for table in ('concept_reach_label', 'concept_reach_interval', 'concept_reach_exception'):
+        rows, size = table_size(cur, table, postgres)
+        index_rows += rows
+        index_bytes = None if size is None else index_bytes + size
+    tc_rows, tc_bytes = table_size(cur, 'ncit_tc_all', postgres)
+    print(datetime.datetime.now(), "reachability index:", len(codes), "labels,",
+          sum(len(ivs) for ivs in intervals.values()), "extra intervals,", len(exceptions), "exceptions")
+    print(datetime.datetime.now(), "reachability index rows", index_rows, "vs ncit_tc_all rows", tc_rows,
+          "(%.1f%%)" % (100.0 * index_rows / max(tc_rows, 1)))
+    if index_bytes is not None:
+        print(datetime.datetime.now(), "reachability index bytes", index_bytes, "vs ncit_tc_all bytes", tc_bytes)
+
+
+class ReachIndex:
+    """Loads the concept_reach_* tables into memory and answers is_a without touching ncit_tc_all."""
+
+    def __init__(self, labels, intervals, exceptions):
+        self.labels = labels
+        self.intervals = intervals
+        self.exceptions = exceptions
+
+    @classmethod
+    def from_db(cls, con):
+        cur = con.cursor()
+        cur.execute('select code, post, lo from concept_reach_label')
+        labels = {code: (post, lo) for code, post, lo in cur}
+        intervals = {}
+        cur.execute('select code, lo, hi from concept_reach_interval order by code, lo')
+        for code, lo, hi in cur:
+            intervals.setdefault(code, []).append((lo, hi))
+        cur.execute('select parent, descendant from concept_reach_exception')
+        exceptions = set(cur.fetchall())
+        return cls(labels, intervals, exceptions)
+
+    def is_a(self, code, ancestor):
+        """True if (ancestor, code) is a row of ncit_tc_all."""
+        d = self.labels.get(code)
+        a = self.labels.get(ancestor)
+        if d is None or a is None:
+            return False
+        p = d[0]
+        if a[1] <= p <= a[0]:
+            return True
+        for lo, hi in self.intervals.get(ancestor, ()):
+            if lo <= p <= hi:
+                return True
+        return (ancestor, code) in self.exceptions
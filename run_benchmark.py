@@ -0,0 +1,135 @@
+"""
+End-to-end build benchmark on synthetic data.
+
+Generates a synthetic NCIt/UMLS/crosswalk input set (see synthetic_ontology), serves EVS from a local stub, runs
+umls_bootstrap.py and build_unified_tc.py against a fresh sqlite database and prints the per-stage timings both
+scripts record with --metrics_file.  Everything is reproducible from the seed, so different closure engines and
+loader modes can be compared offline:
+
+    python run_benchmark.py --workdir /tmp/bench --ncit_concepts 50000 --tc_engine python
+    python run_benchmark.py --workdir /tmp/bench --reuse_data --tc_engine sql --loader stream
+    python run_benchmark.py --workdir /tmp/bench --reuse_data --build_arg=--skip_paths
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+import evs_stub
+import synthetic_ontology
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent
+UMLS_SABS = ','.join(synthetic_ontology.UMLS_SOURCES)
+
+
+def run_script(script, script_args, cwd):
+    cmd = [sys.executable, str(REPO_DIR / script)] + script_args
+    print(datetime.datetime.now(), 'running', ' '.join(cmd))
+    start = time.perf_counter()
+    with open(os.path.join(cwd, script + '.log'), 'w') as log:
+        rc = subprocess.call(cmd, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    if rc != 0:
+        raise RuntimeError(script + ' failed with exit code %d, see %s' % (rc, os.path.join(cwd, script + '.log')))
+    return elapsed
+
+
+def print_stages(title, metrics):
+    print()
+    print(title, '-- %.2fs wall, peak RSS %s MB' % (metrics['wall_seconds'], metrics['peak_rss_mb']))
+    print('  %-70s %10s %12s %10s %14s' % ('stage', 'seconds', 'rows', 'rss MB', 'db delta'))
+    for s in metrics['stages']:
+        print('  %-70s %10.3f %12s %10s %14s' % (s['stage'][:70], s['wall_seconds'],
+                                                '' if s['rows'] is None else s['rows'], s['peak_rss_mb'],
+                                                s['db_size_delta']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the UMLS import and the composite ontology build on '
+                                                 'synthetic data with a local EVS stand-in.')
+    parser.add_argument('--workdir', action='store', type=str, required=True)
+    parser.add_argument('--reuse_data', action='store_true', required=False,
+                        help='reuse the synthetic files already in workdir instead of generating them again')
+    parser.add_argument('--ncit_concepts', action='store', type=int, required=False, default=20000)
+    parser.add_argument('--umls_concepts', action='store', type=int, required=False, default=10000,
+                        help='concepts per UMLS source (ICD10CM, LNC, SNOMEDCT_US)')
+    parser.add_argument('--depth', action='store', type=int, required=False, default=12)
+    parser.add_argument('--branching', action='store', type=int, required=False, default=4)
+    parser.add_argument('--multi_parent', action='store', type=float, required=False, default=0.15,
+                        help='probability that a concept gets a second parent')
+    parser.add_argument('--crosswalk_rows', action='store', type=int, required=False, default=500)
+    parser.add_argument('--mcode_fraction', action='store', type=float, required=False, default=0.02,
+                        help='fraction of NCIt concepts with an mCode synonym in the EVS stub')
+    parser.add_argument('--seed', action='store', type=int, required=False, default=0)
+    parser.add_argument('--evs_latency', action='store', type=float, required=False, default=0.0)
+    parser.add_argument('--evs_failure_rate', action='store', type=float, required=False, default=0.0)
+    parser.add_argument('--tc_engine', action='store', type=str, required=False, default='sql', choices=['sql', 'python'])
+    parser.add_argument('--loader', action='store', type=str, required=False, default='pandas',
+                        choices=['pandas', 'stream'])
+    parser.add_argument('--build_arg', action='append', required=False, default=[],
+                        help='extra argument passed to build_unified_tc.py (repeatable), e.g. --build_arg=--skip_paths')
+    parser.add_argument('--umls_arg', action='append', required=False, default=[],
+                        help='extra argument passed to umls_bootstrap.py (repeatable)')
+    parser.add_argument('--report', action='store', type=str, required=False,
+                        help='write the combined metrics of the run to this JSON file')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    data_dir = os.path.join(workdir, 'data')
+    if args.reuse_data and os.path.exists(os.path.join(data_dir, 'evs_concepts.json')):
+        print(datetime.datetime.now(), 'reusing synthetic data in', data_dir)
+        description = None
+    else:
+        print(datetime.datetime.now(), 'generating synthetic data in', data_dir)
+        description = synthetic_ontology.generate(data_dir, ncit_concepts=args.ncit_concepts,
+                                                  umls_concepts=args.umls_concepts, depth=args.depth,
+                                                  branching=args.branching, multi_parent=args.multi_parent,
+                                                  crosswalk_rows=args.crosswalk_rows,
+                                                  mcode_fraction=args.mcode_fraction, seed=args.seed)
+        print(datetime.datetime.now(), description)
+
+    db = os.path.join(workdir, 'bench.sqlite')
+    for path in (db, db + '.staging', db + '.prev'):
+        if os.path.exists(path):
+            os.remove(path)
+    umls_metrics = os.path.join(workdir, 'umls_metrics.json')
+    build_metrics = os.path.join(workdir, 'build_metrics.json')
+
+    with evs_stub.EvsStub.from_file(os.path.join(data_dir, 'evs_concepts.json'), latency=args.evs_latency,
+                                    failure_rate=args.evs_failure_rate) as stub:
+        umls_seconds = run_script('umls_bootstrap.py',
+                                  ['--dbfilename', db, '--ontologies', UMLS_SABS, '--umls_data_dir', data_dir,
+                                   '--loader', args.loader, '--metrics_file', umls_metrics] + args.umls_arg,
+                                  workdir)
+        build_seconds = run_script('build_unified_tc.py',
+                                   ['--dbfilename', db, '--evs_url', stub.url,
+                                    '--thesaurus_zip', os.path.join(data_dir, 'Thesaurus.FLAT.zip'),
+                                    '--crosswalk_csv', os.path.join(data_dir, 'local_crosswalk.csv'),
+                                    '--tc_engine', args.tc_engine, '--metrics_file', build_metrics] + args.build_arg,
+                                   workdir)
+        evs_calls = stub.calls
+
+    with open(umls_metrics) as f:
+        umls = json.load(f)
+    with open(build_metrics) as f:
+        build = json.load(f)
+    print_stages('umls_bootstrap.py (loader %s)' % args.loader, umls)
+    print_stages('build_unified_tc.py (tc_engine %s%s)' % (args.tc_engine, ' ' + ' '.join(args.build_arg)
+                                                           if args.build_arg else ''), build)
+    print()
+    print('umls_bootstrap.py %.2fs, build_unified_tc.py %.2fs, %d EVS calls, database %d bytes'
+          % (umls_seconds, build_seconds, evs_calls, os.path.getsize(db)))
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({'data': description, 'args': vars(args), 'umls_seconds': umls_seconds,
+                       'build_seconds': build_seconds, 'evs_calls': evs_calls, 'database_bytes': os.path.getsize(db),
+                       'umls_bootstrap': umls, 'build_unified_tc': build}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
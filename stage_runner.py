@@ -0,0 +1,120 @@
+"""
+A small scheduler for build stages that only depend on some of the others.
+
+Each Stage names the stages it depends on.  run_stages starts every stage whose dependencies have finished, up to
+jobs at a time, each on its own database connection from connect().  The heavy lifting of a stage happens inside
+the database (or in a driver call that releases the GIL) so worker threads are enough to keep several stages
+running at once.
+
+    stages = [Stage('mrconso', load_mrconso), Stage('mrconso_idx', index_mrconso, deps=['mrconso'])]
+    run_stages(stages, connect, jobs=4)
+"""
+import concurrent.futures
+import datetime
+
+
+class Stage:
+
+    def __init__(self, name, func, deps=()):
+        """func is called with a connection from connect() once every stage named in deps has finished."""
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+def check_stages(stages):
+    """Raise ValueError for unknown or duplicate stage names and for dependency cycles."""
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('duplicate stage names in ' + ', '.join(names))
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        for d in s.deps:
+            if d not in by_name:
+                raise ValueError('stage ' + s.name + ' depends on unknown stage ' + d)
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if all(d in done for d in s.deps)]
+        if not ready:
+            raise ValueError('dependency cycle between stages ' + ', '.join(s.name for s in remaining))
+        done.update(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in done]
+
+
+def stages_in_order(stages):
+    done = set()
+    ordered = []
+    remaining = list(stages)
+    while remaining:
+        for s in remaining:
+            if all(d in done for d in s.deps):
+                ordered.append(s)
+                done.add(s.name)
+                remaining.remove(s)
+                break
+    return ordered
+
+
+def _close(con):
+    con.close()
+
+
+def run_stages(stages, connect, jobs=1, close=_close, shared=None, metrics=None, metrics_con=None):
+    """
+    Run stages in dependency order with at most jobs of them in flight.  With jobs <= 1 and a shared connection
+    the stages run one after the other on it, exactly like a plain script would.  The first exception raised by
+    a stage stops new stages from starting and is re-raised once the running ones have finished.  With a
+    build_metrics.BuildMetrics every stage is measured on its own connection (metrics_con(con) picks the DB-API
+    connection out of whatever connect() returns).
+    """
+    check_stages(stages)
+    if jobs <= 1 and shared is not None:
+        for s in stages_in_order(stages):
+            _run_stage(s, shared, metrics, metrics_con)
+        return
+
+    def run_on_own_connection(stage):
+        con = connect()
+        try:
+            _run_stage(stage, con, metrics, metrics_con)
+        finally:
+            close(con)
+
+    done = set()
+    pending = list(stages)
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while pending or running:
+            if error is None:
+                for s in [s for s in pending if all(d in done for d in s.deps)]:
+                    if len(running) >= max(jobs, 1):
+                        break
+                    pending.remove(s)
+                    running[pool.submit(run_on_own_connection, s)] = s
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in finished:
+                s = running.pop(f)
+                if f.exception() is not None:
+                    error = error or f.exception()
+                else:
+                    done.add(s.name)
+    if error is not None:
+        raise error
+
+
+def _run_stage(stage, con, metrics=None, metrics_con=None):
+    start = datetime.datetime.now()
+    print(start, "stage", stage.name, "started")
+    if metrics is None:
+        stage.func(con)
+    else:
+        with metrics.stage(stage.name, con if metrics_con is None else metrics_con(con)) as record:
+            rows = stage.func(con)
+            if record is not None and isinstance(rows, int):
+                record.add_rows(rows)
+    end = datetime.datetime.now()
+    print(end, "stage", stage.name, "finished in", end - start)
@@ -0,0 +1,179 @@
+"""
+Synthetic inputs for benchmarking the build without the real NCIt, UMLS or EVS.
+
+generate() writes into one directory everything umls_bootstrap.py and build_unified_tc.py read:
+
+  Thesaurus.FLAT.zip                 NCIt FLAT file (Thesaurus.txt)
+  MRCOLS/MRFILES/MRDOC.RRF           UMLS metadata used to generate the DDL
+  MRCONSO/MRHIER/MRREL/MRDEF.RRF     ICD10CM, LNC and SNOMEDCT_US atoms and hierarchies
+  local_crosswalk.csv                curated ICD10 -> NCIt crosswalk rows
+  evs_concepts.json                  the concept/ncit answers evs_stub.py serves, with mCode synonyms
+
+Every hierarchy is a DAG grown level by level: each concept gets one parent on the level above (so depth and
+branching factor are controlled) and, with probability multi_parent, one more parent from any higher level.
+Output only depends on the seed.
+"""
+import json
+import os
+import random
+import zipfile
+
+VERSION = '99.01a'
+
+MRCONSO_COLUMNS = ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'AUI', 'SAUI', 'SCUI', 'SDUI', 'SAB', 'TTY',
+                   'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF']
+MRHIER_COLUMNS = ['CUI', 'AUI', 'CXN', 'PAUI', 'SAB', 'RELA', 'PTR', 'HCD', 'CVF']
+MRREL_COLUMNS = ['CUI1', 'AUI1', 'STYPE1', 'REL', 'CUI2', 'AUI2', 'STYPE2', 'RELA', 'RUI', 'SRUI', 'SAB', 'SL',
+                 'RG', 'DIR', 'SUPPRESS', 'CVF']
+MRDEF_COLUMNS = ['CUI', 'AUI', 'ATUI', 'SATUI', 'SAB', 'DEF', 'SUPPRESS', 'CVF']
+RRF_FILES = {'MRCONSO.RRF': MRCONSO_COLUMNS, 'MRHIER.RRF': MRHIER_COLUMNS, 'MRREL.RRF': MRREL_COLUMNS,
+             'MRDEF.RRF': MRDEF_COLUMNS}
+TEXT_COLUMNS = {'STR', 'DEF', 'PTR'}
+
+# sab -> (parents table prefix, EVS mCode subSource, code format)
+UMLS_SOURCES = {'ICD10CM': ('ICD10CM', 'ICD-10 CM', 'X%02d.%d'),
+                'LNC': ('LOINC', 'LOINC', '%d-%d'),
+                'SNOMEDCT_US': ('SNOMEDCT', 'SNOMED CT', '%d')}
+
+CROSSWALK_HEADER = ('identifier,code_system,disease_code,preferred_name,evs_nci_code,corrected_preferred_name_for_icd9,'
+                    'date_last_created,date_last_updated,site_code,site_name,disease_code_site_code,'
+                    'evs_preferred_name,comments')
+
+
+def grow_dag(rng, n, depth, branching, multi_parent):
+    """
+    Parent index lists for n nodes.  Node 0 is the root and every parent has a smaller index than its child, so
+    the result is acyclic; nodes that do not fit in depth levels are hung under random nodes of the upper levels.
+    """
+    parents = [[]]
+    levels = [[0]]
+    while len(parents) < n:
+        if len(levels) < depth:
+            above = levels[-1]
+            current = []
+            levels.append(current)
+        else:
+            above = [rng.choice(rng.choice(levels[:-1]))]
+            current = levels[-1]
+        for p in above:
+            for _ in range(rng.randint(1, 2 * branching - 1)):
+                if len(parents) >= n:
+                    break
+                ps = [p]
+                if len(levels) > 2 and rng.random() < multi_parent:
+                    extra = rng.choice(levels[rng.randrange(len(levels) - 2)])
+                    if extra != p:
+                        ps.append(extra)
+                current.append(len(parents))
+                parents.append(ps)
+    return parents
+
+
+def umls_code(sab, i):
+    fmt = UMLS_SOURCES[sab][2]
+    if sab == 'ICD10CM':
+        return fmt % (i // 10, i % 10)
+    if sab == 'LNC':
+        return fmt % (10000 + i, i % 10)
+    return fmt % (100000000 + i)
+
+
+def rrf_line(values):
+    return '|'.join('' if v is None else str(v) for v in values) + '|\n'
+
+
+def write_thesaurus(path, parents, rng):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        with z.open('Thesaurus.txt', 'w') as f:
+            for i, ps in enumerate(parents):
+                code = 'C%d' % (i + 1)
+                name = 'Synthetic Concept %d' % (i + 1)
+                row = [code, '<http://ncicb.nci.nih.gov/xml/owl/EVS/Thesaurus.owl#%s>' % code,
+                       '|'.join('C%d' % (p + 1) for p in ps),
+                       name + '|' + name.upper() + '|SC%d' % (i + 1),
+                       'A synthetic definition for concept %d.' % (i + 1) if rng.random() < 0.6 else '',
+                       '', 'Retired_Concept' if rng.random() < 0.01 else '',
+                       rng.choice(['Neoplastic Process', 'Disease or Syndrome', 'Gene or Genome',
+                                   'Therapeutic or Preventive Procedure'])]
+                f.write(('\t'.join(row) + '\n').encode('utf-8'))
+
+
+def write_umls(directory, graphs):
+    """graphs is sab -> parent index lists."""
+    with open(os.path.join(directory, 'MRFILES.RRF'), 'w') as f:
+        for fil, cols in RRF_FILES.items():
+            f.write(rrf_line([fil, fil + ' synthetic', ','.join(cols), len(cols), 0, 0]))
+    with open(os.path.join(directory, 'MRCOLS.RRF'), 'w') as f:
+        for fil, cols in RRF_FILES.items():
+            for c in cols:
+                f.write(rrf_line([c, c + ' column', '', 0, 0, 0, fil, 'text' if c in TEXT_COLUMNS else 'varchar(100)']))
+    with open(os.path.join(directory, 'MRDOC.RRF'), 'w') as f:
+        f.write(rrf_line(['RELA', 'isa', 'expanded_form', 'Is a']))
+
+    conso = open(os.path.join(directory, 'MRCONSO.RRF'), 'w')
+    hier = open(os.path.join(directory, 'MRHIER.RRF'), 'w')
+    rel = open(os.path.join(directory, 'MRREL.RRF'), 'w')
+    mrdef = open(os.path.join(directory, 'MRDEF.RRF'), 'w')
+    aui = 0
+    cui = 0
+    try:
+        for sab, parents in graphs.items():
+            auis = []
+            for i in range(len(parents)):
+                aui += 1
+                cui += 1
+                auis.append('A%08d' % aui)
+                conso.write(rrf_line(['C%07d' % cui, 'ENG', 'P', 'L%07d' % cui, 'PF', 'S%07d' % aui, 'Y',
+                                      'A%08d' % aui, '', '', '', sab, 'PT', umls_code(sab, i),
+                                      '%s synthetic term %d' % (sab, i), 0, 'N', '']))
+                if i % 3 == 0:
+                    mrdef.write(rrf_line(['C%07d' % cui, 'A%08d' % aui, 'AT%07d' % aui, '', sab,
+                                          'Synthetic definition %d' % i, 'N', '']))
+            for i, ps in enumerate(parents):
+                for cxn, p in enumerate(ps, 1):
+                    hier.write(rrf_line(['', auis[i], cxn, auis[p], sab, 'isa', '', '', '']))
+                    rel.write(rrf_line(['', auis[i], 'AUI', 'CHD', '', auis[p], 'AUI', 'isa', '', '', sab, sab, '',
+                                        '', 'N', '']))
+    finally:
+        conso.close()
+        hier.close()
+        rel.close()
+        mrdef.close()
+
+
+def generate(directory, ncit_concepts=20000, umls_concepts=10000, depth=12, branching=4, multi_parent=0.15,
+             crosswalk_rows=500, mcode_fraction=0.02, seed=0):
+    """Write a full synthetic input set into directory and return a short description of it."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    ncit = grow_dag(rng, ncit_concepts, depth, branching, multi_parent)
+    write_thesaurus(os.path.join(directory, 'Thesaurus.FLAT.zip'), ncit, rng)
+
+    graphs = {sab: grow_dag(rng, umls_concepts, depth, branching, multi_parent) for sab in UMLS_SOURCES}
+    write_umls(directory, graphs)
+
+    with open(os.path.join(directory, 'local_crosswalk.csv'), 'w') as f:
+        f.write(CROSSWALK_HEADER + '\n')
+        for i in range(crosswalk_rows):
+            c = rng.randrange(ncit_concepts)
+            d = umls_code('ICD10CM', rng.randrange(umls_concepts))
+            f.write('%d,ICD10,%s,Synthetic crosswalk %d,C%d,,2019-11-27 16:16:29.229898,,,,,,\n' % (i, d, i, c + 1))
+
+    concepts = {}
+    for i in range(ncit_concepts):
+        code = 'C%d' % (i + 1)
+        synonyms = [{'name': 'Synthetic Concept %d' % (i + 1), 'type': 'PT', 'source': 'NCI'}]
+        if rng.random() < mcode_fraction:
+            sab = rng.choice(list(UMLS_SOURCES))
+            synonyms.append({'name': 'mCode term', 'type': 'PT', 'source': 'mCode',
+                             'subSource': UMLS_SOURCES[sab][1], 'code': umls_code(sab, rng.randrange(umls_concepts))})
+        concepts[code] = {'code': code, 'name': 'Synthetic Concept %d' % (i + 1), 'terminology': 'ncit',
+                          'version': VERSION, 'synonyms': synonyms}
+    with open(os.path.join(directory, 'evs_concepts.json'), 'w') as f:
+        json.dump({'version': VERSION, 'concepts': concepts}, f)
+
+    return {'directory': directory, 'version': VERSION, 'ncit_concepts': ncit_concepts,
+            'ncit_edges': sum(len(ps) for ps in ncit),
+            'umls_concepts_per_source': umls_concepts,
+            'umls_edges': sum(len(ps) for g in graphs.values() for ps in g),
+            'crosswalk_rows': crosswalk_rows}
@@ -0,0 +1,424 @@
+"""
+In-process transitive closure engine for the composite ontology.
+
+The parents table is loaded once into integer-id adjacency lists.  Path rows are produced by walking the
+graph in topological order, extending the paths of each parent by one edge, and closure pairs come from
+an ancestor-set DP over the same order.  The row sets match the recursive CTEs in build_unified_tc.py:
+
+  ncit_tc_with_path_{ncit,icd10cm,snomedct,loinc} -- every path inside the prefix-restricted subgraph
+  ncit_tc_with_path_comp -- the comp_parents seed edges extended upwards through the whole graph
+  ncit_tc_all -- the distinct (parent, descendant) pairs of all of the above plus reflexive rows
+"""
+import datetime
+
+from bulk_load import copy_rows
+
+# (UMLS SAB, code prefix) of the hierarchies build_unified_tc.py extracts from MRHIER.  Each one gets its own
+# ncit_tc_with_path_<prefix> table, so adding a source (it must also be loaded by umls_bootstrap.py --ontologies)
+# is one more entry here.  Prefixes are matched with like 'PREFIX%', so none may start with another one or with C.
+UMLS_HIERARCHIES = [('ICD10CM', 'ICD10CM'), ('SNOMEDCT_US', 'SNOMEDCT'), ('LNC', 'LOINC')]
+
+# (path table suffix, code prefix) -- the prefix plays the role of the like 'C%' filters in the SQL
+ONTOLOGY_PREFIXES = [('ncit', 'C')] + [(prefix.lower(), prefix) for sab, prefix in UMLS_HIERARCHIES]
+NCIT_PREFIX = 'C'
+
+PATH_COLUMNS = ('parent', 'descendant', 'level', 'path')
+TC_COLUMNS = ('parent', 'descendant')
+
+
+class ParentGraph:
+    """Concept -> parent edges with interned integer ids.  Duplicate edges are kept, as in the parents table."""
+
+    def __init__(self):
+        self.codes = []
+        self.ids = {}
+        self.parents = []
+
+    def intern(self, code):
+        i = self.ids.get(code)
+        if i is None:
+            i = len(self.codes)
+            self.ids[code] = i
+            self.codes.append(code)
+            self.parents.append([])
+        return i
+
+    def add_edge(self, concept, parent):
+        c = self.intern(concept)
+        self.parents[c].append(self.intern(parent))
+
+    @classmethod
+    def from_edges(cls, edges):
+        graph = cls()
+        for concept, parent in edges:
+            graph.add_edge(concept, parent)
+        return graph
+
+    @classmethod
+    def from_db(cls, cur, table='parents'):
+        cur.execute('select concept, parent from ' + table)
+        return cls.from_edges(cur)
+
+    def prefix_nodes(self, prefix):
+        return [v for v, code in enumerate(self.codes) if code.startswith(prefix)]
+
+    def subgraph_parents(self, prefix):
+        """Parent lists restricted to edges where both ends start with prefix."""
+        keep = [code.startswith(prefix) for code in self.codes]
+        return [[p for p in ps if keep[p]] if keep[v] else [] for v, ps in enumerate(self.parents)]
+
+    def comp_seed_edges(self):
+        """
+        The distinct comp_parents edges as a dict parent id -> list of concept ids: the NCIt -> other ontology
+        links, the edges below their targets and the edges above their NCIt sources.
+        """
+        is_ncit = [code.startswith(NCIT_PREFIX) for code in self.codes]
+        xwalk_sources = set()
+        xwalk_targets = set()
+        for v, ps in enumerate(self.parents):
+            if not is_ncit[v]:
+                for p in ps:
+                    if is_ncit[p]:
+                        xwalk_sources.add(p)
+                        xwalk_targets.add(v)
+        seeds = {}
+        seen = set()
+        for v, ps in enumerate(self.parents):
+            for p in ps:
+                if (p, v) in seen:
+                    continue
+                if p in xwalk_targets or v in xwalk_sources or (is_ncit[p] and not is_ncit[v]):
+                    seen.add((p, v))
+                    seeds.setdefault(p, []).append(v)
+        return seeds
+
+    def ancestor_nodes(self, start):
+        return reachable_nodes(self.parents, start)
+
+    def children(self):
+        """id -> list of child ids, the reverse of parents."""
+        children = [[] for _ in self.codes]
+        for v, ps in enumerate(self.parents):
+            for p in ps:
+                children[p].append(v)
+        return children
+
+
+def reachable_nodes(adjacency, start):
+    """start plus every node reachable from it through adjacency (parent lists give ancestors, child lists descendants)."""
+    seen = set(start)
+    stack = list(seen)
+    while stack:
+        v = stack.pop()
+        for p in adjacency[v]:
+            if p not in seen:
+                seen.add(p)
+                stack.append(p)
+    return seen
+
+
+def topo_order(parents, nodes):
+    """Kahn's algorithm over nodes, parents before children.  parents must only reference nodes."""
+    indegree = {}
+    children = {}
+    for v in nodes:
+        indegree[v] = len(parents[v])
+        for p in parents[v]:
+            children.setdefault(p, []).append(v)
+    order = [v for v in nodes if indegree[v] == 0]
+    i = 0
+    while i < len(order):
+        for c in children.get(order[i], ()):
+            indegree[c] -= 1
+            if indegree[c] == 0:
+                order.append(c)
+        i += 1
+    if len(order) != len(indegree):
+        raise ValueError('parents graph has a cycle through %d concepts' % (len(indegree) - len(order)))
+    return order
+
+
+def _child_counts(parents, order):
+    remaining = {}
+    for v in order:
+        for p in parents[v]:
+            remaining[p] = remaining.get(p, 0) + 1
+    return remaining
+
+
+def iter_up_paths(codes, parents, order):
+    """
+    Yield (v, up) in order, where up lists (start id, level, path) for every path of length >= 1 ending at v.
+    A node's list is only held until all of its children have been visited.
+    """
+    remaining = _child_counts(parents, order)
+    up = {}
+    for v in order:
+        code = codes[v]
+        lst = []
+        for p in parents[v]:
+            lst.append((p, 1, codes[p] + '|' + code))
+            for s, level, path in up[p]:
+                lst.append((s, level + 1, path + '|' + code))
+        yield v, lst
+        for p in parents[v]:
+            remaining[p] -= 1
+            if remaining[p] == 0:
+                del up[p]
+        if remaining.get(v):
+            up[v] = lst
+
+
+def iter_ancestor_sets(parents, order):
+    """Yield (v, ancestors of v) in order, freeing each set once its children have been visited."""
+    remaining = _child_counts(parents, order)
+    anc = {}
+    for v in order:
+        a = set()
+        for p in parents[v]:
+            a.add(p)
+            a |= anc[p]
+        yield v, a
+        for p in parents[v]:
+            remaining[p] -= 1
+            if remaining[p] == 0:
+                del anc[p]
+        if remaining.get(v):
+            anc[v] = a
+
+
+def _restrict(parents, nodes, descendants):
+    """The nodes to walk when only rows for the given descendant ids are wanted: their ancestors inside nodes."""
+    if descendants is None:
+        return nodes
+    return reachable_nodes(parents, set(nodes).intersection(descendants))
+
+
+def _restrict_seeds(seeds, descendants):
+    if descendants is None:
+        return seeds
+    restricted = {}
+    for x, ys in seeds.items():
+        ys = [y for y in ys if y in descendants]
+        if ys:
+            restricted[x] = ys
+    return restricted
+
+
+def iter_ontology_path_rows(graph, prefix, descendants=None):
+    """
+    Rows of ncit_tc_with_path_<ontology> for the subgraph whose codes start with prefix, optionally only those
+    ending at the given descendant ids.
+    """
+    parents = graph.subgraph_parents(prefix)
+    codes = graph.codes
+    nodes = _restrict(parents, graph.prefix_nodes(prefix), descendants)
+    for v, up in iter_up_paths(codes, parents, topo_order(parents, nodes)):
+        if descendants is not None and v not in descendants:
+            continue
+        d = codes[v]
+        for s, level, path in up:
+            yield codes[s], d, level, path
+
+
+def iter_comp_path_rows(graph, seeds=None, descendants=None):
+    """Rows of ncit_tc_with_path_comp: each seed edge, then extended upwards through any parent edge."""
+    if seeds is None:
+        seeds = graph.comp_seed_edges()
+    seeds = _restrict_seeds(seeds, descendants)
+    codes = graph.codes
+    order = topo_order(graph.parents, graph.ancestor_nodes(seeds))
+    for x, up in iter_up_paths(codes, graph.parents, order):
+        for y in seeds.get(x, ()):
+            d = codes[y]
+            yield codes[x], d, 1, codes[x] + '|' + d
+            for s, level, path in up:
+                yield codes[s], d, level + 1, path + '|' + d
+
+
+def comp_ancestor_sets(graph, seeds=None, descendants=None):
+    """descendant id -> set of parent ids that ncit_tc_with_path_comp pairs it with."""
+    if seeds is None:
+        seeds = graph.comp_seed_edges()
+    seeds = _restrict_seeds(seeds, descendants)
+    comp_anc = {}
+    order = topo_order(graph.parents, graph.ancestor_nodes(seeds))
+    for x, anc in iter_ancestor_sets(graph.parents, order):
+        for y in seeds.get(x, ()):
+            s = comp_anc.setdefault(y, set())
+            s.add(x)
+            s |= anc
+    return comp_anc
+
+
+def iter_closure_pairs(graph, seeds=None, descendants=None):
+    """
+    Distinct (parent, descendant) code pairs of all the path tables, without enumerating any paths.  Optionally
+    only the pairs for the given descendant ids.
+    """
+    codes = graph.codes
+    comp_anc = comp_ancestor_sets(graph, seeds, descendants)
+    for suffix, prefix in ONTOLOGY_PREFIXES:
+        parents = graph.subgraph_parents(prefix)
+        nodes = _restrict(parents, graph.prefix_nodes(prefix), descendants)
+        for v, anc in iter_ancestor_sets(parents, topo_order(parents, nodes)):
+            if descendants is not None and v not in descendants:
+                continue
+            extra = comp_anc.pop(v, None)
+            if extra:
+                anc = anc | extra
+            d = codes[v]
+            for a in anc:
+                yield codes[a], d
+    for v, anc in comp_anc.items():
+        d = codes[v]
+        for a in anc:
+            yield codes[a], d
+
+
+PATH_TABLES = ['ncit_tc_with_path_' + suffix for suffix, prefix in ONTOLOGY_PREFIXES] + ['ncit_tc_with_path_comp']
+
+
+def create_path_table(cur, table, create_table='create table'):
+    cur.execute('drop table if exists ' + table)
+    cur.execute(create_table + ' ' + table + ' (parent text, descendant text, level int, path text)')
+
+
+def build_closure_tables(con, postgres, graph=None, paths=True, create_table='create table'):
+    """
+    Create and fill ncit_tc_with_path_{ncit,icd10cm,snomedct,loinc,comp} and ncit_tc_all (including the
+    reflexive rows) from the parents table.  With paths=False only ncit_tc_all is built.  create_table is the
+    statement prefix (bulk_load.create_table_sql).  Returns the graph so callers can reuse it.
+    """
+    cur = con.cursor()
+    if graph is None:
+        print(datetime.datetime.now(), "loading parents into the closure engine")
+        graph = ParentGraph.from_db(cur)
+    print(datetime.datetime.now(), "closure engine graph has", len(graph.codes), "concepts")
+
+    seeds = graph.comp_seed_edges()
+    if paths:
+        for suffix, prefix in ONTOLOGY_PREFIXES:
+            table = 'ncit_tc_with_path_' + suffix
+            print(datetime.datetime.now(), "computing transitive closure for", table)
+            create_path_table(cur, table, create_table)
+            n = copy_rows(cur, table, PATH_COLUMNS, iter_ontology_path_rows(graph, prefix), postgres)
+            con.commit()
+            print(datetime.datetime.now(), n, "rows written to", table)
+
+        print(datetime.datetime.now(), "computing transitive closure for composite ontology")
+        create_path_table(cur, 'ncit_tc_with_path_comp', create_table)
+        n = copy_rows(cur, 'ncit_tc_with_path_comp', PATH_COLUMNS, iter_comp_path_rows(graph, seeds), postgres)
+        con.commit()
+        print(datetime.datetime.now(), n, "rows written to ncit_tc_with_path_comp")
+
+    print(datetime.datetime.now(), "creating tc_all table")
+    cur.execute('drop table if exists ncit_tc_all')
+    cur.execute(create_table + ' ncit_tc_all (parent text, descendant text)')
+    tc_codes = set()
+
+    def pairs():
+        for parent, descendant in iter_closure_pairs(graph, seeds):
+            tc_codes.add(parent)
+            tc_codes.add(descendant)
+            yield parent, descendant
+
+    n = copy_rows(cur, 'ncit_tc_all', TC_COLUMNS, pairs(), postgres)
+    print(datetime.datetime.now(), n, "closure rows written to ncit_tc_all")
+    n = copy_rows(cur, 'ncit_tc_all', TC_COLUMNS, ((c, c) for c in tc_codes), postgres)
+    con.commit()
+    print(datetime.datetime.now(), n, "reflexive rows written to ncit_tc_all")
+    return graph
+
+
+def changed_edges(old_edges, new_edges):
+    """(concept, parent) pairs whose multiplicity differs between two edge iterables."""
+    counts = {}
+    for edge in old_edges:
+        counts[edge] = counts.get(edge, 0) - 1
+    for edge in new_edges:
+        counts[edge] = counts.get(edge, 0) + 1
+    return [edge for edge, n in counts.items() if n != 0]
+
+
+def affected_codes(changed, old_graph, new_graph):
+    """
+    The descendant codes whose path and closure rows can differ: everything at or below the concept of a changed
+    edge in either graph, plus the NCIt end of changed NCIt -> other ontology links (it seeds comp rows above it).
+    Also returns the codes whose reflexive rows have to be re-checked.
+    """
+    descendants = set()
+    reflexive = set()
+    for graph in (old_graph, new_graph):
+        children = graph.children()
+        start = [graph.ids[c] for c, p in changed if c in graph.ids]
+        descendants.update(graph.codes[v] for v in reachable_nodes(children, start))
+    for c, p in changed:
+        if p.startswith(NCIT_PREFIX) and not c.startswith(NCIT_PREFIX):
+            descendants.add(p)
+        reflexive.add(c)
+        reflexive.add(p)
+    reflexive |= descendants
+    return descendants, reflexive
+
+
+def update_closure_tables(con, postgres, prev_table='parents_prev', max_fraction=0.25):
+    """
+    Bring the closure and path tables built from prev_table up to date with the parents table by deleting and
+    recomputing only the rows whose descendant lies below a changed edge.  Returns False without touching anything
+    when more than max_fraction of the concepts are affected, in which case a full rebuild is cheaper.
+    """
+    cur = con.cursor()
+    print(datetime.datetime.now(), "loading previous and current parents into the closure engine")
+    old_graph = ParentGraph.from_db(cur, prev_table)
+    graph = ParentGraph.from_db(cur)
+    changed = changed_edges(((c, old_graph.codes[p]) for c, v in old_graph.ids.items() for p in old_graph.parents[v]),
+                            ((c, graph.codes[p]) for c, v in graph.ids.items() for p in graph.parents[v]))
+    descendants, reflexive = affected_codes(changed, old_graph, graph)
+    print(datetime.datetime.now(), len(changed), "parent edges changed,", len(descendants), "of", len(graph.codes),
+          "concepts affected")
+    if len(descendants) > max_fraction * max(len(graph.codes), 1):
+        print(datetime.datetime.now(), "too many concepts affected for an incremental update")
+        return False
+
+    cur.execute('drop table if exists tc_affected')
+    cur.execute('create temporary table tc_affected (code text primary key)')
+    copy_rows(cur, 'tc_affected', ('code',), ((c,) for c in descendants), postgres)
+    cur.execute('drop table if exists tc_reflexive')
+    cur.execute('create temporary table tc_reflexive (code text primary key)')
+    copy_rows(cur, 'tc_reflexive', ('code',), ((c,) for c in reflexive), postgres)
+
+    for table in PATH_TABLES + ['ncit_tc_with_path_all', 'ncit_tc_all']:
+        cur.execute('delete from ' + table + ' where descendant in (select code from tc_affected)')
+    cur.execute('delete from ncit_tc_all where parent = descendant and parent in (select code from tc_reflexive)')
+    cur.execute('delete from ncit_tc_with_path_all where level = 0 and parent in (select code from tc_reflexive)')
+
+    affected_ids = set(graph.ids[c] for c in descendants if c in graph.ids)
+    seeds = graph.comp_seed_edges()
+    for suffix, prefix in ONTOLOGY_PREFIXES:
+        table = 'ncit_tc_with_path_' + suffix
+        rows = list(iter_ontology_path_rows(graph, prefix, affected_ids))
+        copy_rows(cur, table, PATH_COLUMNS, rows, postgres)
+        copy_rows(cur, 'ncit_tc_with_path_all', PATH_COLUMNS, rows, postgres)
+        print(datetime.datetime.now(), len(rows), "rows recomputed for", table)
+    rows = list(iter_comp_path_rows(graph, seeds, affected_ids))
+    copy_rows(cur, 'ncit_tc_with_path_comp', PATH_COLUMNS, rows, postgres)
+    copy_rows(cur, 'ncit_tc_with_path_all', PATH_COLUMNS, rows, postgres)
+    print(datetime.datetime.now(), len(rows), "rows recomputed for ncit_tc_with_path_comp")
+    n = copy_rows(cur, 'ncit_tc_all', TC_COLUMNS, iter_closure_pairs(graph, seeds, affected_ids), postgres)
+    print(datetime.datetime.now(), n, "closure rows recomputed for ncit_tc_all")
+
+    # A code keeps its reflexive rows as long as it still shows up in some closure row
+    cur.execute("""
+        insert into ncit_tc_all (parent, descendant)
+        select r.code, r.code from tc_reflexive r
+        where exists (select 1 from ncit_tc_all t where t.parent = r.code)
+           or exists (select 1 from ncit_tc_all t where t.descendant = r.code)""")
+    cur.execute("""
+        insert into ncit_tc_with_path_all (parent, descendant, level, path)
+        select r.code, r.code, 0, r.code from tc_reflexive r
+        where exists (select 1 from ncit_tc_all t where t.parent = r.code and t.descendant = r.code)""")
+    cur.execute('drop table tc_affected')
+    cur.execute('drop table tc_reflexive')
+    con.commit()
+    return True
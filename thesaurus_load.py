@@ -0,0 +1,66 @@
+"""
+Streaming ingestion of the NCIt FLAT Thesaurus.txt.
+
+The file is read straight from the zip member in fixed-size chunks.  Each chunk is written to the ncit table and
+its pipe-delimited parents column is exploded into the NCIt edges of the parents table in the same pass, so only
+one chunk is ever held in memory whatever the size of the release.
+"""
+import datetime
+import itertools
+
+import pandas as pd
+
+import bulk_load
+
+THESAURUS_COLUMNS = ('code', 'url', 'parents', 'synonyms', 'definition', 'display_name', 'concept_status',
+                     'semantic_type')
+NCIT_COLUMNS = ('index',) + THESAURUS_COLUMNS + ('pref_name',)
+THESAURUS_DTYPES = {'code': str, 'url': str, 'parents': str, 'synonyms': str, 'definition': str,
+                    'display_name': str, 'concept_status': 'category', 'semantic_type': 'category'}
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def iter_thesaurus_chunks(fileobj, chunksize=DEFAULT_CHUNK_SIZE):
+    """DataFrames of at most chunksize concepts with pref_name (the first synonym) added."""
+    for chunk in pd.read_csv(fileobj, delimiter='\t', header=None, names=THESAURUS_COLUMNS,
+                             dtype=THESAURUS_DTYPES, chunksize=chunksize):
+        chunk['pref_name'] = chunk['synonyms'].str.partition('|')[0]
+        yield chunk
+
+
+def chunk_edges(chunk):
+    """(concept, parent, level, path) rows for the parent codes listed in a Thesaurus chunk."""
+    edges = chunk.loc[chunk['parents'].notna() & (chunk['parents'] != ''), ['code', 'parents']]
+    edges = edges.assign(parent=edges['parents'].str.split('|')).explode('parent')
+    return zip(edges['code'], edges['parent'], itertools.repeat(1), edges['parent'] + '|' + edges['code'])
+
+
+def chunk_rows(chunk):
+    values = chunk.astype(object)
+    values = values.where(chunk.notna(), None)
+    return values.itertuples(index=True, name=None)
+
+
+def create_ncit_table(cur, create_table='create table'):
+    cur.execute('drop table if exists ncit')
+    cur.execute(create_table + ' ncit ("index" bigint, ' + ', '.join(c + ' text' for c in NCIT_COLUMNS[1:]) + ')')
+
+
+def load_thesaurus(con, postgres, fileobj, chunksize=DEFAULT_CHUNK_SIZE, edge_table='parents',
+                   create_table='create table'):
+    """
+    Stream Thesaurus.txt into a fresh ncit table (created with the create_table prefix) and append the NCIt parent
+    edges to edge_table, which must already exist.  Returns (concepts, edges) written.
+    """
+    cur = con.cursor()
+    create_ncit_table(cur, create_table)
+    num_concepts = 0
+    num_edges = 0
+    columns = ['"index"'] + list(NCIT_COLUMNS[1:])
+    for chunk in iter_thesaurus_chunks(fileobj, chunksize):
+        num_concepts += bulk_load.copy_rows(cur, 'ncit', columns, chunk_rows(chunk), postgres)
+        num_edges += bulk_load.copy_rows(cur, edge_table, ('concept', 'parent', 'level', 'path'), chunk_edges(chunk),
+                                         postgres)
+        con.commit()
+        print(datetime.datetime.now(), num_concepts, "concepts and", num_edges, "NCIt parent edges loaded")
+    return num_concepts, num_edges
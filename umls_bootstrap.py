@@ -1,5 +1,6 @@
 import sys
 
+import io
 import pandas as pd
 import sqlite3
 import pathlib
@@ -8,6 +9,11 @@ import psycopg2.extras
 import sqlalchemy
 import argparse
 import datetime
+import functools
+
+import build_metrics
+import bulk_load
+import stage_runner
 
 parser = argparse.ArgumentParser(description='Selectively bootstrap a sqlite or Postgresql UMLS database.')
 
@@ -20,6 +26,19 @@ parser.add_argument('--schema', action='store', type=str, required=False)
 parser.add_argument('--ontologies', action='store', type=str, required=True)
 parser.add_argument('--dbfilename', action='store', type=str, required=False )
 parser.add_argument('--umls_data_dir', action='store', type=str, required=True)
+parser.add_argument('--loader', action='store', type=str, required=False, default='pandas', choices=['pandas', 'stream'],
+                    help='load MRCONSO/MRREL/MRDEF/MRHIER through pandas chunks (default) or stream them with COPY/executemany')
+parser.add_argument('--metrics_file', action='store', type=str, required=False,
+                    help='write per-stage wall time, rows, peak RSS, database growth and Postgres plans to this JSON file')
+parser.add_argument('--metrics_table', action='store_true', required=False,
+                    help='also append the per-stage metrics to the ' + build_metrics.METRICS_TABLE + ' table')
+parser.add_argument('--jobs', action='store', type=int, required=False, default=1,
+                    help='number of tables imported or indexed at once, each on its own connection (Postgres only)')
+parser.add_argument('--columns', action='store', type=str, required=False, default='all', choices=['all', 'build'],
+                    help='load every MRFILES column (default) or only the ones the ontology build and the indexes use')
+parser.add_argument('--bulk_load', action='store_true', required=False,
+                    help='load with relaxed durability (sqlite pragmas, UNLOGGED tables on Postgres), build all indexes '
+                         'after the loads and ANALYZE the tables; everything is made durable again at the end')
 
 #ontologies = ['NCI', 'SNOMEDCT_US', 'CPT', 'ICD10PCS', 'ICD10CM', 'RXNORM', 'ICD9CM']
 #ontologies = [ 'ICD10CM']
@@ -31,6 +50,14 @@ else:
     connection_string = args.dbfilename
 
 ontologies = args.ontologies.split(',')
+ontology_bytes = {o.encode('utf-8') for o in ontologies}
+
+# The columns kept with --columns build: what build_unified_tc.py reads plus the indexed cuis
+BUILD_COLUMNS = {'MRCONSO': {'CUI', 'AUI', 'SAB', 'TTY', 'CODE', 'STR'},
+                 'MRHIER': {'CUI', 'AUI', 'PAUI', 'SAB', 'PTR'},
+                 'MRREL': {'CUI1', 'AUI1', 'REL', 'CUI2', 'AUI2', 'RELA', 'SAB'},
+                 'MRDEF': {'CUI', 'AUI', 'SAB', 'DEF'}}
+PANDAS_CHUNK_SIZE = 200000
 
 def fix_sql(sql):
     if args.dbfilename is None:
@@ -54,6 +81,30 @@ else:
     sa_connection = db_connection
 
 cur = db_connection.cursor()
+if args.bulk_load:
+    bulk_load.enter_bulk_mode(db_connection, args.dbfilename is None)
+metrics = build_metrics.BuildMetrics(db_connection, args.dbfilename is None, script='umls_bootstrap',
+                                     enabled=args.metrics_file is not None or args.metrics_table)
+
+
+def connect():
+    """A new (db_connection, sa_connection) pair for a stage running next to others."""
+    if args.dbfilename is None:
+        cons = (psycopg2.connect(database=args.dbname, user=args.user, host=args.host, port=args.port,
+                                 password=args.password), sae_connection.connect())
+    else:
+        con = sqlite3.connect(connection_string)
+        cons = (con, con)
+    if args.bulk_load:
+        bulk_load.enter_bulk_mode(cons[0], args.dbfilename is None)
+    return cons
+
+
+def close_connections(cons):
+    db_con, sa_con = cons
+    if sa_con is not db_con:
+        sa_con.close()
+    db_con.close()
 
 def import_table_pandas(table_name, columns):
     print('Importing via Pandas', table_name)
@@ -76,9 +127,13 @@ def import_table_pandas(table_name, columns):
     sa_connection.commit()
     db_connection.commit()
 
-def import_table_pandas_chunks(table_name):
-
-    print('Importing via Pandas in chunks ', table_name)
+def create_rrf_table(table_name, db_con):
+    """
+    Drop and recreate table_name with the columns and datatypes listed in MRFILES/MRCOLS.  Returns all the column
+    names of the file, with a trailing 'foobar' for the empty field after the last '|', and the ones the table got
+    (a subset with --columns build).
+    """
+    cur = db_con.cursor()
     if args.schema is not None:
         cur.execute('drop table if exists ' + args.schema + '.' + table_name)
     else:
@@ -96,111 +151,168 @@ def import_table_pandas_chunks(table_name):
     rs= cur.fetchone()[0]
     print(rs)
 
+    create_table = bulk_load.create_table_sql(args.dbfilename is None, args.bulk_load)
     if args.schema is not None:
-        sql_create = 'create table ' + args.schema+'.'+table_name.lower() + '('
+        sql_create = create_table + ' ' + args.schema+'.'+table_name.lower() + '('
     else:
-        sql_create = 'create table ' + table_name.lower() +  '('
+        sql_create = create_table + ' ' + table_name.lower() +  '('
 
     rs = rs + ',foobar'
     column_names = rs.split(',')
+    table_columns = [c for c in column_names if c != 'foobar' and
+                     (args.columns == 'all' or c in BUILD_COLUMNS.get(table_name, column_names))]
     sql_cols = []
-    for c in column_names:
-        if c != 'foobar':
-            if args.schema is not None:
-                col_sql = 'select col, dty from '+args.schema+'.mrcols where fil = ? and col = ?'
-            else:
-                col_sql = 'select col, dty from mrcols where fil = ? and col = ?'
-            col_sql = fix_sql(col_sql)
-            rc = cur.execute(col_sql,
-                                [table_name + '.RRF'.upper(),c])
-            rs_col = cur.fetchone()[1]
-            print(rs_col)
-            sql_cols.append( c.lower() + " " + rs_col )
+    for c in table_columns:
+        if args.schema is not None:
+            col_sql = 'select col, dty from '+args.schema+'.mrcols where fil = ? and col = ?'
+        else:
+            col_sql = 'select col, dty from mrcols where fil = ? and col = ?'
+        col_sql = fix_sql(col_sql)
+        rc = cur.execute(col_sql,
+                            [table_name + '.RRF'.upper(),c])
+        rs_col = cur.fetchone()[1]
+        print(rs_col)
+        sql_cols.append( c.lower() + " " + rs_col )
     print(sql_cols)
     sql_create = sql_create + ",".join(sql_cols) + ")"
     print(sql_create)
     cur.execute(sql_create)
-    db_connection.commit()
+    db_con.commit()
+    return column_names, table_columns
+
+
+def iter_rrf_lines(path, sab_index):
+    """
+    Yield the raw lines of an RRF file whose SAB is one of the requested ontologies.  Only the fields up to SAB
+    are split off, so the rows of other sources are dropped before anything is decoded or parsed.  Blank or
+    truncated lines without a SAB field are skipped, as the pandas reader did.
+    """
+    with open(path, mode='rb') as f:
+        for line in f:
+            fields = line.split(b'|', sab_index + 1)
+            if len(fields) > sab_index and fields[sab_index] in ontology_bytes:
+                yield line
+
+
+def import_table_pandas_chunks(table_name, cons):
+    db_con, sa_con = cons
+
+    print('Importing via Pandas in chunks ', table_name)
+    column_names, table_columns = create_rrf_table(table_name, db_con)
     tab_dtypes = {}
-    for c in column_names:
+    for c in table_columns:
         tab_dtypes[c] = 'object'
     #db.execute('delete from ' + table_name)
-    df_chunk = pd.read_csv(pathlib.Path(args.umls_data_dir).joinpath(table_name + '.RRF'), delimiter='|', header=None, chunksize=200000,
-                           names = column_names, dtype=tab_dtypes)
+    # Rows of other sources never reach the parser; each chunk is parsed from the lines that passed the SAB filter
+    lines = iter_rrf_lines(pathlib.Path(args.umls_data_dir).joinpath(table_name + '.RRF'), column_names.index('SAB'))
 
     chunk_num = 1
-    for df in df_chunk:
+    num_rows = 0
+    for chunk in bulk_load.batched(lines, PANDAS_CHUNK_SIZE):
+        df = pd.read_csv(io.BytesIO(b''.join(chunk)), delimiter='|', header=None, names=column_names,
+                         usecols=table_columns, dtype=tab_dtypes)[table_columns]
         print("chunk ", chunk_num, 'of', table_name , 'has', len(df) , 'rows')
-        df = df.loc[df['SAB'].isin(ontologies)]
-        print("after purge has", len(df), "rows")
-        df = df.drop(df.columns[len(df.columns) - 1], axis=1)
+        num_rows += len(df)
         df.columns = [x.lower() for x in df.columns]
         if args.schema is not None:
-            df.to_sql(table_name.lower(), sa_connection, schema=args.schema, if_exists='append', index=False)
+            df.to_sql(table_name.lower(), sa_con, schema=args.schema, if_exists='append', index=False)
         else:
-            df.to_sql(table_name.lower(), sa_connection, if_exists='append', index=False)
+            df.to_sql(table_name.lower(), sa_con, if_exists='append', index=False)
         chunk_num += 1
-        sa_connection.commit()
+        sa_con.commit()
+
+    db_con.commit()
+    return num_rows
+
+
+def iter_rrf_rows(path, sab_index, indices):
+    """
+    Yield the fields at indices of the RRF rows whose SAB is one of the requested ontologies, empty or missing
+    fields as NULLs.
+    """
+    for line in iter_rrf_lines(path, sab_index):
+        fields = line.decode('utf-8').rstrip('\n').split('|')
+        yield tuple(fields[i] if i < len(fields) and fields[i] != '' else None for i in indices)
+
+
+def import_table_stream(table_name, cons):
+    """
+    Stream the filtered rows of an RRF file straight into the table -- COPY FROM STDIN on Postgres, executemany
+    on sqlite -- committing once at the end.  No dataframes are built so memory stays flat.
+    """
+    print(datetime.datetime.now(), 'Importing via streaming loader', table_name)
+    db_con = cons[0]
+    column_names, table_columns = create_rrf_table(table_name, db_con)
+    if args.schema is not None:
+        qualified_name = args.schema + '.' + table_name.lower()
+    else:
+        qualified_name = table_name.lower()
+    rows = iter_rrf_rows(pathlib.Path(args.umls_data_dir).joinpath(table_name + '.RRF'),
+                         column_names.index('SAB'), [column_names.index(c) for c in table_columns])
+    num_rows = bulk_load.copy_rows(db_con.cursor(), qualified_name, [c.lower() for c in table_columns], rows,
+                                   postgres=args.dbfilename is None)
+    db_con.commit()
+    print(datetime.datetime.now(), num_rows, 'rows loaded into', qualified_name)
+    return num_rows
 
-    db_connection.commit()
+
+def import_rrf_table(table_name, cons):
+    if args.loader == 'stream':
+        return import_table_stream(table_name, cons)
+    return import_table_pandas_chunks(table_name, cons)
+
+
+def create_index(index_name, table_name, column, cons):
+    db_con = cons[0]
+    if args.schema is not None:
+        db_con.cursor().execute("create index " + index_name + " on " + args.schema + "." + table_name + "(" + column + ")")
+    else:
+        db_con.cursor().execute("create index " + index_name + " on " + table_name + "(" + column + ")")
+    db_con.commit()
 
 
 #
 # Bootstrap with MRCOLS and MRFILES tables so the DDL can be generated for all other tables with proper datatypes
 #
+metrics.begin('importing MRCOLS, MRFILES and MRDOC')
 import_table_pandas('MRCOLS', columns = [ 'COL','DES','REF' ,'MIN','AV','MAX','FIL','DTY'])
 import_table_pandas('MRFILES', columns = ['FIL','DES','FMT','CLS','RWS','BTS'])
 import_table_pandas('MRDOC', columns = ['DOCKEY','VALUE','TYPE','EXPL'])
-
-# Now bring in other needed UMLS tables
-
-import_table_pandas_chunks('MRCONSO')
-import_table_pandas_chunks('MRREL')
-import_table_pandas_chunks('MRDEF')
-import_table_pandas_chunks('MRHIER')
-
-print(datetime.datetime.now(), "Creating indexes")
-if args.schema is not None:
-    cur.execute("create index mrconso_cui on "+args.schema+".mrconso(cui)")
-else:
-    cur.execute("create index mrconso_cui on mrconso(cui)")
-db_connection.commit()
-
-if args.schema is not None:
-    cur.execute("create index rel_cui1 on "+args.schema+".mrrel(cui1)")
-else:
-    cur.execute("create index rel_cui1 on mrrel(cui1)")
-db_connection.commit()
-
-if args.schema is not None:
-    cur.execute("create index rel_cui2 on "+args.schema+".mrrel(cui2)")
-else:
-    cur.execute("create index rel_cui2 on mrrel(cui2)")
-db_connection.commit()
-
-if args.schema is not None:
-    cur.execute("create index hier_sab on "+args.schema+".mrhier(sab)")
-else:
-    cur.execute("create index hier_sab on mrhier(sab)")
-db_connection.commit()
-
-if args.schema is not None:
-    cur.execute("create index hier_aui on "+args.schema+".mrhier(aui)")
-else:
-    cur.execute("create index hier_aui on mrhier(aui)")
-db_connection.commit()
-
-if args.schema is not None:
-    cur.execute("create index hier_paui on "+args.schema+".mrhier(paui)")
-else:
-    cur.execute("create index hier_paui on mrhier(paui)")
-db_connection.commit()
-
-if args.schema is not None:
-    cur.execute("create index conso_aui on "+args.schema+".mrconso(aui)")
-else:
-    cur.execute("create index conso_aui on mrconso(aui)")
-db_connection.commit()
+metrics.end()
+
+# Now bring in other needed UMLS tables.  The imports only depend on MRFILES/MRCOLS and each index only on its
+# own table, so with --jobs they are run side by side on separate connections.  With --bulk_load the indexes wait
+# for all of the loads.
+
+umls_indexes = [('mrconso_cui', 'mrconso', 'cui'),
+                ('rel_cui1', 'mrrel', 'cui1'),
+                ('rel_cui2', 'mrrel', 'cui2'),
+                ('hier_sab', 'mrhier', 'sab'),
+                ('hier_aui', 'mrhier', 'aui'),
+                ('hier_paui', 'mrhier', 'paui'),
+                ('conso_aui', 'mrconso', 'aui')]
+umls_tables = ['MRCONSO', 'MRREL', 'MRDEF', 'MRHIER']
+stages = [stage_runner.Stage(t.lower(), functools.partial(import_rrf_table, t)) for t in umls_tables]
+stages += [stage_runner.Stage(name, functools.partial(create_index, name, table, column),
+                              deps=[t.lower() for t in umls_tables] if args.bulk_load else [table])
+           for name, table, column in umls_indexes]
+jobs = args.jobs if args.dbfilename is None else 1
+stage_runner.run_stages(stages, connect, jobs=jobs, close=close_connections, shared=(db_connection, sa_connection),
+                        metrics=metrics, metrics_con=lambda cons: cons[0])
+
+if args.bulk_load:
+    metrics.begin('analyzing UMLS tables')
+    bulk_load.analyze(db_connection, [(args.schema + '.' if args.schema is not None else '') + t.lower()
+                                      for t in umls_tables])
+    metrics.begin('making UMLS tables durable')
+    bulk_load.leave_bulk_mode(db_connection, args.dbfilename is None, schema=args.schema)
+    metrics.end()
+
+if args.metrics_file is not None or args.metrics_table:
+    metrics_table = None
+    if args.metrics_table:
+        metrics_table = build_metrics.METRICS_TABLE if args.schema is None else args.schema + '.' + build_metrics.METRICS_TABLE
+    metrics.write(args.metrics_file, table=metrics_table)
 
 #create index hier_aui on mrhier(aui);
 #create index heir_paui on mrhier(paui);